@@ -0,0 +1,650 @@
+#!/usr/bin/env python
+# Copyright 2013 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Event loop for driving many URL fetches concurrently from one thread.
+
+Each FetchItem is sent over its own non-blocking socket and all of the
+sockets are multiplexed with poll() or select(). This lets a crawl have
+hundreds of fetches in flight without a thread per connection. Enabled
+with --fetch_engine=async.
+"""
+
+import Queue
+import StringIO
+import collections
+import errno
+import fcntl
+import heapq
+import httplib
+import os
+import select
+import socket
+import ssl
+import sys
+import time
+import urllib
+
+# Local Libraries
+import gflags
+FLAGS = gflags.FLAGS
+
+# Local modules
+from dpxdt.client import fetch_worker
+from dpxdt.client import workers
+
+
+LOGGER = workers.LOGGER
+
+# Bytes to read from or write to a socket at a time.
+BLOCK_SIZE = 64 * 1024
+
+# Largest status line and headers accepted from a server.
+MAX_HEADER_SIZE = 64 * 1024
+
+DEFAULT_PORTS = {
+    'http': 80,
+    'https': 443,
+}
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+
+class ProtocolError(Error):
+    """The server sent a response that could not be parsed."""
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class NotifyingQueue(Queue.Queue):
+    """Queue that writes to a pipe on every put so it can be polled."""
+
+    def __init__(self):
+        Queue.Queue.__init__(self)
+        self.read_fd, self.write_fd = os.pipe()
+        _set_nonblocking(self.read_fd)
+        _set_nonblocking(self.write_fd)
+
+    def _put(self, item):
+        Queue.Queue._put(self, item)
+        try:
+            os.write(self.write_fd, 'x')
+        except OSError, e:
+            # The pipe is full, so the reader is already going to wake up.
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def clear_notifications(self):
+        """Empties the pipe. Call this before draining the queue."""
+        try:
+            while os.read(self.read_fd, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+
+class ResponseParser(object):
+    """Incrementally parses an HTTP/1.x response.
+
+    Has the same status attribute and getheader() method as an
+    httplib.HTTPResponse so it can be passed to fetch_worker.get_redirect.
+    """
+
+    def __init__(self, method, write_body):
+        """Initializer.
+
+        Args:
+            method: HTTP method of the request.
+            write_body: Function to call with each piece of the body.
+        """
+        self.method = method
+        self.write_body = write_body
+        self.status = None
+        self.msg = None
+        self.done = False
+        self.buffer = ''
+        self.remaining = 0
+        self.step = self._parse_head
+
+    def getheader(self, name, default=None):
+        return self.msg.getheader(name, default)
+
+    def feed(self, data):
+        """Parses more data read from the socket."""
+        self.buffer += data
+        while not self.done and self.step():
+            pass
+
+    def feed_eof(self):
+        """Handles the server closing the connection."""
+        if self.step == self._parse_until_close:
+            self.done = True
+        elif not self.done:
+            raise ProtocolError('Connection closed before response finished')
+
+    def _read_line(self):
+        index = self.buffer.find('\r\n')
+        if index == -1:
+            if len(self.buffer) > MAX_HEADER_SIZE:
+                raise ProtocolError('Response line too long')
+            return None
+        line = self.buffer[:index]
+        self.buffer = self.buffer[index + 2:]
+        return line
+
+    def _take_body(self, limit=None):
+        if limit is None:
+            data, self.buffer = self.buffer, ''
+        else:
+            data, self.buffer = self.buffer[:limit], self.buffer[limit:]
+        if data:
+            self.write_body(data)
+        return len(data)
+
+    def _parse_head(self):
+        index = self.buffer.find('\r\n\r\n')
+        if index == -1:
+            if len(self.buffer) > MAX_HEADER_SIZE:
+                raise ProtocolError('Response headers too long')
+            return False
+
+        head = self.buffer[:index + 2]
+        self.buffer = self.buffer[index + 4:]
+        status_line, _, header_text = head.partition('\r\n')
+        parts = status_line.split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+            raise ProtocolError('Bad status line: %r' % status_line)
+        try:
+            self.status = int(parts[1])
+        except ValueError:
+            raise ProtocolError('Bad status line: %r' % status_line)
+        self.msg = httplib.HTTPMessage(StringIO.StringIO(header_text), 0)
+
+        if 100 <= self.status < 200:
+            # Skip informational responses like 100 Continue.
+            return True
+
+        if self.method == 'HEAD' or self.status in (204, 304):
+            self.done = True
+        elif 'chunked' in self.getheader('transfer-encoding', '').lower():
+            self.step = self._parse_chunk_size
+        elif self.getheader('content-length') is not None:
+            try:
+                self.remaining = int(self.getheader('content-length'))
+            except ValueError:
+                raise ProtocolError('Bad Content-Length')
+            self.step = self._parse_length
+            self.done = not self.remaining
+        else:
+            self.step = self._parse_until_close
+        return True
+
+    def _parse_length(self):
+        taken = self._take_body(self.remaining)
+        self.remaining -= taken
+        self.done = not self.remaining
+        return False
+
+    def _parse_until_close(self):
+        self._take_body()
+        return False
+
+    def _parse_chunk_size(self):
+        line = self._read_line()
+        if line is None:
+            return False
+        try:
+            self.remaining = int(line.split(';', 1)[0], 16)
+        except ValueError:
+            raise ProtocolError('Bad chunk size: %r' % line)
+        if self.remaining:
+            self.step = self._parse_chunk_data
+        else:
+            self.step = self._parse_trailers
+        return True
+
+    def _parse_chunk_data(self):
+        self.remaining -= self._take_body(self.remaining)
+        if self.remaining:
+            return False
+        self.step = self._parse_chunk_end
+        return True
+
+    def _parse_chunk_end(self):
+        if len(self.buffer) < 2:
+            return False
+        if self.buffer[:2] != '\r\n':
+            raise ProtocolError('Missing chunk terminator')
+        self.buffer = self.buffer[2:]
+        self.step = self._parse_chunk_size
+        return True
+
+    def _parse_trailers(self):
+        line = self._read_line()
+        if line is None:
+            return False
+        if not line:
+            self.done = True
+        return True
+
+
+class AsyncFetch(object):
+    """State of one fetch that is driven by the event loop."""
+
+    CONNECTING = 'connecting'
+    HANDSHAKING = 'handshaking'
+    SENDING = 'sending'
+    RECEIVING = 'receiving'
+
+    def __init__(self, item, request):
+        self.item = item
+        self.request = request
+        self.redirects = 0
+        self.sock = None
+        self.state = None
+        self.wants_write = False
+        self.deadline = None
+        self.parser = None
+        self.body_parts = None
+        self.result_file = None
+        self.out_data = ''
+        self.out_iter = None
+
+    @property
+    def host_key(self):
+        return (self.request.get_type(), self.request.get_host())
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def start(self, now):
+        """Opens the connection. May block while resolving the host name."""
+        self.close()
+        scheme = self.request.get_type()
+        host, port = urllib.splitport(self.request.get_host())
+        port = int(port or DEFAULT_PORTS[scheme])
+
+        family, socktype, proto, _, address = socket.getaddrinfo(
+            host, port, 0, socket.SOCK_STREAM)[0]
+        self.sock = socket.socket(family, socktype, proto)
+        self.sock.setblocking(0)
+        result = self.sock.connect_ex(address)
+        if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(result, os.strerror(result))
+
+        self.state = self.CONNECTING
+        self.wants_write = True
+        self.deadline = now + self.item.timeout_seconds
+
+        self._prepare_request()
+        if self.item.result_path:
+            self.result_file = open(self.item.result_path, 'wb')
+            write_body = self.result_file.write
+        else:
+            self.body_parts = []
+            write_body = self.body_parts.append
+        self.parser = ResponseParser(self.request.get_method(), write_body)
+
+    def _prepare_request(self):
+        lines = ['%s %s HTTP/1.1' % (
+            self.request.get_method(), self.request.get_selector())]
+        headers = dict(self.request.header_items())
+        headers.setdefault('Host', self.request.get_host())
+        headers['Connection'] = 'close'
+        headers['Accept-Encoding'] = 'identity'
+        for key, value in headers.iteritems():
+            lines.append('%s: %s' % (key, value))
+        self.out_data = '\r\n'.join(lines) + '\r\n\r\n'
+
+        data = self.request.get_data()
+        if data is None:
+            self.out_iter = iter(())
+        elif isinstance(data, str):
+            self.out_iter = iter((data,))
+        else:
+            # Generator from poster.multipart_encode.
+            if hasattr(data, 'reset'):
+                data.reset()
+            self.out_iter = iter(data)
+
+    def handle_ready(self, now):
+        """Makes progress after the socket is ready.
+
+        Returns:
+            True if the response is complete.
+
+        Raises:
+            socket.error, ssl.SSLError, or ProtocolError on failure.
+        """
+        self.deadline = now + self.item.timeout_seconds
+        if self.state == self.CONNECTING:
+            result = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if result:
+                raise socket.error(result, os.strerror(result))
+            if self.request.get_type() == 'https':
+                hostname = urllib.splitport(self.request.get_host())[0]
+                context = ssl.create_default_context()
+                self.sock = context.wrap_socket(
+                    self.sock,
+                    server_hostname=hostname,
+                    do_handshake_on_connect=False)
+                self.state = self.HANDSHAKING
+            else:
+                self.state = self.SENDING
+
+        if self.state == self.HANDSHAKING:
+            try:
+                self.sock.do_handshake()
+            except ssl.SSLWantReadError:
+                self.wants_write = False
+                return False
+            except ssl.SSLWantWriteError:
+                self.wants_write = True
+                return False
+            self.state = self.SENDING
+
+        if self.state == self.SENDING:
+            if not self._send():
+                return False
+            self.state = self.RECEIVING
+            self.wants_write = False
+
+        return self._receive()
+
+    def _send(self):
+        """Returns True once the whole request has been sent."""
+        while True:
+            if not self.out_data:
+                self.out_data = next(self.out_iter, None)
+                if self.out_data is None:
+                    return True
+            try:
+                sent = self.sock.send(self.out_data[:BLOCK_SIZE])
+            except ssl.SSLWantReadError:
+                self.wants_write = False
+                return False
+            except ssl.SSLWantWriteError:
+                self.wants_write = True
+                return False
+            except socket.error, e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                self.wants_write = True
+                return False
+            self.out_data = self.out_data[sent:]
+
+    def _receive(self):
+        """Returns True once the whole response has been received."""
+        while True:
+            try:
+                data = self.sock.recv(BLOCK_SIZE)
+            except ssl.SSLWantReadError:
+                return False
+            except socket.error, e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                return False
+
+            if not data:
+                self.parser.feed_eof()
+                return True
+            self.parser.feed(data)
+            if self.parser.done:
+                return True
+
+            # Decrypted data buffered by SSL won't make the socket readable.
+            if not (isinstance(self.sock, ssl.SSLSocket) and
+                    self.sock.pending()):
+                return False
+
+    def get_redirect(self):
+        """Returns the urllib2.Request to follow a redirect, or None."""
+        if self.redirects >= fetch_worker.MAX_REDIRECTS:
+            return None
+        return fetch_worker.get_redirect(self.request, self.parser)
+
+    def finish(self):
+        """Copies the response to the FetchItem."""
+        self.item.status_code = self.parser.status
+        self.item.content_type = self.parser.msg.gettype()
+        if self.body_parts is not None:
+            self.item.data = ''.join(self.body_parts)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if self.result_file is not None:
+            self.result_file.close()
+            self.result_file = None
+
+
+class AsyncFetchThread(workers.WorkerThread):
+    """Worker thread that runs an event loop of many concurrent fetches.
+
+    Must be given a NotifyingQueue as its input queue.
+    """
+
+    def __init__(self, input_queue, output_queue):
+        workers.WorkerThread.__init__(self, input_queue, output_queue)
+        # Maps host key to deque of AsyncFetch not yet started.
+        self.waiting = {}
+        # Maps host key to number of AsyncFetch in flight.
+        self.host_counts = collections.defaultdict(int)
+        self.active = set()
+        # Heap of (ready_time, FetchItem) waiting on their rate limits.
+        self.deferred = []
+
+    def run(self):
+        try:
+            while not self.interrupted:
+                self.input_queue.clear_notifications()
+                self._receive_items()
+                self._receive_deferred()
+                self._start_fetches()
+                self._poll()
+        finally:
+            for fetch in self.active:
+                fetch.close()
+
+    def _receive_items(self):
+        while True:
+            try:
+                item = self.input_queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            if item is workers._WAKEUP:
+                self.input_queue.task_done()
+                continue
+
+            self._add_item(item)
+
+    def _receive_deferred(self):
+        now = time.time()
+        while self.deferred and self.deferred[0][0] <= now:
+            _, item = heapq.heappop(self.deferred)
+            item.rate_limit_reserved = True
+            self._add_item(item)
+
+    def _add_item(self, item):
+        try:
+            self._start_item(item)
+        except Exception:
+            self._finish_item(item, sys.exc_info())
+
+    def _start_item(self, item):
+        if fetch_worker.is_forbidden(item):
+            self._finish_item(item)
+            return
+
+        if not item.rate_limit_reserved:
+            wait_duration = fetch_worker.LIMITER.reserve(item.url)
+            if wait_duration > 0:
+                LOGGER.debug('Rate limiting URL fetch for %f seconds',
+                             wait_duration)
+                heapq.heappush(
+                    self.deferred, (time.time() + wait_duration, item))
+                return
+        item.rate_limit_reserved = False
+
+        request = fetch_worker.build_request(item)
+        if (FLAGS.fetch_use_internal_redirects or
+                not fetch_worker.is_direct(request)):
+            # These are rare and can't be done with non-blocking sockets.
+            if FLAGS.fetch_use_internal_redirects:
+                fetch_worker.fetch_internal(item, request)
+            else:
+                fetch_worker.fetch_normal(item, request)
+            self._finish_item(item)
+            return
+
+        self._wait(AsyncFetch(item, request))
+
+    def _wait(self, fetch):
+        self.waiting.setdefault(fetch.host_key, collections.deque()).append(
+            fetch)
+
+    def _start_fetches(self):
+        now = time.time()
+        for host_key in self.waiting.keys():
+            queue = self.waiting[host_key]
+            while (queue and
+                   len(self.active) < FLAGS.fetch_async_max_connections and
+                   self.host_counts[host_key] < FLAGS.fetch_async_max_per_host):
+                fetch = queue.popleft()
+                try:
+                    fetch.start(now)
+                except (socket.error, ssl.SSLError), e:
+                    self._fetch_failed(fetch, e)
+                except Exception:
+                    fetch.close()
+                    self._finish_item(fetch.item, sys.exc_info())
+                else:
+                    self.active.add(fetch)
+                    self.host_counts[host_key] += 1
+            if not queue:
+                del self.waiting[host_key]
+
+    def _poll(self):
+        deadlines = [f.deadline for f in self.active]
+        if self.deferred:
+            deadlines.append(self.deferred[0][0])
+        if deadlines:
+            timeout = max(0, min(deadlines) - time.time())
+        else:
+            timeout = None
+
+        fetch_by_fd = dict((f.fileno(), f) for f in self.active)
+        ready_fds = self._wait_for_ready(fetch_by_fd, timeout)
+
+        now = time.time()
+        for fd in ready_fds:
+            fetch = fetch_by_fd.get(fd)
+            if fetch is None:
+                continue
+            try:
+                complete = fetch.handle_ready(now)
+            except (socket.error, ssl.SSLError, ProtocolError), e:
+                self._fetch_failed(fetch, e)
+            except Exception:
+                self._release(fetch)
+                self._finish_item(fetch.item, sys.exc_info())
+            else:
+                if complete:
+                    self._fetch_complete(fetch)
+
+        for fetch in list(self.active):
+            if fetch.deadline <= now:
+                self._fetch_failed(fetch, socket.timeout('timed out'))
+
+    def _wait_for_ready(self, fetch_by_fd, timeout):
+        """Returns the file descriptors of fetches that can make progress."""
+        notify_fd = self.input_queue.read_fd
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            poller.register(notify_fd, select.POLLIN)
+            for fd, fetch in fetch_by_fd.iteritems():
+                if fetch.wants_write:
+                    poller.register(fd, select.POLLOUT)
+                else:
+                    poller.register(fd, select.POLLIN)
+            if timeout is not None:
+                timeout *= 1000
+            events = poller.poll(timeout)
+            return [fd for fd, _ in events if fd != notify_fd]
+
+        readers = [notify_fd]
+        writers = []
+        for fd, fetch in fetch_by_fd.iteritems():
+            if fetch.wants_write:
+                writers.append(fd)
+            else:
+                readers.append(fd)
+        readable, writable, _ = select.select(readers, writers, [], timeout)
+        return [fd for fd in readable + writable if fd != notify_fd]
+
+    def _release(self, fetch):
+        fetch.close()
+        self.active.discard(fetch)
+        self.host_counts[fetch.host_key] -= 1
+        if not self.host_counts[fetch.host_key]:
+            del self.host_counts[fetch.host_key]
+
+    def _fetch_complete(self, fetch):
+        self._release(fetch)
+        next_request = fetch.get_redirect()
+        if next_request:
+            fetch.request = next_request
+            fetch.redirects += 1
+            self._wait(fetch)
+            return
+
+        fetch.finish()
+        LOGGER.debug('Fetched %r status=%s', fetch.request.get_full_url(),
+                     fetch.item.status_code)
+        self._finish_item(fetch.item)
+
+    def _fetch_failed(self, fetch, e):
+        LOGGER.debug('Fetch of %r failed. %s: %s',
+                     fetch.request.get_full_url(), e.__class__.__name__, e)
+        if fetch in self.active:
+            self._release(fetch)
+        else:
+            fetch.close()
+        fetch_worker.set_connection_error(fetch.item, e)
+        self._finish_item(fetch.item)
+
+    def _finish_item(self, item, error=None):
+        if error:
+            item.error = error
+            LOGGER.error('%s error item=%r', self.worker_name, item,
+                         exc_info=error)
+        else:
+            item.done = True
+        self.output_queue.put(item)
+        self.input_queue.task_done()
+
+
+def register(coordinator):
+    """Registers this module as a worker with the given coordinator."""
+    fetch_queue = NotifyingQueue()
+    coordinator.register(fetch_worker.FetchItem, fetch_queue)
+    coordinator.worker_threads.append(
+        AsyncFetchThread(fetch_queue, coordinator.input_queue))
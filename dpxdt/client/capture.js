@@ -18,320 +18,585 @@
 
 var fs = require('fs');
 var system = require('system');
+var webpage = require('webpage');
 
 
-// Read and validate config.
-var configPath = null;
-var outputPath = null;
-if (system.args.length == 3) {
-    configPath = system.args[1];
-    outputPath = system.args[2];
-} else {
-    console.log('Usage: phantomjs capture.js <config.js> <outputPath>');
-    phantom.exit(1);
-}
+// Printed on its own line after each capture in server and manifest mode,
+// followed by a JSON object with the capture's returncode.
+var CAPTURE_DONE_MARKER = 'DPXDT-CAPTURE-DONE ';
 
-try {
-    var config = JSON.parse(fs.read(configPath));
-} catch (e) {
-    console.log('Could not read config at "' + configPath + '":\n' + e);
-    phantom.exit(1);
-}
 
-['targetUrl'].forEach(function(field) {
-    if (!config[field]) {
-        console.log('Missing required field: ' + field);
-        phantom.exit(1);
+// Returns where the screenshot for the viewport at the given index is
+// written when the config has a list of viewports. The index goes before
+// the file extension, e.g. capture.png becomes capture.1.png.
+function getViewportOutputPath(outputPath, index) {
+    var dot = outputPath.lastIndexOf('.');
+    if (dot <= outputPath.lastIndexOf('/')) {
+        return outputPath + '.' + index;
     }
-});
+    return outputPath.slice(0, dot) + '.' + index + outputPath.slice(dot);
+}
 
 
-// Configure the page.
-var page = require('webpage').create();
+var ResourceStatus = {
+    DONE: 'done',
+    ERROR: 'error',
+    TIMEOUT: 'timeout',
+    PENDING: 'pending'
+};
 
-if (config.viewportSize) {
-    page.viewportSize = {
-        width: config.viewportSize.width,
-        height: config.viewportSize.height
-    };
-}
 
-if (config.userAgent) {
-    page.settings.userAgent = config.userAgent;
-}
+// Captures a screenshot of a page, then calls done with a returncode of 0
+// for success or 1 for failure. Each capture uses a new page, so captures
+// do not share any page state.
+function capture(configPath, outputPath, done) {
+    var finished = false;
+    var page = null;
+    var startTime = Date.now();
 
-if (config.clipRect) {
-    page.clipRect = {
-        left: 0,
-        top: 0,
-        width: config.clipRect.width,
-        height: config.clipRect.height
-    };
-}
+    // Logs how long a phase of the capture took.
+    function logTiming(phase, phaseStartTime) {
+        console.log('Timing: ' + phase + ' took ' +
+                    (Date.now() - phaseStartTime) + 'ms');
+    }
 
-if (config.cookies) {
-    config.cookies.forEach(function(cookie) {
-        phantom.addCookie(cookie);
-    });
-}
+    // Calls done exactly once, after closing the page.
+    function finish(returncode) {
+        if (finished) {
+            return;
+        }
+        finished = true;
+        if (page) {
+            page.close();
+        }
+        logTiming('capture', startTime);
+        done(returncode);
+    }
 
-// Add username and password as a parameter for HTTP basic auth
-if (config.httpUserName && config.httpPassword) {
-    page.settings.userName = config.httpUserName;
-    page.settings.password = config.httpPassword;
-}
+    // Read and validate config. The resourceCache field is handled by
+    // capture_worker.py, which starts phantomjs with a shared disk cache.
+    try {
+        var config = JSON.parse(fs.read(configPath));
+    } catch (e) {
+        console.log('Could not read config at "' + configPath + '":\n' + e);
+        finish(1);
+        return;
+    }
 
-page.settings.resourceTimeout = config.resourceTimeoutMs || 10000;
+    var missingField = false;
+    ['targetUrl'].forEach(function(field) {
+        if (!config[field]) {
+            console.log('Missing required field: ' + field);
+            missingField = true;
+        }
+    });
+    if (missingField) {
+        finish(1);
+        return;
+    }
 
 
-// Do not load Google Analytics URLs. We don't want to pollute stats.
-var badResources = [
-    'www.google-analytics.com'
-];
+    // Configure the page.
+    page = webpage.create();
+
+    // A list of viewports, each with a name, width, height, and optional
+    // clipRect, captures one screenshot per viewport from a single page
+    // load. The page is laid out for the first viewport when it loads.
+    var viewports = config.viewports || null;
+    if (viewports) {
+        page.viewportSize = {
+            width: viewports[0].width,
+            height: viewports[0].height
+        };
+    } else if (config.viewportSize) {
+        page.viewportSize = {
+            width: config.viewportSize.width,
+            height: config.viewportSize.height
+        };
+    }
 
-if (config.resourcesToIgnore) {
-    badResources.forEach(function(bad) {
-        config.resourcesToIgnore.push(bad);
-    });
-} else {
-    config.resourcesToIgnore = badResources;
-}
+    if (config.userAgent) {
+        page.settings.userAgent = config.userAgent;
+    }
 
+    if (config.clipRect) {
+        page.clipRect = {
+            left: 0,
+            top: 0,
+            width: config.clipRect.width,
+            height: config.clipRect.height
+        };
+    }
 
-// Echo all console messages from the page to our log.
-page.onConsoleMessage = function(message, line, source) {
-    console.log('>> CONSOLE: ' + message);
-};
+    if (config.cookies) {
+        config.cookies.forEach(function(cookie) {
+            phantom.addCookie(cookie);
+        });
+    }
 
+    // Add username and password as a parameter for HTTP basic auth
+    if (config.httpUserName && config.httpPassword) {
+        page.settings.userName = config.httpUserName;
+        page.settings.password = config.httpPassword;
+    }
 
-var ResourceStatus = {
-    DONE: 'done',
-    ERROR: 'error',
-    TIMEOUT: 'timeout',
-    PENDING: 'pending'
-};
+    page.settings.resourceTimeout = config.resourceTimeoutMs || 10000;
 
-// Maps a URL to a ResultStatus value.
-var resourceStatusMap = {};
+    // How long no resources must be pending before the page is ready.
+    var quietPeriodMs = config.quietPeriodMs;
+    if (quietPeriodMs === undefined) {
+        quietPeriodMs = 100;
+    }
+
+    // How long to wait for the page to be ready. After this the capture
+    // fails, unless renderOnTimeout is set to take the screenshot anyway.
+    var readyTimeoutMs = config.readyTimeoutMs || 60000;
+    var renderOnTimeout = !!config.renderOnTimeout;
 
 
-// We don't necessarily want to load every resource a page asks for.
-page.onResourceRequested = function(requestData, networkRequest) {
-    var url = requestData.url;
+    // Do not load Google Analytics URLs. We don't want to pollute stats.
+    var badResources = [
+        'www.google-analytics.com'
+    ];
 
-    if (url.indexOf('data:') == 0) {
-        console.log('Requested data URI');
+    if (config.resourcesToIgnore) {
+        badResources.forEach(function(bad) {
+            config.resourcesToIgnore.push(bad);
+        });
     } else {
-        for (var i = 0; i < config.resourcesToIgnore.length; i++) {
-            var bad = config.resourcesToIgnore[i];
-            if (bad == url || url.match(new RegExp(bad))) {
-                console.log('Blocking resource: ' + url);
-                networkRequest.abort();
-                return;
+        config.resourcesToIgnore = badResources;
+    }
+
+
+    // Echo all console messages from the page to our log.
+    page.onConsoleMessage = function(message, line, source) {
+        console.log('>> CONSOLE: ' + message);
+    };
+
+
+    // Maps a URL to a ResultStatus value.
+    var resourceStatusMap = {};
+
+
+    // We don't necessarily want to load every resource a page asks for.
+    page.onResourceRequested = function(requestData, networkRequest) {
+        var url = requestData.url;
+
+        if (url.indexOf('data:') == 0) {
+            console.log('Requested data URI');
+        } else {
+            for (var i = 0; i < config.resourcesToIgnore.length; i++) {
+                var bad = config.resourcesToIgnore[i];
+                if (bad == url || url.match(new RegExp(bad))) {
+                    console.log('Blocking resource: ' + url);
+                    networkRequest.abort();
+                    return;
+                }
             }
-        }
 
-        if (config.injectHeaders) {
-            for (var host in config.injectHeaders) {
-                if (host == url || url.match(new RegExp(host))) {
-                    var headers = config.injectHeaders[host];
-                    for (var header in headers) {
-                        networkRequest.setHeader(header, headers[header]);
-                        console.log('Setting header ' + header + ' to ' + headers[header]);
+            if (config.injectHeaders) {
+                for (var host in config.injectHeaders) {
+                    if (host == url || url.match(new RegExp(host))) {
+                        var headers = config.injectHeaders[host];
+                        for (var header in headers) {
+                            networkRequest.setHeader(header, headers[header]);
+                            console.log('Setting header ' + header + ' to ' + headers[header]);
+                        }
                     }
                 }
             }
+            console.log('Requested: ' + url);
         }
-        console.log('Requested: ' + url);
-    }
 
-    // Always reset the status to pending each time a new request happens.
-    // This handles the case where the page or JS causes a resource to reload
-    // for some reason, expecting a different result.
-    resourceStatusMap[url] = ResourceStatus.PENDING;
-};
+        // Always reset the status to pending each time a new request happens.
+        // This handles the case where the page or JS causes a resource to
+        // reload for some reason, expecting a different result.
+        resourceStatusMap[url] = ResourceStatus.PENDING;
+        checkReady();
+    };
 
 
-// Log all resources loaded as part of this request, for debugging.
-page.onResourceReceived = function(response) {
-    if (response.stage != 'end') {
-        return;
-    }
-    var url = response.url;
-    if (url.indexOf('data:') == 0) {
-        console.log('Loaded data URI');
-    } else if (response.redirectURL) {
-        console.log('Loaded redirect: ' + url + ' -> ' + response.redirectURL);
-    } else {
-        console.log('Loaded: ' + url);
-    }
-    if (resourceStatusMap[url] == ResourceStatus.PENDING) {
-        resourceStatusMap[url] = ResourceStatus.DONE;
-    }
-};
+    // Log all resources loaded as part of this request, for debugging.
+    page.onResourceReceived = function(response) {
+        if (response.stage != 'end') {
+            return;
+        }
+        var url = response.url;
+        if (url.indexOf('data:') == 0) {
+            console.log('Loaded data URI');
+        } else if (response.redirectURL) {
+            console.log('Loaded redirect: ' + url + ' -> ' + response.redirectURL);
+        } else {
+            console.log('Loaded: ' + url);
+        }
+        if (resourceStatusMap[url] == ResourceStatus.PENDING) {
+            resourceStatusMap[url] = ResourceStatus.DONE;
+        }
+        checkReady();
+    };
 
 
-// Detect if any resources timeout.
-page.onResourceTimeout = function(request) {
-    var url = request.url;
-    console.log('Loading resource timed out: ' + url);
-    if (resourceStatusMap[url] == ResourceStatus.PENDING) {
-        resourceStatusMap[url] = ResourceStatus.TIMEOUT;
-    }
-};
+    // Detect if any resources timeout.
+    page.onResourceTimeout = function(request) {
+        var url = request.url;
+        console.log('Loading resource timed out: ' + url);
+        if (resourceStatusMap[url] == ResourceStatus.PENDING) {
+            resourceStatusMap[url] = ResourceStatus.TIMEOUT;
+        }
+        checkReady();
+    };
 
 
-// Detect if any resources fail to load.
-page.onResourceError = function(error) {
-    var url = error.url;
-    console.log('Loading resource errored: ' + url +
-                ', errorCode=' + error.errorCode +
-                ', errorString=' + error.errorString);
-    if (resourceStatusMap[url] == ResourceStatus.PENDING) {
-        resourceStatusMap[url] = ResourceStatus.ERROR;
-    }
-};
+    // Detect if any resources fail to load.
+    page.onResourceError = function(error) {
+        var url = error.url;
+        console.log('Loading resource errored: ' + url +
+                    ', errorCode=' + error.errorCode +
+                    ', errorString=' + error.errorString);
+        if (resourceStatusMap[url] == ResourceStatus.PENDING) {
+            resourceStatusMap[url] = ResourceStatus.ERROR;
+        }
+        checkReady();
+    };
 
 
-// Just for debug logging.
-page.onInitialized = function() {
-    console.log('page.onInitialized');
-};
+    // Just for debug logging.
+    page.onInitialized = function() {
+        console.log('page.onInitialized');
+    };
 
 
-// Dumps out any error logs.
-page.onError = function(msg, trace) {
-    var msgStack = [msg];
-    if (trace && trace.length) {
-        trace.forEach(function(t) {
-            msgStack.push(
-                ' -> ' + (t.file || t.sourceURL) + ': ' + t.line +
-                (t.function ? ' (in function ' + t.function + ')' : ''));
-        });
-    }
+    // Dumps out any error logs.
+    page.onError = function(msg, trace) {
+        var msgStack = [msg];
+        if (trace && trace.length) {
+            trace.forEach(function(t) {
+                msgStack.push(
+                    ' -> ' + (t.file || t.sourceURL) + ': ' + t.line +
+                    (t.function ? ' (in function ' + t.function + ')' : ''));
+            });
+        }
 
-    console.log('page.onError', msgStack.join('\n'));
-};
+        console.log('page.onError', msgStack.join('\n'));
+    };
 
 
-// Just for debug logging.
-page.onNavigationRequested = function(url, type, willNavigate, main) {
-    if (!main) {
-        return;
-    }
-    console.log('page.onNavigationRequested: ' + url);
-};
+    // Just for debug logging.
+    page.onNavigationRequested = function(url, type, willNavigate, main) {
+        if (!main) {
+            return;
+        }
+        console.log('page.onNavigationRequested: ' + url);
+    };
 
 
-// Just for debug logging.
-page.onLoadStarted = function() {
-    console.log('page.onLoadStarted');
-};
+    // Just for debug logging.
+    page.onLoadStarted = function() {
+        console.log('page.onLoadStarted');
+    };
 
 
-// Just for debug logging.
-page.onLoadFinished = function(status) {
-    console.log('page.onLoadFinished');
-    if (status == 'success') {
-        console.log('Loaded the page successfully');
-    } else {
-        console.log('Loading the page failed', status);
-        phantom.exit(1);
-    }
-};
+    // Just for debug logging.
+    page.onLoadFinished = function(status) {
+        console.log('page.onLoadFinished');
+        if (status == 'success') {
+            console.log('Loaded the page successfully');
+        } else {
+            console.log('Loading the page failed', status);
+            finish(1);
+        }
+    };
 
 
-// Takes the screenshot and exits successfully.
-page.doScreenshot = function() {
-    console.log('Taking the screenshot and saving to:', outputPath);
-    page.render(outputPath);
-    phantom.exit(0);
-};
+    // Takes the screenshot and finishes successfully.
+    page.doScreenshot = function() {
+        if (finished) {
+            return;
+        }
+        if (viewports) {
+            page.doViewportScreenshot(0);
+            return;
+        }
+        console.log('Taking the screenshot and saving to:', outputPath);
+        var renderStartTime = Date.now();
+        page.render(outputPath);
+        logTiming('render', renderStartTime);
+        finish(0);
+    };
 
 
-// Injects CSS and JS into the page.
-page.doInject = function() {
-    var didInject = false;
+    // Takes the screenshot for each viewport in turn, starting with the
+    // given index, re-laying out the page for each one.
+    page.doViewportScreenshot = function(index) {
+        if (finished) {
+            return;
+        }
+        if (index >= viewports.length) {
+            finish(0);
+            return;
+        }
 
-    if (config.injectCss) {
-        didInject = true;
-        console.log('Injecting CSS: ' + config.injectCss);
-        page.evaluate(function(config) {
-            var styleEl = document.createElement('style');
-            styleEl.type = 'text/css';
-            styleEl.innerHTML = config.injectCss;
-            document.getElementsByTagName('head')[0].appendChild(styleEl);
-        }, config);
-    }
+        var viewport = viewports[index];
+        var render = function() {
+            var viewportOutputPath = getViewportOutputPath(outputPath, index);
+            console.log('Taking the screenshot for viewport ' +
+                        viewport.name + ' and saving to:',
+                        viewportOutputPath);
+            var renderStartTime = Date.now();
+            page.render(viewportOutputPath);
+            logTiming('render ' + viewport.name, renderStartTime);
+            page.doViewportScreenshot(index + 1);
+        };
+
+        page.clipRect = {
+            left: 0,
+            top: 0,
+            width: viewport.clipRect ? viewport.clipRect.width : 0,
+            height: viewport.clipRect ? viewport.clipRect.height : 0
+        };
+
+        if (index == 0) {
+            // The page was already laid out for the first viewport.
+            render();
+            return;
+        }
+
+        // Resizing can load different responsive resources, so wait for the
+        // page to get ready again before taking the screenshot.
+        console.log('Resizing to viewport ' + viewport.name + ':',
+                    viewport.width + 'x' + viewport.height);
+        page.viewportSize = {
+            width: viewport.width,
+            height: viewport.height
+        };
+        page.waitForReady('viewport ' + viewport.name, render);
+    };
+
+
+    // Injects CSS and JS into the page.
+    page.doInject = function() {
+        if (finished) {
+            return;
+        }
 
-    if (config.injectJs) {
-        didInject = true;
-        console.log('Injecting JS: ' + config.injectJs);
-        var success = page.evaluate(function(config) {
-            try {
-                window.eval(config.injectJs);
-            } catch (e) {
-                console.log('Exception running injectJs');
-                console.log(e.stack);
-                return false;
+        var didInject = false;
+
+        if (config.injectCss) {
+            didInject = true;
+            console.log('Injecting CSS: ' + config.injectCss);
+            page.evaluate(function(config) {
+                var styleEl = document.createElement('style');
+                styleEl.type = 'text/css';
+                styleEl.innerHTML = config.injectCss;
+                document.getElementsByTagName('head')[0].appendChild(styleEl);
+            }, config);
+        }
+
+        if (config.injectJs) {
+            didInject = true;
+            console.log('Injecting JS: ' + config.injectJs);
+            var success = page.evaluate(function(config) {
+                try {
+                    window.eval(config.injectJs);
+                } catch (e) {
+                    console.log('Exception running injectJs');
+                    console.log(e.stack);
+                    return false;
+                }
+                return true;
+            }, config);
+            if (!success) {
+                finish(1);
+                return;
             }
-            return true;
-        }, config);
-        if (!success) {
-            phantom.exit(1);
         }
+
+        if (!didInject) {
+            page.doScreenshot();
+        } else {
+            // Wait for any injected CSS and JS to finish running, including
+            // asynchronous requests, then take a screenshot.
+            page.waitForReady('inject', page.doScreenshot);
+        }
+    };
+
+
+    // The current call to waitForReady, if any.
+    var readyWaiter = null;
+
+
+    // Returns counts of resources by ResourceStatus value.
+    function getResourceTotals() {
+        var totals = {};
+        for (var url in resourceStatusMap) {
+            var status = resourceStatusMap[url];
+            var value = totals[status] || 0;
+            totals[status] = value + 1;
+        }
+        return totals;
     }
 
-    if (!didInject) {
-        page.doScreenshot();
-    } else {
-        // Wait for any injected CSS and JS to finish running, including
-        // asynchronous requests, then take a screenshot.
-        window.setTimeout(function() {
-            page.waitForReady(page.doScreenshot);
-        }, 500);
+
+    // Stops waiting and calls the waiting function.
+    function fireReady() {
+        var waiter = readyWaiter;
+        readyWaiter = null;
+        window.clearTimeout(waiter.quietTimer);
+        window.clearTimeout(waiter.deadlineTimer);
+
+        console.log('Status of all resources:',
+                    JSON.stringify(getResourceTotals()));
+        logTiming('wait for ' + waiter.phase, waiter.startTime);
+        if (!finished) {
+            waiter.func();
+        }
     }
-};
 
 
-// Wait for all resources on the page to load, then call the given function.
-page.waitForReady = function(func) {
-    var totals = {};
-    for (var url in resourceStatusMap) {
-        var status = resourceStatusMap[url];
-        var value = totals[status] || 0;
-        totals[status] = value + 1;
+    // Called whenever a resource changes status. Starts the quiet period
+    // once nothing is pending, and cancels it when a new request starts.
+    function checkReady() {
+        if (!readyWaiter || finished) {
+            return;
+        }
+
+        var pending = getResourceTotals()[ResourceStatus.PENDING] || 0;
+        if (pending) {
+            window.clearTimeout(readyWaiter.quietTimer);
+            readyWaiter.quietTimer = null;
+        } else if (!readyWaiter.quietTimer) {
+            readyWaiter.quietTimer = window.setTimeout(function() {
+                console.log('No more resources are pending!');
+                fireReady();
+            }, quietPeriodMs);
+        }
     }
 
-    console.log('Status of all resources:', JSON.stringify(totals));
 
-    var pending = totals[ResourceStatus.PENDING] || 0;
-    if (!pending) {
-        console.log('No more resources are pending!');
-        func();
-        return;
-    } else {
-        for (var url in resourceStatusMap) {
-            if (resourceStatusMap[url] == ResourceStatus.PENDING) {
-                console.log('Still waiting for: ' + url);
-            }
+    // Waits for all resources on the page to load and then for the quiet
+    // period to pass with no new requests, then calls the given function.
+    // Fails the capture after the ready timeout, or calls the function
+    // anyway when renderOnTimeout is set.
+    page.waitForReady = function(phase, func) {
+        if (finished) {
+            return;
         }
+
+        readyWaiter = {
+            phase: phase,
+            func: func,
+            startTime: Date.now(),
+            quietTimer: null,
+            deadlineTimer: window.setTimeout(function() {
+                for (var url in resourceStatusMap) {
+                    if (resourceStatusMap[url] == ResourceStatus.PENDING) {
+                        console.log('Still waiting for: ' + url);
+                    }
+                }
+                if (renderOnTimeout) {
+                    console.log('Page was not ready after ' + readyTimeoutMs +
+                                'ms, continuing anyway');
+                    fireReady();
+                    return;
+                }
+                console.log('Page was not ready after ' + readyTimeoutMs +
+                            'ms, giving up');
+                window.clearTimeout(readyWaiter.quietTimer);
+                readyWaiter = null;
+                finish(1);
+            }, readyTimeoutMs)
+        };
+        checkReady();
+    };
+
+
+    // Kickoff the load!
+    console.log('Opening page', config.targetUrl);
+    var openStartTime = Date.now();
+    page.open(config.targetUrl, function(status) {
+        console.log('Finished loading page:', config.targetUrl,
+                    'w/ status:', status);
+        logTiming('open', openStartTime);
+
+        // Wait for the page to get ready, then inject CSS and JS.
+        page.waitForReady('load', page.doInject);
+    });
+}
+
+
+// Runs the capture for one job of many in the same browser process, then
+// prints CAPTURE_DONE_MARKER and calls next.
+function captureJob(job, next) {
+    capture(job.configPath, job.outputPath, function(returncode) {
+        // Reset state that outlives the page before the next capture.
+        phantom.clearCookies();
+        console.log(
+            CAPTURE_DONE_MARKER + JSON.stringify({returncode: returncode}));
+        window.setTimeout(next, 0);
+    });
+}
+
+
+// Runs captures one after another for jobs read from stdin, so one browser
+// process can be reused for many captures. Each job is a line of JSON with
+// the configPath and outputPath. Exits when stdin is closed.
+function serve() {
+    var line = system.stdin.readLine();
+    if (!line) {
+        phantom.exit(0);
+        return;
     }
 
-    window.setTimeout(function() {
-        page.waitForReady(func);
-    }, 500);
-};
+    var job = null;
+    try {
+        job = JSON.parse(line);
+    } catch (e) {
+        console.log('Could not parse capture job "' + line + '":\n' + e);
+        console.log(CAPTURE_DONE_MARKER + JSON.stringify({returncode: 1}));
+        window.setTimeout(serve, 0);
+        return;
+    }
 
+    captureJob(job, serve);
+}
 
-// Kickoff the load!
-console.log('Opening page', config.targetUrl);
-page.open(config.targetUrl, function(status) {
-    console.log('Finished loading page:', config.targetUrl,
-                'w/ status:', status);
 
-    // Wait for the page to get ready, then inject CSS and JS.
-    window.setTimeout(function() {
-        page.waitForReady(page.doInject);
-    }, 500);
-});
+// Runs captures one after another for the jobs in a manifest file, which
+// is a JSON list of objects with the configPath and outputPath. Exits once
+// every job is done.
+function runManifest(manifestPath) {
+    try {
+        var jobs = JSON.parse(fs.read(manifestPath));
+    } catch (e) {
+        console.log('Could not read manifest at "' + manifestPath + '":\n' +
+                    e);
+        phantom.exit(1);
+        return;
+    }
+
+    var index = 0;
+    var next = function() {
+        if (index >= jobs.length) {
+            phantom.exit(0);
+            return;
+        }
+        captureJob(jobs[index++], next);
+    };
+    next();
+}
+
+
+if (system.args.length == 2 && system.args[1] == '--server') {
+    serve();
+} else if (system.args.length == 3 && system.args[1] == '--manifest') {
+    runManifest(system.args[2]);
+} else if (system.args.length == 3) {
+    capture(system.args[1], system.args[2], function(returncode) {
+        phantom.exit(returncode);
+    });
+} else {
+    console.log('Usage: phantomjs capture.js <config.js> <outputPath>\n' +
+                '       phantomjs capture.js --manifest <manifest.json>\n' +
+                '       phantomjs capture.js --server');
+    phantom.exit(1);
+}
@@ -23,6 +23,7 @@
 
 import json
 import logging
+import os
 from pprint import pprint
 import sys
 import time
@@ -57,6 +58,11 @@ def getProfile(desired_capabilities, config):
         profile.update_preferences()
     return profile
 
+def getViewportOutputFile(output_file, index):
+    # Matches capture_worker.get_viewport_output_path.
+    root, ext = os.path.splitext(output_file)
+    return '%s.%d%s' % (root, index, ext)
+
 def injectCSSandJS(driver, config):
     if 'injectCss' in config and config['injectCss'] is not None and config['injectCss'] != '':
         script = ("var node = document.createElement('style');"
@@ -73,6 +79,13 @@ driver = webdriver.Remote(
     command_executor=config['command_executor'],
     desired_capabilities=config['desired_capabilities'],
 )
+
+# With a list of viewports, load the page once at the first viewport and
+# resize the window for each of the others.
+viewports = config.get('viewports')
+if viewports:
+    driver.set_window_size(viewports[0]['width'], viewports[0]['height'])
+
 driver.get(config['targetUrl'])
 injectCSSandJS(driver, config)
 
@@ -81,5 +94,13 @@ wait = WebDriverWait(driver, resourceTimeoutMs)
 areResourcesDoneScript = "return typeof jQuery !== 'undefined' && jQuery.active === 0"
 wait.until(lambda driver: driver.execute_script(areResourcesDoneScript))
 
-driver.save_screenshot(output_file)
+if viewports:
+    for index, viewport in enumerate(viewports):
+        if index > 0:
+            driver.set_window_size(viewport['width'], viewport['height'])
+            wait.until(
+                lambda driver: driver.execute_script(areResourcesDoneScript))
+        driver.save_screenshot(getViewportOutputFile(output_file, index))
+else:
+    driver.save_screenshot(output_file)
 driver.quit()
@@ -20,7 +20,10 @@ import json
 import logging
 import os
 import shutil
+import subprocess
+import sys
 import tempfile
+import threading
 import time
 import urllib2
 
@@ -36,6 +39,13 @@ from dpxdt.client import release_worker
 from dpxdt.client import utils
 from dpxdt.client import workers
 
+
+LOGGER = workers.LOGGER
+
+# Line that capture.js prints after each capture in --server and --manifest
+# mode, followed by JSON with the capture's returncode.
+CAPTURE_DONE_MARKER = 'DPXDT-CAPTURE-DONE '
+
 DEFAULT_PHANTOMJS_FLAGS = [
     '--disk-cache=false',
     '--debug=true',
@@ -92,15 +102,191 @@ gflags.DEFINE_integer(
     'capture_timeout', 120,
     'Seconds until giving up on a capture sub-process and trying again.')
 
+gflags.DEFINE_integer(
+    'capture_pool_size', 0,
+    'Number of long-running capture processes to keep warm and reuse '
+    'across screenshots. Usually the same as --capture_threads. When 0, '
+    'a new capture process is started for every screenshot. Requires a '
+    'capture script that supports --server, like capture.js.')
+
+gflags.DEFINE_integer(
+    'capture_pool_max_jobs', 100,
+    'Restart each pooled capture process after it has taken this many '
+    'screenshots, to bound leaked memory in the browser.')
+
+gflags.DEFINE_string(
+    'capture_cache_dir', None,
+    'Directory for caching static resources like CSS, JS, fonts, and '
+    'images across captures of the same build. Only used for captures '
+    'whose config sets "resourceCache": true, and only with phantomjs. '
+    'When not set, captures never share a resource cache.')
+
+gflags.DEFINE_integer(
+    'capture_cache_build_mb', 100,
+    'Maximum size of the resource cache for each build, in megabytes.')
+
+gflags.DEFINE_integer(
+    'capture_cache_size_mb', 1000,
+    'Maximum total size of all build resource caches, in megabytes. The '
+    'least recently used builds are evicted first.')
+
+gflags.DEFINE_integer(
+    'capture_batch_size', 1,
+    'Lease up to this many capture tasks for the same build together and '
+    'screenshot them all with one capture process. Each of the '
+    '--capture_threads then runs a batch instead of a single task. Requires '
+    'a capture script that supports --manifest, like capture.js. Cannot be '
+    'used with --capture_pool_size.')
+
 
 class CaptureFailedError(queue_worker.GiveUpAfterAttemptsError):
     """Capturing a webpage screenshot failed for some reason."""
 
 
+def get_capture_timeout():
+    """Returns the number of seconds to wait for a single capture."""
+    if FLAGS.phantomjs_timeout is not None:
+        logging.info(
+            'Using FLAGS.phantomjs_timeout which is deprecated in favor'
+            'of FLAGS.capture_timeout - please update your config')
+        return FLAGS.phantomjs_timeout
+    return FLAGS.capture_timeout
+
+
+def get_phantomjs_flags(cache_flags=None):
+    """Returns the flags to pass to phantomjs.
+
+    Args:
+        cache_flags: Optional. Flags for the disk cache to use in place of
+            the default of no disk cache.
+    """
+    if not cache_flags:
+        return DEFAULT_PHANTOMJS_FLAGS
+    return [
+        flag for flag in DEFAULT_PHANTOMJS_FLAGS
+        if not flag.startswith('--disk-cache=')] + cache_flags
+
+
+def get_capture_args(script_args, cache_flags=None):
+    """Returns the command line for running the capture script.
+
+    Args:
+        script_args: List of arguments to pass to the capture script.
+        cache_flags: Optional. Flags for the disk cache phantomjs should use.
+    """
+    if FLAGS.phantomjs_binary:
+        logging.info(
+            'Using FLAGS.phantomjs_binary which is deprecated in favor'
+            'of FLAGS.capture_binary - please update your config')
+        return ([FLAGS.phantomjs_binary] + get_phantomjs_flags(cache_flags) +
+                [FLAGS.phantomjs_script] + script_args)
+
+    args = [FLAGS.capture_binary]
+    # Injects some default flags if we think this is phantomjs
+    if FLAGS.capture_binary.endswith('phantomjs'):
+        args += get_phantomjs_flags(cache_flags)
+    return args + [FLAGS.capture_script] + script_args
+
+
+def _get_dir_size(path):
+    """Returns the total size of all files under a directory, in bytes."""
+    total = 0
+    for dir_path, dir_names, file_names in os.walk(path):
+        for name in file_names:
+            try:
+                total += os.path.getsize(os.path.join(dir_path, name))
+            except OSError:
+                # File was evicted by the browser while walking.
+                pass
+    return total
+
+
+def prune_resource_caches(keep_path):
+    """Deletes the least recently used build caches over the size limit.
+
+    Args:
+        keep_path: Path of the build cache that is about to be used, which
+            is never deleted.
+    """
+    cache_paths = []
+    for name in os.listdir(FLAGS.capture_cache_dir):
+        path = os.path.join(FLAGS.capture_cache_dir, name)
+        if path != keep_path and os.path.isdir(path):
+            cache_paths.append((os.path.getmtime(path), path))
+    cache_paths.sort(reverse=True)
+
+    # Make room for the new cache to grow to its full size.
+    total = FLAGS.capture_cache_build_mb * 1024 * 1024
+    limit = FLAGS.capture_cache_size_mb * 1024 * 1024
+    for unused_mtime, path in cache_paths:
+        total += _get_dir_size(path)
+        if total > limit:
+            logging.info('Evicting resource cache %s', path)
+            shutil.rmtree(path, True)
+
+
+def get_cache_flags(build_id, config_path):
+    """Returns phantomjs flags for sharing a build's resource cache.
+
+    Captures of the same build share a disk cache that honors HTTP caching
+    headers, so static resources are only fetched from the site under test
+    once per build instead of once per screenshot.
+
+    Args:
+        build_id: ID of the build the capture is for.
+        config_path: Path to the capture config, which opts in to caching
+            by setting "resourceCache" to true.
+
+    Returns:
+        List of flags, empty if the capture should not use a cache.
+    """
+    if not FLAGS.capture_cache_dir:
+        return []
+
+    try:
+        with open(config_path) as config_file:
+            config = json.load(config_file)
+    except (IOError, ValueError):
+        # Let the capture script report the bad config.
+        return []
+
+    if not config.get('resourceCache'):
+        return []
+
+    cache_path = os.path.join(FLAGS.capture_cache_dir, 'build-%s' % build_id)
+    if not os.path.isdir(cache_path):
+        prune_resource_caches(cache_path)
+        try:
+            os.makedirs(cache_path)
+        except OSError:
+            # Another capture thread created it first.
+            pass
+
+    # Modified time is used for least recently used eviction.
+    os.utime(cache_path, None)
+
+    return [
+        '--disk-cache=true',
+        '--disk-cache-path=%s' % cache_path,
+        '--max-disk-cache-size=%d' % (FLAGS.capture_cache_build_mb * 1024),
+    ]
+
+
+def get_viewport_output_path(output_path, index):
+    """Returns where a capture script writes the screenshot for a viewport.
+
+    When the capture config has a list of viewports, the screenshot for
+    each is written next to the output path with the viewport's index
+    before the file extension, e.g. capture.png becomes capture.1.png.
+    """
+    root, ext = os.path.splitext(output_path)
+    return '%s.%d%s' % (root, index, ext)
+
+
 class CaptureWorkflow(process_worker.ProcessWorkflow):
     """Workflow for capturing a website screenshot using PhantomJs."""
 
-    def __init__(self, log_path, config_path, output_path):
+    def __init__(self, log_path, config_path, output_path, cache_flags=None):
         """Initializer.
 
         Args:
@@ -108,39 +294,278 @@ class CaptureWorkflow(process_worker.ProcessWorkflow):
             config_path: Path to the screenshot config file to pass
                 to PhantomJs.
             output_path: Where the output screenshot should be written.
+            cache_flags: Optional. Disk cache flags from get_cache_flags.
         """
-        if FLAGS.phantomjs_timeout is not None:
-            logging.info(
-                'Using FLAGS.phantomjs_timeout which is deprecated in favor'
-                'of FLAGS.capture_timeout - please update your config')
-            capture_timeout = FLAGS.phantomjs_timeout
-        else:
-            capture_timeout = FLAGS.capture_timeout
         process_worker.ProcessWorkflow.__init__(
-            self, log_path, timeout_seconds=capture_timeout)
+            self, log_path, timeout_seconds=get_capture_timeout())
         self.config_path = config_path
         self.output_path = output_path
+        self.cache_flags = cache_flags
 
     def get_args(self):
-        if FLAGS.phantomjs_binary:
-            logging.info(
-                'Using FLAGS.phantomjs_binary which is deprecated in favor'
-                'of FLAGS.capture_binary - please update your config')
-            return [FLAGS.phantomjs_binary] + DEFAULT_PHANTOMJS_FLAGS + [
-                FLAGS.phantomjs_script,
-                self.config_path,
-                self.output_path,
-            ]
+        return get_capture_args(
+            [self.config_path, self.output_path],
+            cache_flags=self.cache_flags)
+
+
+class CaptureBatchWorkflow(process_worker.ProcessWorkflow):
+    """Workflow for capturing many screenshots with one capture process."""
+
+    def __init__(self, log_path, manifest_path, count, cache_flags=None):
+        """Initializer.
+
+        Args:
+            log_path: Where to write the verbose logging output of all of the
+                captures, which is split up with split_batch_log.
+            manifest_path: Path to a JSON list of objects with the configPath
+                and outputPath for each capture.
+            count: Number of captures in the manifest.
+            cache_flags: Optional. Disk cache flags from get_cache_flags.
+        """
+        process_worker.ProcessWorkflow.__init__(
+            self, log_path, timeout_seconds=get_capture_timeout() * count)
+        self.manifest_path = manifest_path
+        self.cache_flags = cache_flags
+
+    def get_args(self):
+        return get_capture_args(
+            ['--manifest', self.manifest_path],
+            cache_flags=self.cache_flags)
+
+
+def split_batch_log(batch_log_path, log_paths):
+    """Splits the log of a capture batch into a log for each capture.
+
+    Args:
+        batch_log_path: Path to the output of CaptureBatchWorkflow.
+        log_paths: Where to write the log of each capture in the batch, in
+            the same order as the manifest.
+
+    Returns:
+        List of the returncode for each capture, or None for each capture
+        that didn't finish.
+    """
+    returncodes = [None] * len(log_paths)
+    index = 0
+    log_file = open(log_paths[index], 'a')
+    try:
+        with open(batch_log_path) as batch_log:
+            for line in batch_log:
+                if (line.startswith(CAPTURE_DONE_MARKER) and
+                        index < len(log_paths)):
+                    status = json.loads(line[len(CAPTURE_DONE_MARKER):])
+                    returncodes[index] = status['returncode']
+                    index += 1
+                    if index < len(log_paths):
+                        log_file.close()
+                        log_file = open(log_paths[index], 'a')
+                    continue
+
+                # Output after the last capture goes with the last capture.
+                log_file.write(line)
+    finally:
+        log_file.close()
+
+    return returncodes
+
+
+class CaptureItem(workers.WorkItem):
+    """Work item for taking a screenshot with a pooled capture process."""
+
+    def __init__(self, log_path, config_path, output_path, cache_flags=None):
+        """Initializer.
+
+        Args:
+            log_path: Where to write the verbose logging output.
+            config_path: Path to the screenshot config file.
+            output_path: Where the output screenshot should be written.
+            cache_flags: Optional. Disk cache flags from get_cache_flags.
+        """
+        workers.WorkItem.__init__(self)
+        self.log_path = log_path
+        self.config_path = config_path
+        self.output_path = output_path
+        self.cache_flags = cache_flags
+        # Response values
+        self.returncode = None
+
+
+class CaptureThread(workers.WorkerThread):
+    """Worker thread that takes screenshots with a long-running browser.
+
+    The capture script is started once with --server and then sent one job
+    per line on stdin, as JSON with the configPath and outputPath. It
+    echoes its logging to stdout and ends each job with a line that has
+    CAPTURE_DONE_MARKER followed by JSON with the job's returncode. This
+    saves starting a new browser for every screenshot.
+
+    The disk cache is set when the browser starts, so the browser is
+    restarted whenever a capture needs different cache flags.
+    """
+
+    def __init__(self, input_queue, output_queue):
+        workers.WorkerThread.__init__(self, input_queue, output_queue)
+        self.process = None
+        self.process_args = None
+        self.output_lines = None
+        self.jobs_done = 0
+
+    def run(self):
+        try:
+            workers.WorkerThread.run(self)
+        finally:
+            self.stop_process()
+
+    def start_process(self, args):
+        """Starts a new capture process with the given arguments."""
+        LOGGER.info('%s Starting capture process: %r', self.worker_name, args)
+        self.process = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            close_fds=sys.platform != 'win32')
+        self.process_args = args
+        self.output_lines = Queue.Queue()
+        self.jobs_done = 0
+
+        # Reading output lines is done on a separate thread so handling
+        # a capture can time out while the process is stuck.
+        def read(stdout, output_lines):
+            for line in iter(stdout.readline, ''):
+                output_lines.put(line)
+            output_lines.put(None)
+
+        thread = threading.Thread(
+            target=read,
+            args=(self.process.stdout, self.output_lines),
+            name='read-pid-%s' % self.process.pid)
+        thread.daemon = True
+        thread.start()
+
+    def stop_process(self):
+        """Kills the current capture process, if any."""
+        if not self.process:
+            return
+        LOGGER.info('%s Stopping capture process pid=%r',
+                    self.worker_name, self.process.pid)
+        try:
+            self.process.kill()
+        except OSError:
+            # The process already exited.
+            pass
+        self.process.wait()
+        self.process = None
+        self.output_lines = None
+
+    def handle_item(self, item):
+        args = get_capture_args(['--server'], cache_flags=item.cache_flags)
+        if self.process and self.process_args != args:
+            self.stop_process()
+        if not self.process:
+            self.start_process(args)
+
+        start_time = time.time()
+        timeout_seconds = get_capture_timeout()
+        job = dict(configPath=item.config_path, outputPath=item.output_path)
+
+        with open(item.log_path, 'a') as log_file:
+            try:
+                self.process.stdin.write(json.dumps(job) + '\n')
+                self.process.stdin.flush()
+            except IOError:
+                # The process exited since the last capture; the loop below
+                # will notice the end of its output.
+                pass
+
+            while True:
+                remaining = start_time + timeout_seconds - time.time()
+                try:
+                    line = self.output_lines.get(True, max(0, remaining))
+                except Queue.Empty:
+                    pid = self.process.pid
+                    self.stop_process()
+                    raise process_worker.TimeoutError(
+                        'Sent SIGKILL to item=%r, pid=%s, run_time=%s' %
+                        (item, pid, time.time() - start_time))
+
+                if line is None:
+                    returncode = self.process.wait()
+                    LOGGER.info('%s Capture process exited pid=%r, '
+                                'returncode=%r', self.worker_name,
+                                self.process.pid, returncode)
+                    self.process = None
+                    self.output_lines = None
+                    # Exiting in the middle of a capture is always a failure.
+                    item.returncode = returncode or 1
+                    return item
+
+                if line.startswith(CAPTURE_DONE_MARKER):
+                    status = json.loads(line[len(CAPTURE_DONE_MARKER):])
+                    item.returncode = status['returncode']
+                    break
+
+                log_file.write(line)
+
+        self.jobs_done += 1
+        if self.jobs_done >= FLAGS.capture_pool_max_jobs:
+            self.stop_process()
+
+        return item
+
+
+class ReportCaptureWorkflow(workers.WorkflowItem):
+    """Reports the screenshots and log from a capture to its runs.
+
+    Args:
+        build_id: ID of the build.
+        release_name: Name of the release.
+        release_number: Number of the release candidate.
+        run_name: Run the capture is for.
+        baseline: When True, the capture is for the reference baseline.
+        viewport_run_names: When the capture has many viewports, the names
+            of the runs each viewport's screenshot is for. May be None.
+        image_path: Where the capture process wrote the screenshot.
+        log_path: Path to the capture process's log.
+        failure_reason: None if the capture process succeeded, or a
+            description of why it failed.
+
+    Returns:
+        None if every screenshot was reported, or the reason the capture
+        failed.
+    """
+
+    def run(self, build_id, release_name, release_number, run_name,
+            baseline, viewport_run_names, image_path, log_path,
+            failure_reason):
+        capture_failed = failure_reason is not None
+
+        if viewport_run_names:
+            run_images = [
+                (name, get_viewport_output_path(image_path, i))
+                for i, name in enumerate(viewport_run_names)]
         else:
-            args = [FLAGS.capture_binary]
-            # Injects some default flags if we think this is phantomjs
-            if FLAGS.capture_binary.endswith('phantomjs'):
-                args += DEFAULT_PHANTOMJS_FLAGS
-            return args + [
-                FLAGS.capture_script,
-                self.config_path,
-                self.output_path,
-            ]
+            run_images = [(run_name, image_path)]
+
+        # Don't upload bad captures, but always upload the error log.
+        reports = []
+        for report_run_name, report_image_path in run_images:
+            run_failed = (
+                capture_failed or not os.path.exists(report_image_path))
+            if run_failed:
+                report_image_path = None
+                if not capture_failed:
+                    capture_failed = True
+                    failure_reason = 'missing screenshot for run=%r' % (
+                        report_run_name)
+
+            reports.append(release_worker.ReportRunWorkflow(
+                build_id, release_name, release_number, report_run_name,
+                image_path=report_image_path, log_path=log_path,
+                baseline=baseline, run_failed=run_failed))
+
+        yield reports
+        raise workers.Return(failure_reason)
 
 
 class DoCaptureQueueWorkflow(workers.WorkflowItem):
@@ -155,6 +580,9 @@ class DoCaptureQueueWorkflow(workers.WorkflowItem):
         config_sha1sum: Content hash of the config for the new screenshot.
         baseline: Optional. When specified and True, this capture is for
             the reference baseline of the specified run, not the new capture.
+        viewport_run_names: Optional. When the config has a list of
+            viewports, the names of the runs that each viewport's screenshot
+            should be reported to, in the same order.
         heartbeat: Function to call with progress status.
 
     Raises:
@@ -163,13 +591,12 @@ class DoCaptureQueueWorkflow(workers.WorkflowItem):
 
     def run(self, build_id=None, release_name=None, release_number=None,
             run_name=None, url=None, config_sha1sum=None, baseline=None,
-            heartbeat=None):
+            viewport_run_names=None, heartbeat=None):
         output_path = tempfile.mkdtemp()
         try:
             image_path = os.path.join(output_path, 'capture.%s' % FLAGS.capture_format)
             log_path = os.path.join(output_path, 'log.txt')
             config_path = os.path.join(output_path, 'config.json')
-            capture_failed = True
             failure_reason = None
 
             yield heartbeat('Fetching webpage capture config')
@@ -177,26 +604,29 @@ class DoCaptureQueueWorkflow(workers.WorkflowItem):
                 build_id, config_sha1sum, result_path=config_path)
 
             yield heartbeat('Running webpage capture process')
+            cache_flags = get_cache_flags(build_id, config_path)
             try:
-                returncode = yield CaptureWorkflow(
-                    log_path, config_path, image_path)
+                if FLAGS.capture_pool_size > 0:
+                    item = yield CaptureItem(
+                        log_path, config_path, image_path,
+                        cache_flags=cache_flags)
+                    returncode = item.returncode
+                else:
+                    returncode = yield CaptureWorkflow(
+                        log_path, config_path, image_path,
+                        cache_flags=cache_flags)
             except (process_worker.TimeoutError, OSError), e:
                 failure_reason = str(e)
             else:
-                capture_failed = returncode != 0
-                failure_reason = 'returncode=%s' % returncode
-
-            # Don't upload bad captures, but always upload the error log.
-            if capture_failed:
-                image_path = None
+                if returncode != 0:
+                    failure_reason = 'returncode=%s' % returncode
 
             yield heartbeat('Reporting capture status to server')
-            yield release_worker.ReportRunWorkflow(
-                build_id, release_name, release_number, run_name,
-                image_path=image_path, log_path=log_path, baseline=baseline,
-                run_failed=capture_failed)
+            failure_reason = yield ReportCaptureWorkflow(
+                build_id, release_name, release_number, run_name, baseline,
+                viewport_run_names, image_path, log_path, failure_reason)
 
-            if capture_failed:
+            if failure_reason:
                 raise CaptureFailedError(
                     FLAGS.capture_task_max_attempts,
                     failure_reason)
@@ -204,6 +634,138 @@ class DoCaptureQueueWorkflow(workers.WorkflowItem):
             shutil.rmtree(output_path, True)
 
 
+class CaptureManifestWorkflow(workers.WorkflowItem):
+    """Runs one capture process for many captures and splits up the results.
+
+    Args:
+        output_path: Directory to write the manifest and batch log to.
+        jobs: List of dictionaries with the config_path, image_path, and
+            log_path of each capture. The failure_reason of each is set to
+            None if the capture succeeded, or why it failed.
+        cache_flags: Disk cache flags from get_cache_flags.
+    """
+
+    def run(self, output_path, jobs, cache_flags):
+        os.mkdir(output_path)
+        manifest_path = os.path.join(output_path, 'manifest.json')
+        batch_log_path = os.path.join(output_path, 'log.txt')
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump(
+                [dict(configPath=job['config_path'],
+                      outputPath=job['image_path'])
+                 for job in jobs],
+                manifest_file)
+
+        batch_failure_reason = None
+        try:
+            returncode = yield CaptureBatchWorkflow(
+                batch_log_path, manifest_path, len(jobs),
+                cache_flags=cache_flags)
+        except (process_worker.TimeoutError, OSError), e:
+            batch_failure_reason = str(e)
+        else:
+            if returncode != 0:
+                batch_failure_reason = 'returncode=%s' % returncode
+
+        returncodes = [None] * len(jobs)
+        if os.path.exists(batch_log_path):
+            returncodes = split_batch_log(
+                batch_log_path, [job['log_path'] for job in jobs])
+
+        for job, job_returncode in zip(jobs, returncodes):
+            if job_returncode is None:
+                job['failure_reason'] = (
+                    batch_failure_reason or 'capture did not finish')
+            elif job_returncode != 0:
+                job['failure_reason'] = 'returncode=%s' % job_returncode
+            else:
+                job['failure_reason'] = None
+
+
+class DoCaptureBatchQueueWorkflow(workers.WorkflowItem):
+    """Runs webpage screenshots for a batch of queue tasks in one process.
+
+    Args:
+        payloads: List of dictionaries with the same parameters that
+            DoCaptureQueueWorkflow takes, one for each task.
+
+    Returns:
+        List with a CaptureFailedError for each capture that failed, or
+        None for each capture that succeeded.
+    """
+
+    def run(self, payloads):
+        output_path = tempfile.mkdtemp()
+        try:
+            jobs = []
+            for index, payload in enumerate(payloads):
+                job_path = os.path.join(output_path, str(index))
+                os.mkdir(job_path)
+                jobs.append(dict(
+                    payload=payload,
+                    image_path=os.path.join(
+                        job_path, 'capture.%s' % FLAGS.capture_format),
+                    log_path=os.path.join(job_path, 'log.txt'),
+                    config_path=os.path.join(job_path, 'config.json')))
+
+            yield [p['heartbeat']('Fetching webpage capture config')
+                   for p in payloads]
+            yield [
+                release_worker.DownloadArtifactWorkflow(
+                    job['payload']['build_id'],
+                    job['payload']['config_sha1sum'],
+                    result_path=job['config_path'])
+                for job in jobs]
+
+            # Captures that need different disk caches can't share a process.
+            jobs_by_cache = {}
+            for job in jobs:
+                cache_flags = get_cache_flags(
+                    job['payload']['build_id'], job['config_path'])
+                jobs_by_cache.setdefault(tuple(cache_flags), []).append(job)
+
+            yield [p['heartbeat']('Running webpage capture process for '
+                                  'batch of %d' % len(payloads))
+                   for p in payloads]
+            yield [
+                CaptureManifestWorkflow(
+                    os.path.join(output_path, 'batch-%d' % index),
+                    cache_jobs, list(cache_flags))
+                for index, (cache_flags, cache_jobs)
+                in enumerate(jobs_by_cache.iteritems())]
+
+            yield [p['heartbeat']('Reporting capture status to server')
+                   for p in payloads]
+            failure_reasons = yield [
+                ReportCaptureWorkflow(
+                    job['payload']['build_id'],
+                    job['payload']['release_name'],
+                    job['payload']['release_number'],
+                    job['payload']['run_name'],
+                    job['payload'].get('baseline'),
+                    job['payload'].get('viewport_run_names'),
+                    job['image_path'],
+                    job['log_path'],
+                    job['failure_reason'])
+                for job in jobs]
+
+            results = []
+            for failure_reason in failure_reasons:
+                if failure_reason:
+                    results.append(CaptureFailedError(
+                        FLAGS.capture_task_max_attempts, failure_reason))
+                else:
+                    results.append(None)
+            raise workers.Return(results)
+        finally:
+            shutil.rmtree(output_path, True)
+
+
+def _get_batch_key(payload):
+    """Returns the key for capture tasks that can run in the same batch."""
+    return payload['build_id']
+
+
 def register(coordinator):
     """Registers this module as a worker with the given coordinator."""
 
@@ -218,10 +780,35 @@ def register(coordinator):
     assert FLAGS.capture_threads > 0
     assert FLAGS.queue_server_prefix
 
+    if FLAGS.capture_cache_dir and not os.path.isdir(FLAGS.capture_cache_dir):
+        os.makedirs(FLAGS.capture_cache_dir)
+
+    assert FLAGS.capture_batch_size > 0
+    assert FLAGS.capture_pool_size == 0 or FLAGS.capture_batch_size == 1, (
+        '--capture_batch_size cannot be used with --capture_pool_size')
+
+    if FLAGS.capture_pool_size > 0:
+        assert FLAGS.capture_pool_max_jobs > 0
+        capture_queue = Queue.Queue()
+        coordinator.register(CaptureItem, capture_queue)
+        for i in xrange(FLAGS.capture_pool_size):
+            coordinator.worker_threads.append(
+                CaptureThread(capture_queue, coordinator.input_queue))
+
+    # Heartbeats for a batch are sent right before and after its capture
+    # process, which may run for the capture timeout of every task in it.
+    batch_lease_seconds = (
+        get_capture_timeout() * FLAGS.capture_batch_size +
+        queue_worker.BATCH_TASK_LEASE_SECONDS)
+
     item = queue_worker.RemoteQueueWorkflow(
         constants.CAPTURE_QUEUE_NAME,
         DoCaptureQueueWorkflow,
         max_tasks=FLAGS.capture_threads,
-        wait_seconds=FLAGS.capture_wait_seconds)
+        wait_seconds=FLAGS.capture_wait_seconds,
+        local_batch_workflow=DoCaptureBatchQueueWorkflow,
+        batch_size=FLAGS.capture_batch_size,
+        batch_key=_get_batch_key,
+        batch_lease_seconds=batch_lease_seconds)
     item.root = True
     coordinator.input_queue.put(item)
@@ -17,14 +17,18 @@
 
 import Queue
 import base64
+import httplib
 import json
 import logging
+import select
 import shutil
 import socket
 import ssl
+import threading
 import time
 import urllib
 import urllib2
+import urlparse
 
 # Local Libraries
 import gflags
@@ -34,6 +38,7 @@ import poster.streaminghttp
 poster.streaminghttp.register_openers()
 
 # Local modules
+from dpxdt.client import timer_worker
 from dpxdt.client import workers
 
 
@@ -42,11 +47,31 @@ LOGGER = workers.LOGGER
 
 gflags.DEFINE_float(
     'fetch_frequency', 1.0,
-    'Maximum number of fetches to make per second per thread.')
+    'Maximum number of fetches to make per second to each host, unless '
+    'overridden by --fetch_rate_limit. Set to 0 for no limit.')
+
+gflags.DEFINE_integer(
+    'fetch_burst', 1,
+    'Number of fetches that may be made to a host back-to-back before '
+    '--fetch_frequency applies.')
+
+gflags.DEFINE_multistring(
+    'fetch_rate_limit', [],
+    'Rate limit for all URLs that start with a prefix, in the form '
+    'PREFIX=FETCHES_PER_SECOND or PREFIX=FETCHES_PER_SECOND/BURST. All URLs '
+    'with the prefix share one limit and the longest matching prefix wins. '
+    'Use 0 for no limit. Fetches to --release_server_prefix and '
+    '--queue_server_prefix are never limited. May be repeated.')
 
 gflags.DEFINE_integer(
     'fetch_threads', 1, 'Number of fetch threads to run')
 
+gflags.DEFINE_integer(
+    'fetch_long_poll_threads', 4,
+    'Number of threads to run for fetches that the server may hold open '
+    'for a long time, like waiting for work queue tasks. These are kept '
+    'apart so they never hold up other fetches.')
+
 gflags.DEFINE_bool(
     'fetch_use_internal_redirects', False,
     'When doing URL fetches, always direct the request to the local server. '
@@ -55,6 +80,50 @@ gflags.DEFINE_bool(
     'process in a firewall configuration where sockets can come in but they '
     'can\'t go out.')
 
+gflags.DEFINE_integer(
+    'fetch_pool_size', 4,
+    'Maximum number of idle persistent HTTP connections to keep open to '
+    'each host, shared by all fetch threads. Set to 0 to open a new '
+    'connection for every fetch.')
+
+gflags.DEFINE_float(
+    'fetch_pool_idle_seconds', 30,
+    'Seconds a persistent HTTP connection may sit idle in the pool before '
+    'it is closed instead of reused.')
+
+gflags.DEFINE_integer(
+    'fetch_pool_stale_retries', 1,
+    'Number of times to retry a fetch on a new connection when a pooled '
+    'connection turns out to have been closed by the server.')
+
+gflags.DEFINE_enum(
+    'fetch_engine', 'threads', ['threads', 'async'],
+    'How to run URL fetches. "threads" runs --fetch_threads threads that '
+    'each do one blocking fetch at a time. "async" runs a single thread '
+    'with an event loop that drives many fetches concurrently.')
+
+gflags.DEFINE_integer(
+    'fetch_async_max_connections', 500,
+    'Maximum number of fetches the async engine will have in flight at '
+    'once. Further fetches wait for a free connection.')
+
+gflags.DEFINE_integer(
+    'fetch_async_max_per_host', 8,
+    'Maximum number of fetches the async engine will have in flight to a '
+    'single host at once.')
+
+# Same limit that urllib2.HTTPRedirectHandler uses.
+MAX_REDIRECTS = 10
+
+# Methods that are safe to send again if a pooled connection drops before
+# the response arrives.
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+# Status code of a fetch that failed without getting an HTTP response, such
+# as when the connection was refused, dropped, or timed out. The item's
+# connection_error attribute says what went wrong.
+CONNECTION_ERROR_STATUS = 400
+
 
 class FetchItem(workers.WorkItem):
     """Work item that is handled by fetching a URL."""
@@ -95,6 +164,10 @@ class FetchItem(workers.WorkItem):
         self.data = None
         self._data_json = None
         self.content_type = None
+        # Description of the error when the fetch got no HTTP response.
+        self.connection_error = None
+        # Set when the fetch already has its rate limit slot booked.
+        self.rate_limit_reserved = False
 
     def _get_dict_for_repr(self):
         result = self.__dict__.copy()
@@ -115,6 +188,19 @@ class FetchItem(workers.WorkItem):
         return self._data_json
 
 
+def set_connection_error(item, e):
+    """Marks a FetchItem as failed without an HTTP response."""
+    item.status_code = CONNECTION_ERROR_STATUS
+    item.connection_error = '%s: %s' % (e.__class__.__name__, e)
+
+
+class LongPollFetchItem(FetchItem):
+    """FetchItem that the server may hold open waiting for something.
+
+    These are never rate limited and run on their own threads.
+    """
+
+
 def fetch_internal(item, request):
     """Fetches the given request by using the local Flask context."""
     # Break client dependence on Flask if internal fetches aren't being used.
@@ -160,15 +246,240 @@ def fetch_internal(item, request):
     return item
 
 
-def fetch_normal(item, request):
-    """Fetches the given request over HTTP."""
+class ConnectionPool(object):
+    """Pool of persistent HTTP/1.1 connections shared by all fetch threads.
+
+    Idle connections are kept per scheme and host. The most recently used
+    connection is handed out first so the rest can age out of the pool.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def get(self, scheme, host, timeout):
+        """Returns a tuple (connection, reused) for the given host."""
+        key = (scheme, host)
+        now = time.time()
+        expired = []
+        conn = None
+        with self.lock:
+            idle_list = self.idle.get(key, [])
+            while idle_list:
+                last_used, pooled_conn = idle_list.pop()
+                if (now - last_used > FLAGS.fetch_pool_idle_seconds or
+                        _is_connection_dropped(pooled_conn)):
+                    expired.append(pooled_conn)
+                else:
+                    conn = pooled_conn
+                    break
+
+        for expired_conn in expired:
+            expired_conn.close()
+
+        if conn is not None:
+            conn.timeout = timeout
+            if conn.sock:
+                conn.sock.settimeout(timeout)
+            return conn, True
+
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, timeout=timeout)
+        else:
+            conn = httplib.HTTPConnection(host, timeout=timeout)
+        return conn, False
+
+    def put(self, scheme, host, conn):
+        """Returns a connection with no outstanding response to the pool."""
+        key = (scheme, host)
+        with self.lock:
+            idle_list = self.idle.setdefault(key, [])
+            if len(idle_list) < FLAGS.fetch_pool_size:
+                idle_list.append((time.time(), conn))
+                return
+        conn.close()
+
+    def close_all(self):
+        """Closes all idle connections."""
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for idle_list in idle.itervalues():
+            for _, conn in idle_list:
+                conn.close()
+
+
+POOL = ConnectionPool()
+
+
+def _is_connection_dropped(conn):
+    """Returns True if the server closed an idle connection.
+
+    An idle connection has nothing to read until a request is sent, so
+    being readable means the server hung up or sent something unexpected.
+    """
+    if not conn.sock:
+        return False
+    try:
+        if hasattr(select, 'poll'):
+            # Unlike select, poll works for any file descriptor number.
+            poller = select.poll()
+            poller.register(conn.sock, select.POLLIN)
+            return bool(poller.poll(0))
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (ValueError, select.error, socket.error):
+        return True
+    return bool(readable)
+
+
+def is_direct(request):
+    """Returns True if the request can be sent straight to its host."""
+    scheme = request.get_type()
+    if scheme not in ('http', 'https'):
+        return False
+    # Let urllib2 deal with any configured proxies.
+    if scheme in urllib.getproxies():
+        return not urllib.proxy_bypass(request.get_host())
+    return True
+
+
+def _use_pool(request):
+    """Returns True if the request should use a pooled connection."""
+    return FLAGS.fetch_pool_size > 0 and is_direct(request)
+
+
+def _send_request(conn, request):
+    """Sends a urllib2.Request over the given HTTP connection."""
+    conn.putrequest(request.get_method(), request.get_selector(),
+                    skip_accept_encoding=True)
+    for key, value in request.header_items():
+        conn.putheader(key, value)
+    conn.endheaders()
+
+    data = request.get_data()
+    if data is None:
+        return
+    if isinstance(data, str):
+        conn.send(data)
+    else:
+        # Generator from poster.multipart_encode.
+        for chunk in data:
+            conn.send(chunk)
+
+
+def _open_pooled(request, timeout):
+    """Sends a request on a pooled connection and waits for the response.
+
+    Returns:
+        Tuple (connection, response).
+
+    Raises:
+        socket.error or httplib.HTTPException if the request failed.
+    """
+    scheme, host = request.get_type(), request.get_host()
+    retries = FLAGS.fetch_pool_stale_retries
+    while True:
+        conn, reused = POOL.get(scheme, host, timeout)
+        sent = False
+        try:
+            _send_request(conn, request)
+            sent = True
+            return conn, conn.getresponse()
+        except (socket.error, httplib.HTTPException), e:
+            conn.close()
+            if (not reused or retries <= 0 or
+                    isinstance(e, socket.timeout)):
+                raise
+            # The server may have acted on a request that was sent in full
+            # even though no response came back, so only send it again if
+            # doing so is harmless.
+            if sent and request.get_method() not in IDEMPOTENT_METHODS:
+                raise
+            retries -= 1
+            LOGGER.debug('Retrying fetch of %r on a new connection. %s: %s',
+                         request.get_full_url(), e.__class__.__name__, e)
+            data = request.get_data()
+            if hasattr(data, 'reset'):
+                data.reset()
+
+
+def get_redirect(request, response):
+    """Returns a urllib2.Request to follow a redirect or None.
+
+    Follows the same rules as urllib2.HTTPRedirectHandler.
+    """
+    location = response.getheader('location')
+    if not location:
+        return None
+
+    method = request.get_method()
+    status = response.status
+    if not ((status in (301, 302, 303, 307) and method in ('GET', 'HEAD')) or
+            (status in (301, 302, 303) and method == 'POST')):
+        return None
+
+    url = urlparse.urljoin(request.get_full_url(), location)
+    if urlparse.urlparse(url).scheme not in ('http', 'https'):
+        return None
+
+    headers = dict(
+        (key, value) for key, value in request.header_items()
+        if key.lower() not in ('content-length', 'content-type'))
+    return urllib2.Request(url, headers=headers)
+
+
+def _fetch_pooled(item, request):
+    """Fetches the given request over a persistent HTTP connection."""
+    try:
+        for redirects in xrange(MAX_REDIRECTS + 1):
+            conn, response = _open_pooled(request, item.timeout_seconds)
+            next_request = get_redirect(request, response)
+            if not next_request:
+                break
+            if redirects == MAX_REDIRECTS:
+                # Like urllib2, give up and return the last redirect.
+                LOGGER.warning('Too many redirects fetching %r', item.url)
+                break
+            response.read()
+            if response.will_close:
+                conn.close()
+            else:
+                POOL.put(request.get_type(), request.get_host(), conn)
+            request = next_request
+    except (socket.error, httplib.HTTPException), e:
+        set_connection_error(item, e)
+        return item
+
+    reusable = False
+    try:
+        item.status_code = response.status
+        item.content_type = response.msg.gettype()
+        if item.result_path:
+            with open(item.result_path, 'wb') as result_file:
+                shutil.copyfileobj(response, result_file)
+        else:
+            item.data = response.read()
+        reusable = not response.will_close
+    except (socket.error, httplib.HTTPException), e:
+        set_connection_error(item, e)
+        return item
+    finally:
+        if reusable:
+            POOL.put(request.get_type(), request.get_host(), conn)
+        else:
+            conn.close()
+
+    return item
+
+
+def _fetch_urllib2(item, request):
+    """Fetches the given request with a new connection from urllib2."""
     try:
         conn = urllib2.urlopen(request, timeout=item.timeout_seconds)
     except urllib2.HTTPError, e:
         conn = e
     except (urllib2.URLError, ssl.SSLError), e:
-        # TODO: Make this status more clear
-        item.status_code = 400
+        set_connection_error(item, e)
         return item
 
     try:
@@ -180,8 +491,7 @@ def fetch_normal(item, request):
         else:
             item.data = conn.read()
     except socket.timeout, e:
-        # TODO: Make this status more clear
-        item.status_code = 400
+        set_connection_error(item, e)
         return item
     finally:
         conn.close()
@@ -189,67 +499,230 @@ def fetch_normal(item, request):
     return item
 
 
+def fetch_normal(item, request):
+    """Fetches the given request over HTTP."""
+    if _use_pool(request):
+        return _fetch_pooled(item, request)
+    else:
+        return _fetch_urllib2(item, request)
+
+
+def build_request(item):
+    """Returns a urllib2.Request for a FetchItem."""
+    if item.post is not None:
+        adjusted_data = {}
+        use_form_data = False
+
+        for key, value in item.post.iteritems():
+            if value is None:
+                continue
+            if isinstance(value, file):
+                use_form_data = True
+            adjusted_data[key] = value
+
+        if use_form_data:
+            datagen, headers = poster.encode.multipart_encode(
+                adjusted_data)
+            request = urllib2.Request(item.url, datagen, headers)
+        else:
+            post_data = urllib.urlencode(adjusted_data)
+            headers = {
+                'Content-Type': 'application/x-www-form-urlencoded',
+                'Content-Length': len(post_data),
+            }
+            request = urllib2.Request(item.url, post_data, headers)
+    else:
+        request = urllib2.Request(item.url)
+
+    if item.username:
+        credentials = base64.b64encode(
+            '%s:%s' % (item.username, item.password))
+        request.add_header('Authorization', 'Basic %s' % credentials)
+
+    return request
+
+
+def is_forbidden(item):
+    """Returns True and sets a 403 status if the item can't be fetched."""
+    # For security reasons, don't allow any fetches of file URLs.
+    if item.url.startswith('file:'):
+        item.status_code = 403
+        LOGGER.debug('Blocking fetch of URL with file scheme: %r', item.url)
+        return True
+    return False
+
+
+def fetch(item):
+    """Fetches a FetchItem in the current thread and returns it."""
+    if is_forbidden(item):
+        return item
+
+    request = build_request(item)
+    if FLAGS.fetch_use_internal_redirects:
+        return fetch_internal(item, request)
+    else:
+        return fetch_normal(item, request)
+
+
+def parse_rate_limit(spec):
+    """Parses a --fetch_rate_limit value.
+
+    Returns:
+        Tuple (prefix, rate, burst).
+
+    Raises:
+        ValueError if the value is not formatted correctly.
+    """
+    prefix, _, limit = spec.rpartition('=')
+    rate, _, burst = limit.partition('/')
+    if not prefix:
+        raise ValueError('Bad --fetch_rate_limit: %r' % spec)
+    try:
+        return prefix, float(rate), int(burst or 1)
+    except ValueError:
+        raise ValueError('Bad --fetch_rate_limit: %r' % spec)
+
+
+def _get_api_prefixes():
+    """Returns URL prefixes of the API servers this process talks to."""
+    prefixes = []
+    for name in ('release_server_prefix', 'queue_server_prefix'):
+        # These flags are only defined when their modules are imported.
+        prefix = getattr(FLAGS, name, None)
+        if prefix:
+            prefixes.append(prefix)
+    return prefixes
+
+
+class RateLimiter(object):
+    """Token buckets that limit how often URLs may be fetched.
+
+    Each host gets its own bucket unless a --fetch_rate_limit prefix
+    matches the URL, in which case all URLs with that prefix share one.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Maps bucket key to tuple (tokens, last_update_time).
+        self.buckets = {}
+
+    def get_limit(self, url):
+        """Returns a tuple (bucket_key, rate, burst) for a URL."""
+        for prefix in _get_api_prefixes():
+            if url.startswith(prefix):
+                return prefix, 0, 0
+
+        best = None
+        for spec in FLAGS.fetch_rate_limit:
+            limit = parse_rate_limit(spec)
+            if url.startswith(limit[0]) and (
+                    best is None or len(limit[0]) > len(best[0])):
+                best = limit
+        if best:
+            return best
+
+        parts = urlparse.urlsplit(url)
+        return ('%s://%s' % (parts.scheme, parts.netloc),
+                FLAGS.fetch_frequency, FLAGS.fetch_burst)
+
+    def reserve(self, url, now=None):
+        """Books the next slot for fetching a URL.
+
+        A token is taken even when none are left, so the bucket goes into
+        debt. Fetches that have to wait get their slots in the order they
+        asked for them and only need to wake up once.
+
+        Returns:
+            Zero if the URL may be fetched now. Otherwise the number of
+            seconds until its slot, after which it may be fetched without
+            calling reserve() again.
+        """
+        key, rate, burst = self.get_limit(url)
+        if rate <= 0:
+            return 0
+
+        if now is None:
+            now = time.time()
+        burst = max(1, burst)
+        with self.lock:
+            tokens, last_update = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - last_update) * rate) - 1
+            self.buckets[key] = (tokens, now)
+        if tokens >= 0:
+            return 0
+        return -tokens / float(rate)
+
+
+LIMITER = RateLimiter()
+
+
+class DeferredFetchItem(timer_worker.TimerItem):
+    """Timer for a FetchItem that is waiting on its rate limit."""
+
+    def __init__(self, delay_seconds, fetch_item):
+        timer_worker.TimerItem.__init__(self, delay_seconds)
+        self.fetch_item = fetch_item
+
+    def fire(self, output_queue):
+        self.fetch_item.rate_limit_reserved = True
+        output_queue.put(self.fetch_item)
+
+
 class FetchThread(workers.WorkerThread):
     """Worker thread for fetching URLs."""
 
-    def handle_item(self, item):
-        start_time = time.time()
-
-        # For security reasons, don't allow any fetches of file URLs.
-        if item.url.startswith('file:'):
-            item.status_code = 403
-            LOGGER.debug('Blocking fetch of URL with file scheme: %r', item.url)
-            return item
-
-        if item.post is not None:
-            adjusted_data = {}
-            use_form_data = False
-
-            for key, value in item.post.iteritems():
-                if value is None:
-                    continue
-                if isinstance(value, file):
-                    use_form_data = True
-                adjusted_data[key] = value
-
-            if use_form_data:
-                datagen, headers = poster.encode.multipart_encode(
-                    adjusted_data)
-                request = urllib2.Request(item.url, datagen, headers)
-            else:
-                post_data = urllib.urlencode(adjusted_data)
-                headers = {
-                    'Content-Type': 'application/x-www-form-urlencoded',
-                    'Content-Length': len(post_data),
-                }
-                request = urllib2.Request(item.url, post_data, headers)
-        else:
-            request = urllib2.Request(item.url)
+    def __init__(self, input_queue, output_queue, defer_queue=None):
+        """Initializer.
 
-        if item.username:
-            credentials = base64.b64encode(
-                '%s:%s' % (item.username, item.password))
-            request.add_header('Authorization', 'Basic %s' % credentials)
+        Args:
+            input_queue: Queue of FetchItems to fetch.
+            output_queue: Queue where finished FetchItems are put.
+            defer_queue: Optional. Queue of a TimerThread that puts
+                DeferredFetchItems back on the input_queue. When supplied,
+                fetches are rate limited by LIMITER.
+        """
+        workers.WorkerThread.__init__(self, input_queue, output_queue)
+        self.defer_queue = defer_queue
 
-        try:
-            if FLAGS.fetch_use_internal_redirects:
-                return fetch_internal(item, request)
-            else:
-                return fetch_normal(item, request)
-        finally:
-            end_time = time.time()
-            wait_duration = (1.0 / FLAGS.fetch_frequency) - (
-                end_time - start_time)
+    def handle_item(self, item):
+        if self.defer_queue is not None and not item.rate_limit_reserved:
+            wait_duration = LIMITER.reserve(item.url)
             if wait_duration > 0:
                 LOGGER.debug('Rate limiting URL fetch for %f seconds',
                              wait_duration)
-                time.sleep(wait_duration)
+                self.defer_queue.put(DeferredFetchItem(wait_duration, item))
+                return workers.DEFERRED
+
+        item.rate_limit_reserved = False
+        return fetch(item)
 
 
 def register(coordinator):
     """Registers this module as a worker with the given coordinator."""
+    long_poll_queue = Queue.Queue()
+    coordinator.register(LongPollFetchItem, long_poll_queue)
+    for i in xrange(FLAGS.fetch_long_poll_threads):
+        coordinator.worker_threads.append(
+            FetchThread(long_poll_queue, coordinator.input_queue))
+
+    if FLAGS.fetch_engine == 'async':
+        # Break circular dependencies.
+        from dpxdt.client import async_fetch_worker
+        async_fetch_worker.register(coordinator)
+        return
+
+    for spec in FLAGS.fetch_rate_limit:
+        parse_rate_limit(spec)
+
     fetch_queue = Queue.Queue()
     coordinator.register(FetchItem, fetch_queue)
+
+    # Fetches over their rate limit wait in a timer thread of their own
+    # that puts them back on the fetch queue when they're ready.
+    defer_queue = Queue.Queue()
+    coordinator.worker_threads.append(
+        timer_worker.TimerThread(defer_queue, fetch_queue))
+
     for i in xrange(FLAGS.fetch_threads):
         coordinator.worker_threads.append(
-            FetchThread(fetch_queue, coordinator.input_queue))
+            FetchThread(fetch_queue, coordinator.input_queue, defer_queue))
@@ -0,0 +1,689 @@
+#!/usr/bin/env python
+# Copyright 2013 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process perceptual diffs of screenshots using NumPy.
+
+Computes the same root mean squared error (RMSE) distortion that the
+ImageMagick command 'compare -metric RMSE' reports, along with the same
+style of highlight image, without forking any subprocesses.
+
+Images are read, compared, and highlighted one band of rows at a time, so
+memory use depends on the width of the screenshots and not their height.
+8-bit PNGs, which is what the capture worker writes, are decoded one band
+at a time too; other images are decoded in full first. For very tall
+screenshots, diffing by tiles skips unchanged areas cheaply and reports the
+changed regions.
+
+NumPy and PIL are imported lazily so workers that only use the ImageMagick
+binaries do not need them installed.
+"""
+
+import StringIO
+import os
+import struct
+import zlib
+
+# Rows of pixels to compare at a time. Bounds the size of the temporary
+# arrays for very tall screenshots.
+BAND_ROWS = 256
+
+# Default width and height of the tiles compared by diff_tiles.
+TILE_SIZE = 256
+
+# Matches the output of 'compare -highlight-color Red -compose Src'.
+HIGHLIGHT_COLOR = (255, 0, 0, 255)
+LOWLIGHT_COLOR = (255, 255, 255, 204)
+
+# ImageMagick reports absolute distortion scaled to its quantum depth.
+QUANTUM_RANGE = 65535
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+# Bytes per pixel of the 8-bit PNG color types that PngBands can read.
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+# Most compressed PNG data to read from a file at once.
+PNG_READ_BYTES = 64 * 1024
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+
+class DecodeError(Error):
+    """An image could not be decoded."""
+
+
+class DiffResult(object):
+    """Result of diffing two images.
+
+    Attributes:
+        distortion: Normalized RMSE between the two images, from 0 to 1.
+        pixels_changed: Number of pixels that differ between the images.
+        width: Width of the compared area, which is the new image's width.
+        height: Height of the compared area, which is the new image's height.
+        ref_size: Tuple (width, height) of the reference image before it was
+            padded or cropped.
+        regions: List of changed regions when diffing by tiles, otherwise
+            None. See diff_tiles.
+    """
+
+    def __init__(self, distortion, pixels_changed, width, height, ref_size,
+                 regions=None):
+        self.distortion = distortion
+        self.pixels_changed = pixels_changed
+        self.width = width
+        self.height = height
+        self.ref_size = ref_size
+        self.regions = regions
+
+    def __repr__(self):
+        return 'DiffResult(%r)' % self.__dict__
+
+
+def is_available():
+    """Returns True if NumPy and PIL can be imported."""
+    try:
+        import numpy
+        import PIL.Image
+    except ImportError:
+        return False
+    return True
+
+
+def _png_chunk(chunk_type, data):
+    """Returns a PNG chunk with the given type and data."""
+    crc = zlib.crc32(chunk_type + data) & 0xffffffff
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack(
+        '>I', crc)
+
+
+class ImageBands(object):
+    """Reads a decoded image from the top down, one band of rows at a time.
+
+    Attributes:
+        size: Tuple (width, height) of the image.
+        has_alpha: True if the image has an alpha channel.
+    """
+
+    def __init__(self, image, has_alpha):
+        self.image = image
+        self.size = image.size
+        self.has_alpha = has_alpha
+        self.top = 0
+
+    def _read_rows(self, count):
+        """Returns the next count rows of the image as a PIL Image."""
+        return self.image.crop((0, self.top, self.size[0], self.top + count))
+
+    def read_band(self, rows, width):
+        """Returns the next band of rows of the image as an RGBA array.
+
+        The band is padded or cropped from the top-left to the given rows and
+        width using fully transparent pixels, like compositing the image onto
+        a canvas with 'composite -compose src -gravity NorthWest' does. Rows
+        past the bottom of the image are all padding.
+
+        Returns:
+            uint8 array with shape (rows, width, 4).
+
+        Raises:
+            DecodeError if the rows could not be decoded.
+        """
+        import numpy
+
+        image_width, image_height = self.size
+        count = max(0, min(rows, image_height - self.top))
+        pixels = None
+        if count:
+            band = self._read_rows(count)
+            self.top += count
+            if band.mode != 'RGBA':
+                band = band.convert('RGBA')
+            pixels = numpy.asarray(band)
+            if count == rows and image_width == width:
+                return pixels
+
+        result = numpy.zeros((rows, width, 4), dtype=numpy.uint8)
+        if pixels is not None:
+            copy_width = min(width, image_width)
+            result[:count, :copy_width] = pixels[:, :copy_width]
+        return result
+
+    def close(self):
+        """Releases the image."""
+        self.image = None
+
+
+class PngBands(ImageBands):
+    """Reads an 8-bit PNG file one band of rows at a time.
+
+    Only the compressed image data for the band being read is inflated. It
+    is decoded by PIL as a PNG of its own, which starts with the last row of
+    the band before so the PNG row filters can refer back to it.
+    """
+
+    def __init__(self, png_file, width, height, color_type, chunks,
+                 idat_length):
+        """Initializer.
+
+        Args:
+            png_file: PNG file positioned at the start of the first IDAT
+                chunk's data.
+            width, height, color_type: From the PNG's IHDR chunk.
+            chunks: List of tuples (chunk_type, data) for the PLTE and tRNS
+                chunks that each band needs to be decoded.
+            idat_length: Length of the first IDAT chunk.
+        """
+        self.png_file = png_file
+        self.size = (width, height)
+        self.color_type = color_type
+        self.chunks = chunks
+        self.has_alpha = (
+            color_type in (4, 6) or
+            any(chunk_type == 'tRNS' for chunk_type, _ in chunks))
+        self.top = 0
+        self.idat_remaining = idat_length
+        self.idat_done = False
+        self.inflater = zlib.decompressobj()
+        row_bytes = width * PNG_CHANNELS[color_type]
+        self.stride = row_bytes + 1
+        self.previous = '\0' * row_bytes
+
+    def _read_idat(self):
+        """Returns the next piece of compressed image data, or '' at the end.
+        """
+        while not self.idat_remaining:
+            if self.idat_done:
+                return ''
+            # Skip the CRC of the last IDAT chunk.
+            self.png_file.read(4)
+            chunk_type, length = _read_png_chunk_header(self.png_file)
+            if chunk_type != 'IDAT':
+                self.idat_done = True
+                return ''
+            self.idat_remaining = length
+
+        data = self.png_file.read(min(self.idat_remaining, PNG_READ_BYTES))
+        if not data:
+            raise DecodeError('PNG image data is truncated')
+        self.idat_remaining -= len(data)
+        return data
+
+    def _read_rows(self, count):
+        from PIL import Image
+
+        need = count * self.stride
+        pieces = []
+        have = 0
+        try:
+            while have < need:
+                data = self.inflater.unconsumed_tail or self._read_idat()
+                if not data:
+                    raise DecodeError('PNG image data ended early')
+                piece = self.inflater.decompress(data, need - have)
+                pieces.append(piece)
+                have += len(piece)
+        except zlib.error, e:
+            raise DecodeError('Could not inflate PNG image data. %s' % e)
+
+        width = self.size[0]
+        header = struct.pack(
+            '>IIBBBBB', width, count + 1, 8, self.color_type, 0, 0, 0)
+        data = zlib.compress('\0' + self.previous + ''.join(pieces), 1)
+        png_data = ''.join(
+            [PNG_SIGNATURE, _png_chunk('IHDR', header)] +
+            [_png_chunk(chunk_type, chunk_data)
+             for chunk_type, chunk_data in self.chunks] +
+            [_png_chunk('IDAT', data), _png_chunk('IEND', '')])
+
+        try:
+            image = Image.open(StringIO.StringIO(png_data))
+            image.load()
+        except (IOError, ValueError), e:
+            raise DecodeError('Could not decode PNG rows. %s: %s' % (
+                              e.__class__.__name__, e))
+
+        self.previous = image.crop((0, count, width, count + 1)).tobytes()
+        return image.crop((0, 1, width, count + 1))
+
+    def close(self):
+        """Closes the PNG file."""
+        self.png_file.close()
+
+
+def _read_png_chunk_header(png_file):
+    """Returns a tuple (chunk_type, length) for the next PNG chunk."""
+    data = png_file.read(8)
+    if len(data) != 8:
+        raise DecodeError('PNG file is truncated')
+    length, chunk_type = struct.unpack('>I4s', data)
+    return chunk_type, length
+
+
+def _open_png(png_file):
+    """Reads the header of a PNG file for PngBands.
+
+    Returns:
+        PngBands instance, or None if the file isn't a PNG that PngBands can
+        read.
+
+    Raises:
+        DecodeError if the file is a truncated PNG.
+    """
+    if png_file.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+        return None
+
+    chunk_type, length = _read_png_chunk_header(png_file)
+    if chunk_type != 'IHDR' or length != 13:
+        return None
+    header = png_file.read(length + 4)
+    if len(header) != length + 4:
+        raise DecodeError('PNG file is truncated')
+    (width, height, bit_depth, color_type,
+     compression, filter_method, interlace) = struct.unpack(
+        '>IIBBBBB', header[:13])
+    if (bit_depth != 8 or color_type not in PNG_CHANNELS or
+            compression or filter_method or interlace):
+        return None
+
+    chunks = []
+    while True:
+        chunk_type, length = _read_png_chunk_header(png_file)
+        if chunk_type == 'IDAT':
+            return PngBands(
+                png_file, width, height, color_type, chunks, length)
+        if chunk_type == 'IEND':
+            return None
+        data = png_file.read(length + 4)
+        if len(data) != length + 4:
+            raise DecodeError('PNG file is truncated')
+        if chunk_type in ('PLTE', 'tRNS'):
+            chunks.append((chunk_type, data[:length]))
+
+
+def open_image(path):
+    """Opens an image file to read one band of rows at a time.
+
+    Args:
+        path: Path to the image to read.
+
+    Returns:
+        PngBands instance for 8-bit PNG files, otherwise an ImageBands
+        instance for the fully decoded image.
+
+    Raises:
+        DecodeError if the image could not be decoded.
+    """
+    from PIL import Image
+
+    try:
+        png_file = open(path, 'rb')
+    except IOError, e:
+        raise DecodeError('Could not open %r. %s' % (path, e))
+
+    try:
+        bands = _open_png(png_file)
+    except DecodeError, e:
+        png_file.close()
+        raise DecodeError('Could not decode %r. %s' % (path, e))
+    except:
+        png_file.close()
+        raise
+    if bands:
+        return bands
+    png_file.close()
+
+    try:
+        image = Image.open(path)
+        image.load()
+    except (IOError, ValueError), e:
+        raise DecodeError('Could not decode %r. %s: %s' % (
+                          path, e.__class__.__name__, e))
+
+    has_alpha = (
+        image.mode in ('RGBA', 'LA', 'PA') or
+        'transparency' in image.info)
+    return ImageBands(image, has_alpha)
+
+
+class HighlightWriter(object):
+    """Writes a highlight image to a PNG file one band of rows at a time.
+
+    The highlight image is the size of the new image so it lines up with the
+    screenshot it is shown next to. Changed pixels are red and everything
+    else is the lowlight color. The file is only created once the first
+    band with changes is written.
+    """
+
+    def __init__(self, path, width, height):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.top = 0
+        self.output = None
+        self.deflater = None
+        self.lowlight_row = '\0' + struct.pack('4B', *LOWLIGHT_COLOR) * width
+
+    def _write_data(self, data):
+        compressed = self.deflater.compress(data)
+        if compressed:
+            self.output.write(_png_chunk('IDAT', compressed))
+
+    def _fill_to(self, top):
+        """Writes rows of only the lowlight color up to the given row."""
+        while self.top < top:
+            rows = min(top - self.top, BAND_ROWS)
+            self._write_data(self.lowlight_row * rows)
+            self.top += rows
+
+    def write_band(self, top, mask):
+        """Writes a band of rows.
+
+        Args:
+            top: First row of the band. Rows above it that haven't been
+                written yet have no changes.
+            mask: Boolean array with shape (rows, width) that is True for
+                the changed pixels of the band.
+        """
+        import numpy
+
+        if self.output is None:
+            self.output = open(self.path, 'wb')
+            self.deflater = zlib.compressobj()
+            self.output.write(PNG_SIGNATURE)
+            self.output.write(_png_chunk('IHDR', struct.pack(
+                '>IIBBBBB', self.width, self.height, 8, 6, 0, 0, 0)))
+        self._fill_to(top)
+
+        rows = mask.shape[0]
+        pixels = numpy.empty((rows, self.width, 4), dtype=numpy.uint8)
+        pixels[...] = LOWLIGHT_COLOR
+        pixels[mask] = HIGHLIGHT_COLOR
+        # Each row starts with a zero byte for PNG filter type None.
+        filters = numpy.zeros((rows, 1), dtype=numpy.uint8)
+        self._write_data(
+            numpy.hstack([filters, pixels.reshape(rows, -1)]).tostring())
+        self.top += rows
+
+    def close(self):
+        """Finishes the file, if any bands were written.
+
+        Returns:
+            True if the highlight image was written, False otherwise.
+        """
+        if self.output is None:
+            return False
+        self._fill_to(self.height)
+        self.output.write(_png_chunk('IDAT', self.deflater.flush()))
+        self.output.write(_png_chunk('IEND', ''))
+        self.output.close()
+        self.output = None
+        return True
+
+    def discard(self):
+        """Deletes the file, if any bands were written."""
+        if self.output is not None:
+            self.output.close()
+            self.output = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _band_squared_error(ref_band, run_band, channels):
+    """Returns the sum of squared normalized errors for a band of rows.
+
+    Color channels are scaled by their alpha before comparing, which is how
+    ImageMagick computes distortion for images with transparency.
+    """
+    import numpy
+
+    ref = ref_band.astype(numpy.float32) / 255.0
+    run = run_band.astype(numpy.float32) / 255.0
+    if channels == 4:
+        ref[..., :3] *= ref[..., 3:4]
+        run[..., :3] *= run[..., 3:4]
+    delta = ref[..., :channels] - run[..., :channels]
+    return float(numpy.square(delta, out=delta).sum(dtype=numpy.float64))
+
+
+def diff_images(ref_bands, run_bands, use_alpha=True, highlight=None):
+    """Diffs two images one band of rows at a time.
+
+    Args:
+        ref_bands: ImageBands of the reference. It is padded or cropped to
+            the size of the new image.
+        run_bands: ImageBands of the new image.
+        use_alpha: When True, the alpha channel counts towards distortion.
+        highlight: Optional. HighlightWriter to write the changed pixels of
+            each band to.
+
+    Returns:
+        Tuple (distortion, pixels_changed).
+    """
+    import numpy
+
+    width, height = run_bands.size
+    channels = 4 if use_alpha else 3
+
+    total = 0.0
+    pixels_changed = 0
+    for top in xrange(0, height, BAND_ROWS):
+        rows = min(height, top + BAND_ROWS) - top
+        ref_band = ref_bands.read_band(rows, width)
+        run_band = run_bands.read_band(rows, width)
+        mask = numpy.any(ref_band != run_band, axis=2)
+        count = int(mask.sum())
+        if not count:
+            continue
+
+        pixels_changed += count
+        total += _band_squared_error(ref_band, run_band, channels)
+        if highlight:
+            highlight.write_band(top, mask)
+
+    if not pixels_changed or not total:
+        return 0.0, pixels_changed
+
+    distortion = (total / (height * width * channels)) ** 0.5
+    return distortion, pixels_changed
+
+
+def _merge_tiles(tile_dict):
+    """Merges touching changed tiles into regions.
+
+    Args:
+        tile_dict: Dictionary mapping (tile_row, tile_column) to a list
+            [left, top, right, bottom, pixels_changed] for the changed
+            pixels in that tile.
+
+    Returns:
+        List of tuples (left, top, right, bottom, pixels_changed), one for
+        each group of changed tiles that share an edge, sorted from the top.
+    """
+    regions = []
+    remaining = set(tile_dict)
+    while remaining:
+        stack = [remaining.pop()]
+        region = list(tile_dict[stack[0]])
+        while stack:
+            row, column = stack.pop()
+            for neighbor in ((row - 1, column), (row + 1, column),
+                             (row, column - 1), (row, column + 1)):
+                if neighbor not in remaining:
+                    continue
+                remaining.remove(neighbor)
+                stack.append(neighbor)
+                left, top, right, bottom, pixels = tile_dict[neighbor]
+                region[0] = min(region[0], left)
+                region[1] = min(region[1], top)
+                region[2] = max(region[2], right)
+                region[3] = max(region[3], bottom)
+                region[4] += pixels
+        regions.append(tuple(region))
+
+    regions.sort(key=lambda x: (x[1], x[0]))
+    return regions
+
+
+def diff_tiles(ref_bands, run_bands, use_alpha=True, tile_size=TILE_SIZE,
+               highlight=None):
+    """Diffs two images one tile at a time.
+
+    Bands of rows that are identical are skipped with a single comparison,
+    and so are identical tiles within a band, so unchanged parts of a tall
+    screenshot cost little. No temporary arrays are larger than a band.
+
+    Args:
+        ref_bands: ImageBands of the reference. It is padded or cropped to
+            the size of the new image.
+        run_bands: ImageBands of the new image.
+        use_alpha: When True, the alpha channel counts towards distortion.
+        tile_size: Width and height of the tiles to compare.
+        highlight: Optional. HighlightWriter to write the changed pixels of
+            each band to.
+
+    Returns:
+        Tuple (distortion, pixels_changed, regions) where regions is a list
+        of tuples (left, top, right, bottom, pixels_changed) bounding the
+        changed pixels, with touching changed tiles merged together.
+    """
+    import numpy
+
+    width, height = run_bands.size
+    channels = 4 if use_alpha else 3
+
+    tile_dict = {}
+    total = 0.0
+    pixels_changed = 0
+    for top in xrange(0, height, tile_size):
+        rows = min(height, top + tile_size) - top
+        ref_band = ref_bands.read_band(rows, width)
+        run_band = run_bands.read_band(rows, width)
+        if numpy.array_equal(ref_band, run_band):
+            continue
+
+        band_mask = numpy.zeros((rows, width), dtype=numpy.bool_)
+        for left in xrange(0, width, tile_size):
+            right = min(width, left + tile_size)
+            ref_tile = ref_band[:, left:right]
+            run_tile = run_band[:, left:right]
+            if numpy.array_equal(ref_tile, run_tile):
+                continue
+
+            mask = band_mask[:, left:right]
+            numpy.any(ref_tile != run_tile, axis=2, out=mask)
+            tile_rows = numpy.flatnonzero(mask.any(axis=1))
+            tile_columns = numpy.flatnonzero(mask.any(axis=0))
+            count = int(mask.sum())
+            tile_dict[(top // tile_size, left // tile_size)] = [
+                left + int(tile_columns[0]), top + int(tile_rows[0]),
+                left + int(tile_columns[-1]) + 1, top + int(tile_rows[-1]) + 1,
+                count]
+            pixels_changed += count
+            total += _band_squared_error(ref_tile, run_tile, channels)
+
+        if highlight:
+            highlight.write_band(top, band_mask)
+
+    regions = _merge_tiles(tile_dict)
+    if not pixels_changed or not total:
+        return 0.0, pixels_changed, regions
+
+    distortion = (total / (height * width * channels)) ** 0.5
+    return distortion, pixels_changed, regions
+
+
+def diff_files(ref_path, run_path, output_path=None, tile_size=None):
+    """Diffs a reference image file against a new image file.
+
+    This is a module-level function so it may be run in a process pool.
+
+    Args:
+        ref_path: Path to the reference image.
+        run_path: Path to the new image.
+        output_path: Optional. Where to write the highlight image when the
+            images are different. Nothing is written if they are the same.
+        tile_size: Optional. When supplied, diff the images by tiles of this
+            size with diff_tiles and report the changed regions.
+
+    Returns:
+        DiffResult instance.
+
+    Raises:
+        DecodeError if either image could not be decoded.
+    """
+    ref_bands = open_image(ref_path)
+    try:
+        run_bands = open_image(run_path)
+    except:
+        ref_bands.close()
+        raise
+
+    width, height = run_bands.size
+    resized = ref_bands.size != run_bands.size
+    use_alpha = ref_bands.has_alpha or run_bands.has_alpha or resized
+
+    highlight = None
+    if output_path:
+        highlight = HighlightWriter(output_path, width, height)
+
+    regions = None
+    try:
+        if tile_size:
+            distortion, pixels_changed, regions = diff_tiles(
+                ref_bands, run_bands, use_alpha=use_alpha,
+                tile_size=tile_size, highlight=highlight)
+        else:
+            distortion, pixels_changed = diff_images(
+                ref_bands, run_bands, use_alpha=use_alpha,
+                highlight=highlight)
+    except:
+        if highlight:
+            highlight.discard()
+        raise
+    finally:
+        ref_bands.close()
+        run_bands.close()
+
+    if highlight:
+        if distortion:
+            highlight.close()
+        else:
+            highlight.discard()
+
+    return DiffResult(
+        distortion, pixels_changed, width, height, ref_bands.size,
+        regions=regions)
+
+
+def format_log(ref_path, run_path, result):
+    """Returns log text for a diff in the style of 'compare -verbose'."""
+    lines = [
+        'Image: %s' % ref_path,
+        '  Geometry: %dx%d' % result.ref_size,
+        'Image: %s' % run_path,
+        '  Geometry: %dx%d' % (result.width, result.height),
+        '  Channel distortion: RMSE',
+        '    all: %g (%g)' % (
+            result.distortion * QUANTUM_RANGE, result.distortion),
+        '  Pixels changed: %d' % result.pixels_changed,
+    ]
+    if result.regions is not None:
+        # Geometry is written the ImageMagick way, as WxH+X+Y.
+        lines.append('  Changed regions: %d' % len(result.regions))
+        for left, top, right, bottom, pixels in result.regions:
+            lines.append('    %dx%d+%d+%d: %d pixels' % (
+                right - left, bottom - top, left, top, pixels))
+    return '\n'.join(lines) + '\n'
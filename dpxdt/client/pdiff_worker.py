@@ -17,6 +17,8 @@
 
 import Queue
 import json
+import logging
+import multiprocessing
 import os
 import shutil
 import subprocess
@@ -33,6 +35,7 @@ FLAGS = gflags.FLAGS
 
 # Local modules
 from dpxdt import constants
+from dpxdt.client import pdiff_engine
 from dpxdt.client import process_worker
 from dpxdt.client import queue_worker
 from dpxdt.client import release_worker
@@ -64,6 +67,29 @@ gflags.DEFINE_integer(
     'pdiff_timeout', 60,
     'Seconds until we should give up on a pdiff sub-process and try again.')
 
+gflags.DEFINE_enum(
+    'pdiff_engine', 'auto', ['auto', 'numpy', 'imagemagick'],
+    'How to compute perceptual diffs. "numpy" decodes and compares the '
+    'images in-process. "imagemagick" runs the composite and compare '
+    'binaries. "auto" uses numpy when it is installed and falls back to '
+    'ImageMagick otherwise.')
+
+gflags.DEFINE_integer(
+    'pdiff_processes', 0,
+    'Number of processes in the pool used for in-process perceptual diffs. '
+    'When zero, diffs are computed directly on the pdiff threads.')
+
+gflags.DEFINE_integer(
+    'pdiff_tile_size', 0,
+    'When greater than zero, the numpy engine compares images in square '
+    'tiles of this many pixels, skips identical tiles, and reports the '
+    'changed regions with the run. Zero compares the whole image a band '
+    'of rows at a time. Both write a full size highlight image.')
+
+NUMPY_ENGINE = 'numpy'
+
+IMAGEMAGICK_ENGINE = 'imagemagick'
+
 DIFF_REGEX = re.compile(".*all:.*\(([0-9e\-\.]*)\).*")
 
 
@@ -137,6 +163,85 @@ class PdiffWorkflow(process_worker.ProcessWorkflow):
         ]
 
 
+class DiffImagesItem(workers.WorkItem):
+    """Work item for diffing two images in-process with the pdiff_engine."""
+
+    def __init__(self, log_path, ref_path, run_path, output_path):
+        """Initializer.
+
+        Args:
+            log_path: Where to write the verbose logging output.
+            ref_path: Path to reference screenshot to diff.
+            run_path: Path to the most recent run screenshot to diff.
+            output_path: Where the diff image should be written, if the
+                images are different.
+        """
+        workers.WorkItem.__init__(self)
+        self.log_path = log_path
+        self.ref_path = ref_path
+        self.run_path = run_path
+        self.output_path = output_path
+        # Response values
+        self.distortion = None
+        self.pixels_changed = None
+        self.regions = None
+
+
+class PdiffThread(workers.WorkerThread):
+    """Worker thread that computes perceptual diffs in-process."""
+
+    def __init__(self, input_queue, output_queue, pool=None):
+        """Initializer.
+
+        Args:
+            input_queue: Queue this worker consumes work from.
+            output_queue: Queue where this worker puts new work items, if any.
+            pool: Optional. multiprocessing.Pool to run the diffs in. When
+                not supplied the diff is computed on this thread.
+        """
+        workers.WorkerThread.__init__(self, input_queue, output_queue)
+        self.pool = pool
+
+    def handle_item(self, item):
+        args = (item.ref_path, item.run_path, item.output_path,
+                FLAGS.pdiff_tile_size or None)
+        try:
+            if self.pool:
+                result = self.pool.apply(pdiff_engine.diff_files, args)
+            else:
+                result = pdiff_engine.diff_files(*args)
+        except pdiff_engine.Error, e:
+            with open(item.log_path, 'a') as log_file:
+                log_file.write('%s: %s\n' % (e.__class__.__name__, e))
+            raise
+
+        with open(item.log_path, 'a') as log_file:
+            log_file.write(pdiff_engine.format_log(
+                item.ref_path, item.run_path, result))
+
+        item.distortion = result.distortion
+        item.pixels_changed = result.pixels_changed
+        item.regions = result.regions
+        return item
+
+
+def get_engine():
+    """Returns the name of the perceptual diff engine to use."""
+    if FLAGS.pdiff_engine == 'auto':
+        if pdiff_engine.is_available():
+            return NUMPY_ENGINE
+        return IMAGEMAGICK_ENGINE
+    return FLAGS.pdiff_engine
+
+
+def get_parameters():
+    """Returns the settings that change the diffs this worker computes."""
+    engine = get_engine()
+    if engine == NUMPY_ENGINE:
+        return 'engine=%s,tile_size=%d' % (engine, FLAGS.pdiff_tile_size)
+    return 'engine=%s' % engine
+
+
 class DoPdiffQueueWorkflow(workers.WorkflowItem):
     """Runs the perceptual diff from queue parameters.
 
@@ -174,63 +279,100 @@ class DoPdiffQueueWorkflow(workers.WorkflowItem):
 
             max_attempts = FLAGS.pdiff_task_max_attempts
 
-            yield heartbeat('Resizing reference image')
-            returncode = yield ResizeWorkflow(
-                log_path, ref_path, run_path, ref_resized_path)
-            if returncode != 0:
-                raise PdiffFailedError(
-                    max_attempts,
-                    'Could not resize reference image to size of new image')
-
-            yield heartbeat('Running perceptual diff process')
-            returncode = yield PdiffWorkflow(
-                log_path, ref_resized_path, run_path, diff_path)
-
-            # ImageMagick returns 1 if the images are different and 0 if
-            # they are the same, so the return code is a bad judge of
-            # successfully running the diff command. Instead we need to check
-            # the output text.
-            diff_failed = True
-
-            # Check for a successful run or a known failure.
-            distortion = None
-            if os.path.isfile(log_path):
-                log_data = open(log_path).read()
-                if 'all: 0 (0)' in log_data:
-                    diff_path = None
-                    diff_failed = False
-                elif 'image widths or heights differ' in log_data:
-                    # Give up immediately
-                    max_attempts = 1
+            if get_engine() == NUMPY_ENGINE:
+                yield heartbeat('Running in-process perceptual diff')
+                diff_failed = True
+                distortion = None
+                regions = None
+                try:
+                    item = yield DiffImagesItem(
+                        log_path, ref_path, run_path, diff_path)
+                except pdiff_engine.Error, e:
+                    failure_reason = str(e)
                 else:
-                    # Try to find the image magic normalized root square
-                    # mean and grab the first one.
-                    r = DIFF_REGEX.findall(log_data)
-                    if len(r) > 0:
+                    diff_failed = False
+                    if item.distortion:
+                        distortion = item.distortion
+                        regions = item.regions
+                    else:
+                        diff_path = None
+            else:
+                regions = None
+                yield heartbeat('Resizing reference image')
+                returncode = yield ResizeWorkflow(
+                    log_path, ref_path, run_path, ref_resized_path)
+                if returncode != 0:
+                    raise PdiffFailedError(
+                        max_attempts,
+                        'Could not resize reference image to size of new image')
+
+                yield heartbeat('Running perceptual diff process')
+                returncode = yield PdiffWorkflow(
+                    log_path, ref_resized_path, run_path, diff_path)
+                failure_reason = 'returncode=%r' % returncode
+
+                # ImageMagick returns 1 if the images are different and 0 if
+                # they are the same, so the return code is a bad judge of
+                # successfully running the diff command. Instead we need to
+                # check the output text.
+                diff_failed = True
+
+                # Check for a successful run or a known failure.
+                distortion = None
+                if os.path.isfile(log_path):
+                    log_data = open(log_path).read()
+                    if 'all: 0 (0)' in log_data:
+                        diff_path = None
                         diff_failed = False
-                        distortion = r[0]
+                    elif 'image widths or heights differ' in log_data:
+                        # Give up immediately
+                        max_attempts = 1
+                    else:
+                        # Try to find the image magic normalized root square
+                        # mean and grab the first one.
+                        r = DIFF_REGEX.findall(log_data)
+                        if len(r) > 0:
+                            diff_failed = False
+                            distortion = r[0]
 
             yield heartbeat('Reporting diff result to server')
             yield release_worker.ReportPdiffWorkflow(
                 build_id, release_name, release_number, run_name,
-                diff_path, log_path, diff_failed, distortion)
+                diff_path, log_path, diff_failed, distortion,
+                parameters=get_parameters(), regions=regions)
 
             if diff_failed:
                 raise PdiffFailedError(
                     max_attempts,
-                    'Comparison failed. returncode=%r' % returncode)
+                    'Comparison failed. %s' % failure_reason)
         finally:
             shutil.rmtree(output_path, True)
 
 
 def register(coordinator):
     """Registers this module as a worker with the given coordinator."""
-    utils.verify_binary('pdiff_compare_binary', ['-version'])
-    utils.verify_binary('pdiff_composite_binary', ['-version'])
-
     assert FLAGS.pdiff_threads > 0
     assert FLAGS.queue_server_prefix
 
+    engine = get_engine()
+    if engine == NUMPY_ENGINE:
+        if not pdiff_engine.is_available():
+            logging.error('--pdiff_engine=%s requires numpy and PIL', engine)
+            sys.exit(1)
+
+        pool = None
+        if FLAGS.pdiff_processes > 0:
+            pool = multiprocessing.Pool(FLAGS.pdiff_processes)
+
+        pdiff_queue = Queue.Queue()
+        coordinator.register(DiffImagesItem, pdiff_queue)
+        for i in xrange(FLAGS.pdiff_threads):
+            coordinator.worker_threads.append(
+                PdiffThread(pdiff_queue, coordinator.input_queue, pool=pool))
+    else:
+        utils.verify_binary('pdiff_compare_binary', ['-version'])
+        utils.verify_binary('pdiff_composite_binary', ['-version'])
+
     item = queue_worker.RemoteQueueWorkflow(
         constants.PDIFF_QUEUE_NAME,
         DoPdiffQueueWorkflow,
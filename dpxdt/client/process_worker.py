@@ -18,6 +18,7 @@
 import Queue
 import logging
 import subprocess
+import threading
 import time
 import sys
 
@@ -40,6 +41,38 @@ class TimeoutError(Exception):
     """Subprocess has taken too long to complete and was terminated."""
 
 
+class ProcessExitItem(timer_worker.TimerItem):
+    """Work item that waits for a subprocess to exit or time out.
+
+    This is handled by the TimerThread like any other timer. A daemon thread
+    blocks on the subprocess and fires the timer as soon as it exits, so
+    finished processes are noticed right away instead of on the next poll.
+
+    Args:
+        process: subprocess.Popen instance to wait on.
+        timeout_seconds: How long to wait before giving up.
+
+    Returns:
+        Sets the returncode attribute to the subprocess's exit code, or
+        leaves it as None if the timeout passed first.
+    """
+
+    def __init__(self, process, timeout_seconds):
+        timer_worker.TimerItem.__init__(self, timeout_seconds)
+        self.process = process
+        self.returncode = None
+
+    def start(self, wake):
+        def wait():
+            self.returncode = self.process.wait()
+            wake(self)
+
+        thread = threading.Thread(
+            target=wait, name='wait-pid-%s' % self.process.pid)
+        thread.daemon = True
+        thread.start()
+
+
 class ProcessWorkflow(workers.WorkflowItem):
     """Workflow that runs a subprocess.
 
@@ -78,26 +111,22 @@ class ProcessWorkflow(workers.WorkflowItem):
                              self, args)
                 raise
 
-            while True:
-                LOGGER.info('item=%r Polling pid=%r', self, process.pid)
-                # NOTE: Use undocumented polling method to work around a
-                # bug in subprocess for handling defunct zombie processes:
-                # http://bugs.python.org/issue2475
-                process._internal_poll(_deadstate=127)
-                if process.returncode is not None:
-                    LOGGER.info(
-                        'item=%r Subprocess finished pid=%r, returncode=%r',
-                        self, process.pid, process.returncode)
-                    raise workers.Return(process.returncode)
-
-                now = time.time()
-                run_time = now - start_time
-                if run_time > timeout_seconds:
-                    LOGGER.info('item=%r Subprocess timed out pid=%r',
-                                self, process.pid)
-                    process.kill()
-                    raise TimeoutError(
-                        'Sent SIGKILL to item=%r, pid=%s, run_time=%s' %
-                        (self, process.pid, run_time))
-
-                yield timer_worker.TimerItem(FLAGS.polltime)
+            LOGGER.info('item=%r Waiting for pid=%r', self, process.pid)
+            item = yield ProcessExitItem(process, timeout_seconds)
+            if item.returncode is not None:
+                LOGGER.info(
+                    'item=%r Subprocess finished pid=%r, returncode=%r',
+                    self, process.pid, item.returncode)
+                raise workers.Return(item.returncode)
+
+            run_time = time.time() - start_time
+            LOGGER.info('item=%r Subprocess timed out pid=%r',
+                        self, process.pid)
+            try:
+                process.kill()
+            except OSError:
+                # The process exited right as the timeout passed.
+                pass
+            raise TimeoutError(
+                'Sent SIGKILL to item=%r, pid=%s, run_time=%s' %
+                (self, process.pid, run_time))
@@ -15,7 +15,11 @@
 
 """Workers that consumer a release server's work queue."""
 
+import Queue
+import json
 import logging
+import sys
+import time
 
 # Local Libraries
 import gflags
@@ -39,13 +43,45 @@ gflags.DEFINE_string(
 gflags.DEFINE_integer(
     'queue_idle_poll_seconds', 60,
     'How often to poll the work queue for new tasks when the worker is '
-    'currently not processing any tasks.')
+    'currently not processing any tasks and the server does not support '
+    'long polling.')
+
+gflags.DEFINE_integer(
+    'queue_lease_wait_seconds', 30,
+    'When the worker is not processing any tasks, how long the server '
+    'should hold a lease request open waiting for new tasks to arrive. '
+    'Set to 0 to poll every --queue_idle_poll_seconds instead.')
 
 gflags.DEFINE_integer(
     'queue_busy_poll_seconds', 1,
     'How often to poll tasks running locally to see if they have completed '
     'and then go back to the server to look for more work.')
 
+gflags.DEFINE_bool(
+    'queue_batch_updates', True,
+    'Send task heartbeats and finishes to the work queue server in batches '
+    'from a single thread. Updates that arrive while a batch is being sent '
+    'go out together in the next one, and only the latest heartbeat for '
+    'each task is sent.')
+
+gflags.DEFINE_float(
+    'queue_update_seconds', 0,
+    'When batching task updates, how long to wait for more updates before '
+    'sending a batch. Trades latency for fewer requests.')
+
+gflags.DEFINE_integer(
+    'queue_reap_seconds', 0,
+    'How often to ask the work queue server to delete old finished tasks. '
+    'Only one worker for a server needs to do this. Defaults to 0, which '
+    'never reaps from this worker.')
+
+# Most task updates to send to the server in one request.
+MAX_UPDATE_BATCH = 500
+
+# How long each task in a batch adds to the batch's lease by default.
+# Matches the server's default lease for a single task.
+BATCH_TASK_LEASE_SECONDS = 60
+
 
 class Error(Exception):
     """Base-class for exceptions in this module."""
@@ -70,6 +106,181 @@ class HeartbeatError(Error):
     """Reporting the status of a task in progress failed for some reason."""
 
 
+class TaskUpdateItem(workers.WorkItem):
+    """Work item for a task update that is sent as part of a batch.
+
+    Args:
+        queue_url: Base URL of the work queue.
+        task_id: ID of the task to update.
+
+    Returns:
+        Sets the status_code attribute to the response status of the batch
+        request and the json attribute to the result for this task.
+    """
+
+    def __init__(self, queue_url, task_id):
+        workers.WorkItem.__init__(self)
+        self.queue_url = queue_url
+        self.task_id = task_id
+        self.status_code = None
+        self.json = None
+
+
+class HeartbeatItem(TaskUpdateItem):
+    """Heartbeat for a task that is sent as part of a batch."""
+
+    def __init__(self, queue_url, task_id, message, index):
+        TaskUpdateItem.__init__(self, queue_url, task_id)
+        self.message = message
+        self.index = index
+
+
+class FinishItem(TaskUpdateItem):
+    """Finish for a task that is sent as part of a batch."""
+
+    def __init__(self, queue_url, task_id, error=False):
+        TaskUpdateItem.__init__(self, queue_url, task_id)
+        self.task_error = error
+
+
+class TaskUpdateThread(workers.WorkerThread):
+    """Worker thread that coalesces TaskUpdateItems into batched requests."""
+
+    def _get_batch(self, item):
+        batch = [item]
+        deadline = time.time() + FLAGS.queue_update_seconds
+        while len(batch) < MAX_UPDATE_BATCH:
+            wait_seconds = deadline - time.time()
+            try:
+                if wait_seconds > 0:
+                    next_item = self.input_queue.get(True, wait_seconds)
+                else:
+                    # Take what arrived while the last batch was being sent.
+                    next_item = self.input_queue.get_nowait()
+            except Queue.Empty:
+                break
+            self.input_queue.task_done()
+            if not isinstance(next_item, TaskUpdateItem):
+                # Let the main loop handle wake-ups for stopping the thread.
+                self.input_queue.put(next_item)
+                break
+            batch.append(next_item)
+        return batch
+
+    def _send(self, url, param_name, updates, items_by_task):
+        """Sends one batch of updates and sets the results on its items."""
+        LOGGER.debug('Sending %d updates to %r', len(updates), url)
+        try:
+            call = fetch_worker.fetch(fetch_worker.FetchItem(
+                url,
+                post={param_name: json.dumps(updates)},
+                username=FLAGS.release_client_id,
+                password=FLAGS.release_client_secret))
+        except Exception:
+            LOGGER.exception('Could not send task updates to %r', url)
+            error = sys.exc_info()
+            for items in items_by_task.itervalues():
+                for next_item in items:
+                    next_item.error = error
+            return
+
+        results = {}
+        if call.json and call.json.get('results'):
+            for result in call.json['results']:
+                results[result['task_id']] = result
+        elif call.json:
+            # The whole request failed, so every task gets the same error.
+            results = dict.fromkeys(items_by_task, call.json)
+
+        for task_id, items in items_by_task.iteritems():
+            for next_item in items:
+                next_item.status_code = call.status_code
+                next_item.json = results.get(task_id)
+
+    def handle_item(self, item):
+        batch = self._get_batch(item)
+
+        # Maps queue_url to dictionaries of task_id to lists of items.
+        heartbeats = {}
+        finishes = {}
+        for next_item in batch:
+            if isinstance(next_item, HeartbeatItem):
+                target = heartbeats
+            else:
+                target = finishes
+            target.setdefault(next_item.queue_url, {}).setdefault(
+                next_item.task_id, []).append(next_item)
+
+        for queue_url, items_by_task in heartbeats.iteritems():
+            # Only the latest heartbeat for each task matters.
+            updates = []
+            for task_id, items in items_by_task.iteritems():
+                latest = max(items, key=lambda x: x.index)
+                updates.append(dict(
+                    task_id=task_id,
+                    message=latest.message,
+                    index=latest.index))
+            self._send(queue_url + '/heartbeat_tasks', 'heartbeats',
+                       updates, items_by_task)
+
+        for queue_url, items_by_task in finishes.iteritems():
+            updates = []
+            for task_id, items in items_by_task.iteritems():
+                updates.append(dict(
+                    task_id=task_id,
+                    error=any(x.task_error for x in items)))
+            self._send(queue_url + '/finish_tasks', 'finishes',
+                       updates, items_by_task)
+
+        # The main loop marks the first item done and returns it. Do the same
+        # for the rest of the batch, which was pulled off the queue here.
+        for next_item in batch[1:]:
+            next_item.done = True
+            self.output_queue.put(next_item)
+
+        return item
+
+
+def _heartbeat(queue_url, task_id, message, index):
+    """Returns a WorkItem that sends a heartbeat for a task.
+
+    When --queue_batch_updates is True, the heartbeat is sent as part of a
+    batch. The returned item's json attribute is the response.
+    """
+    if FLAGS.queue_batch_updates:
+        return HeartbeatItem(queue_url, task_id, message, index)
+
+    return fetch_worker.FetchItem(
+        queue_url + '/heartbeat',
+        post={
+            'task_id': task_id,
+            'message': message,
+            'index': index,
+        },
+        username=FLAGS.release_client_id,
+        password=FLAGS.release_client_secret)
+
+
+def _finish(queue_url, task_id, error):
+    """Returns a WorkItem that marks a task as finished.
+
+    When --queue_batch_updates is True, the finish is sent as part of a
+    batch. The returned item's json attribute is the response.
+    """
+    if FLAGS.queue_batch_updates:
+        return FinishItem(queue_url, task_id, error=error)
+
+    finish_params = {'task_id': task_id}
+    if error:
+        finish_params['error'] = '1'
+
+    return fetch_worker.FetchItem(
+        queue_url + '/finish',
+        post=finish_params,
+        username=FLAGS.release_client_id,
+        password=FLAGS.release_client_secret)
+
+
 class HeartbeatWorkflow(workers.WorkflowItem):
     """Reports the status of a RemoteQueueWorkflow to the API server.
 
@@ -82,15 +293,7 @@ class HeartbeatWorkflow(workers.WorkflowItem):
     """
 
     def run(self, queue_url, task_id, message, index):
-        call = yield fetch_worker.FetchItem(
-            queue_url + '/heartbeat',
-            post={
-                'task_id': task_id,
-                'message': message,
-                'index': index,
-            },
-            username=FLAGS.release_client_id,
-            password=FLAGS.release_client_secret)
+        call = yield _heartbeat(queue_url, task_id, message, index)
 
         if call.json and call.json.get('error'):
             raise HeartbeatError(call.json.get('error'))
@@ -99,6 +302,69 @@ class HeartbeatWorkflow(workers.WorkflowItem):
             raise HeartbeatError('Bad response: %r' % call)
 
 
+def _make_heartbeat(queue_url, task_id):
+    """Returns a heartbeat function for a task.
+
+    The function returns a workflow for reporting status. This will
+    auto-increment the index on each call, so only the latest update will
+    be saved.
+    """
+    index = [0]
+    def heartbeat(message):
+        next_index = index[0]
+        index[0] = next_index + 1
+        return HeartbeatWorkflow(
+            queue_url, task_id, message, next_index)
+    return heartbeat
+
+
+class CompleteTaskWorkflow(workers.WorkflowItem):
+    """Marks a task done in the remote queue after it has been processed.
+
+    Args:
+        queue_url: Base URL of the work queue.
+        task: JSON payload of the task.
+        heartbeat: Heartbeat function for the task.
+        exception: Optional. Exception raised while processing the task.
+            When supplied the task is only marked done if it has hit its
+            maximum attempts; otherwise it is left to retry in the queue.
+    """
+
+    def run(self, queue_url, task, heartbeat, exception=None):
+        task_id = task['task_id']
+        error = False
+
+        if exception is not None:
+            yield heartbeat('%s: %s' % (
+                exception.__class__.__name__, str(exception)))
+
+            if (isinstance(exception, GiveUpAfterAttemptsError) and
+                    task['lease_attempts'] >= exception.max_attempts):
+                LOGGER.warning(
+                    'Hit max attempts on task=%r, marking task as error',
+                    task)
+                error = True
+            else:
+                # The task has legimiately failed. Do not mark the task as
+                # finished. Let it retry in the queue again.
+                return
+
+        try:
+            finish_item = yield _finish(queue_url, task_id, error)
+        except Exception, e:
+            LOGGER.error('Could not finish work with '
+                         'queue_url=%r, task=%r. %s: %s',
+                         queue_url, task, e.__class__.__name__, e)
+        else:
+            if finish_item.json and finish_item.json.get('error'):
+                LOGGER.error('Could not finish work with '
+                             'queue_url=%r, task=%r. %s',
+                             queue_url, finish_item.json['error'], task)
+            else:
+                LOGGER.info('Finished work item with queue_url=%r, '
+                            'task_id=%r', queue_url, task_id)
+
+
 class DoTaskWorkflow(workers.WorkflowItem):
     """Runs a local workflow for a task and marks it done in the remote queue.
 
@@ -121,62 +387,95 @@ class DoTaskWorkflow(workers.WorkflowItem):
         if wait_seconds > 0:
             yield timer_worker.TimerItem(wait_seconds)
 
-        # Define a heartbeat closure that will return a workflow for
-        # reporting status. This will auto-increment the index on each
-        # call, so only the latest update will be saved.
-        index = [0]
-        task_id = task['task_id']
-        def heartbeat(message):
-            next_index = index[0]
-            index[0] = next_index + 1
-            return HeartbeatWorkflow(
-                queue_url, task_id, message, next_index)
-
+        heartbeat = _make_heartbeat(queue_url, task['task_id'])
         payload = task['payload']
         payload.update(heartbeat=heartbeat)
 
-        error = False
-
+        exception = None
         try:
             yield local_queue_workflow(**payload)
         except Exception, e:
             LOGGER.exception('Exception while processing work from '
                              'queue_url=%r, task=%r', queue_url, task)
-            yield heartbeat('%s: %s' % (e.__class__.__name__, str(e)))
+            exception = e
 
-            if (isinstance(e, GiveUpAfterAttemptsError) and
-                    task['lease_attempts'] >= e.max_attempts):
-                LOGGER.warning(
-                    'Hit max attempts on task=%r, marking task as error',
-                    task)
-                error = True
-            else:
-                # The task has legimiately failed. Do not mark the task as
-                # finished. Let it retry in the queue again.
-                return
+        yield CompleteTaskWorkflow(queue_url, task, heartbeat, exception)
 
-        finish_params = {'task_id': task_id}
-        if error:
-            finish_params['error'] = '1'
+
+class DoTaskBatchWorkflow(workers.WorkflowItem):
+    """Runs a local workflow for a batch of tasks and marks each one done.
+
+    Args:
+        queue_url: Base URL of the work queue.
+        local_batch_workflow: WorkflowItem sub-class to create with a list of
+            the remote work payloads that will execute the tasks together.
+            It should return a list with an Exception for each task that
+            failed, or None for each task that succeeded.
+        tasks: List of JSON payloads of the tasks.
+        wait_seconds: Wait this many seconds before starting work.
+            Defaults to zero.
+    """
+
+    fire_and_forget = True
+
+    def run(self, queue_url, local_batch_workflow, tasks, wait_seconds=0):
+        LOGGER.info('Starting batch of %d work items from queue_url=%r, '
+                    'task_ids=%r, workflow=%r, wait_seconds=%r',
+                    len(tasks), queue_url, [t['task_id'] for t in tasks],
+                    local_batch_workflow, wait_seconds)
+
+        if wait_seconds > 0:
+            yield timer_worker.TimerItem(wait_seconds)
+
+        payloads = []
+        for task in tasks:
+            payload = task['payload']
+            payload.update(
+                heartbeat=_make_heartbeat(queue_url, task['task_id']))
+            payloads.append(payload)
 
         try:
-            finish_item = yield fetch_worker.FetchItem(
-                queue_url + '/finish',
-                post=finish_params,
-                username=FLAGS.release_client_id,
-                password=FLAGS.release_client_secret)
+            exceptions = yield local_batch_workflow(payloads)
         except Exception, e:
-            LOGGER.error('Could not finish work with '
-                         'queue_url=%r, task=%r. %s: %s',
-                         queue_url, task, e.__class__.__name__, e)
-        else:
-            if finish_item.json and finish_item.json.get('error'):
-                LOGGER.error('Could not finish work with '
-                             'queue_url=%r, task=%r. %s',
-                             queue_url, finish_item.json['error'], task)
-            else:
-                LOGGER.info('Finished work item with queue_url=%r, '
-                            'task_id=%r', queue_url, task_id)
+            LOGGER.exception('Exception while processing batch of work from '
+                             'queue_url=%r, tasks=%r', queue_url, tasks)
+            exceptions = [e] * len(tasks)
+
+        for task, exception in zip(tasks, exceptions):
+            if exception is not None:
+                LOGGER.error('Error while processing work from queue_url=%r, '
+                             'task=%r. %s: %s', queue_url, task,
+                             exception.__class__.__name__, exception)
+
+        yield [
+            CompleteTaskWorkflow(
+                queue_url, task, payload['heartbeat'], exception)
+            for task, payload, exception in zip(tasks, payloads, exceptions)]
+
+
+def _get_batches(tasks, batch_size, batch_key):
+    """Splits tasks into batches with the same key, in lease order.
+
+    Args:
+        tasks: List of JSON payloads of the tasks.
+        batch_size: Maximum number of tasks in each batch.
+        batch_key: Function that takes a task's payload and returns a key.
+            Only tasks with the same key are batched together.
+
+    Returns:
+        List of lists of tasks.
+    """
+    batches = []
+    open_batches = {}
+    for task in tasks:
+        key = batch_key(task['payload'])
+        batch = open_batches.get(key)
+        if batch is None or len(batch) >= batch_size:
+            batch = []
+            open_batches[key] = batch
+            batches.append(batch)
+        batch.append(task)
+    return batches
 
 
 class RemoteQueueWorkflow(workers.WorkflowItem):
@@ -187,29 +486,75 @@ class RemoteQueueWorkflow(workers.WorkflowItem):
         local_queue_workflow: WorkflowItem sub-class to create using parameters
             from the remote work payload that will execute the task.
         max_tasks: Maximum number of tasks to have in flight at any time.
-            Defaults to 1.
+            Defaults to 1. When batching, this is the maximum number of
+            batches instead. Leased tasks that don't fit in a free batch
+            wait locally for the next one, for up to half of their lease.
         wait_seconds: How many seconds should be between tasks starting to
             process locally. Defaults to 0. Can be used to spread out
             the load a new set of tasks has on the server.
+        local_batch_workflow: Optional. WorkflowItem sub-class to create with
+            a list of remote work payloads that will execute many tasks
+            together. See DoTaskBatchWorkflow.
+        batch_size: Maximum number of tasks in each batch. Tasks are only
+            batched when this is more than 1 and local_batch_workflow is
+            supplied.
+        batch_key: Optional. Function that takes a task's payload and
+            returns a key. Only tasks with the same key are batched together.
+            When not supplied any tasks may be batched together.
+        batch_lease_seconds: Optional. How many seconds to lease tasks for
+            when batching. This should be at least the longest that
+            local_batch_workflow may go without sending heartbeats for its
+            tasks. Defaults to BATCH_TASK_LEASE_SECONDS for each task in a
+            batch.
     """
 
     def run(self, queue_name, local_queue_workflow,
-            max_tasks=1, wait_seconds=0):
+            max_tasks=1, wait_seconds=0, local_batch_workflow=None,
+            batch_size=1, batch_key=None, batch_lease_seconds=None):
         queue_url = '%s/%s' % (FLAGS.queue_server_prefix, queue_name)
         outstanding = []
+        batching = bool(local_batch_workflow) and batch_size > 1
+        if batch_key is None:
+            batch_key = lambda payload: None
+        if batch_lease_seconds is None:
+            batch_lease_seconds = BATCH_TASK_LEASE_SECONDS * batch_size
+
+        # Leased tasks that are waiting for a free batch, and when each one
+        # must start by. After that too little of its lease is left for the
+        # batch to keep it, so it's left for the server to lease again.
+        pending = []
+        start_by = {}
 
         while not self.interrupted:
             next_count = max_tasks - len(outstanding)
+            lease_count = next_count
+            if batching:
+                lease_count = next_count * batch_size - len(pending)
             next_tasks = []
+            long_polled = False
 
-            if next_count > 0:
+            if lease_count > 0:
                 LOGGER.debug(
                     'Fetching %d tasks from queue_url=%r for workflow=%r',
-                    next_count, queue_url, local_queue_workflow)
+                    lease_count, queue_url, local_queue_workflow)
+
+                # Have the server wait for new tasks when there's nothing
+                # to do locally, instead of polling for them.
+                post = {'count': lease_count}
+                if batching:
+                    post['timeout'] = batch_lease_seconds
+                fetch_class = fetch_worker.FetchItem
+                timeout_seconds = 30
+                if not outstanding and FLAGS.queue_lease_wait_seconds > 0:
+                    post['wait'] = FLAGS.queue_lease_wait_seconds
+                    fetch_class = fetch_worker.LongPollFetchItem
+                    timeout_seconds += FLAGS.queue_lease_wait_seconds
+
                 try:
-                    next_item = yield fetch_worker.FetchItem(
+                    next_item = yield fetch_class(
                         queue_url + '/lease',
-                        post={'count': next_count},
+                        post=post,
+                        timeout_seconds=timeout_seconds,
                         username=FLAGS.release_client_id,
                         password=FLAGS.release_client_secret)
                 except Exception, e:
@@ -224,12 +569,47 @@ class RemoteQueueWorkflow(workers.WorkflowItem):
                                 queue_url, next_item.json['error'])
                         elif next_item.json['tasks']:
                             next_tasks = next_item.json['tasks']
-
-            for index, task in enumerate(next_tasks):
-                item = yield DoTaskWorkflow(
-                    queue_url, local_queue_workflow, task,
-                    wait_seconds=index * wait_seconds)
-                outstanding.append(item)
+                            if batching:
+                                deadline = (
+                                    time.time() + batch_lease_seconds / 2.0)
+                                for task in next_tasks:
+                                    start_by[task['task_id']] = deadline
+                        elif next_item.json.get('wait_seconds'):
+                            long_polled = True
+
+            if batching:
+                now = time.time()
+                expired = [t for t in pending if start_by[t['task_id']] <= now]
+                if expired:
+                    LOGGER.warning(
+                        'Dropping %d tasks from queue_url=%r that waited too '
+                        'long for a free batch, task_ids=%r', len(expired),
+                        queue_url, [t['task_id'] for t in expired])
+                    pending[:] = [t for t in pending if t not in expired]
+
+                # Tasks with different keys can make more batches than there
+                # are free slots. Start what fits and keep the rest for the
+                # next batches, ahead of any new tasks.
+                batches = _get_batches(
+                    pending + next_tasks, batch_size, batch_key)
+                del pending[:]
+                for index, batch in enumerate(batches):
+                    if index >= next_count:
+                        pending.extend(batch)
+                        continue
+                    item = yield DoTaskBatchWorkflow(
+                        queue_url, local_batch_workflow, batch,
+                        wait_seconds=index * wait_seconds)
+                    outstanding.append(item)
+
+                start_by = dict(
+                    (t['task_id'], start_by[t['task_id']]) for t in pending)
+            else:
+                for index, task in enumerate(next_tasks):
+                    item = yield DoTaskWorkflow(
+                        queue_url, local_queue_workflow, task,
+                        wait_seconds=index * wait_seconds)
+                    outstanding.append(item)
 
             # Poll for new tasks frequently when we're currently handling
             # task load. Poll infrequently when there hasn't been anything
@@ -237,9 +617,68 @@ class RemoteQueueWorkflow(workers.WorkflowItem):
             poll_time = FLAGS.queue_idle_poll_seconds
             if outstanding:
                 poll_time = FLAGS.queue_busy_poll_seconds
+            elif long_polled:
+                # The server already waited for new tasks; ask again.
+                continue
 
             yield timer_worker.TimerItem(poll_time)
 
             outstanding[:] = [x for x in outstanding if not x.done]
             LOGGER.debug('%d items for %r still outstanding: %r',
                          len(outstanding), local_queue_workflow, outstanding)
+
+
+class ReapQueuesWorkflow(workers.WorkflowItem):
+    """Periodically has the server delete old finished tasks.
+
+    The server reaps a bounded number of tasks per request, so this asks
+    again right away until it reports that it's done.
+
+    Args:
+        reap_seconds: How long to wait between reaping passes.
+    """
+
+    def run(self, reap_seconds):
+        reap_url = '%s/reap' % FLAGS.queue_server_prefix
+
+        while not self.interrupted:
+            done = True
+            try:
+                reap_item = yield fetch_worker.FetchItem(
+                    reap_url,
+                    post={},
+                    username=FLAGS.release_client_id,
+                    password=FLAGS.release_client_secret)
+            except Exception, e:
+                LOGGER.error('Could not reap tasks with reap_url=%r. %s: %s',
+                             reap_url, e.__class__.__name__, e)
+            else:
+                if reap_item.json and reap_item.json.get('success'):
+                    done = reap_item.json['done']
+                    LOGGER.info(
+                        'Reaped %d tasks in %d batches in %.3f seconds',
+                        reap_item.json['reaped'], reap_item.json['batches'],
+                        reap_item.json['seconds'])
+                else:
+                    LOGGER.error(
+                        'Could not reap tasks with reap_url=%r. status=%r, '
+                        'json=%r', reap_url, reap_item.status_code,
+                        reap_item.json)
+
+            if not done:
+                continue
+
+            yield timer_worker.TimerItem(reap_seconds)
+
+
+def register(coordinator):
+    """Registers this module as a worker with the given coordinator."""
+    update_queue = Queue.Queue()
+    coordinator.register(TaskUpdateItem, update_queue)
+    coordinator.worker_threads.append(
+        TaskUpdateThread(update_queue, coordinator.input_queue))
+
+    if FLAGS.queue_reap_seconds > 0 and FLAGS.queue_server_prefix:
+        item = ReapQueuesWorkflow(FLAGS.queue_reap_seconds)
+        item.root = True
+        coordinator.input_queue.put(item)
@@ -15,8 +15,12 @@
 
 """Background worker that uploads new release candidates."""
 
+import Queue
 import hashlib
+import json
 import os
+import sys
+import time
 
 # Local Libraries
 import gflags
@@ -27,6 +31,9 @@ from dpxdt.client import fetch_worker
 from dpxdt.client import workers
 
 
+LOGGER = workers.LOGGER
+
+
 gflags.DEFINE_string(
     'release_server_prefix', None,
     'URL prefix of where the release server is located, such as '
@@ -41,6 +48,22 @@ gflags.DEFINE_string(
     'release_client_secret', None,
     'Client secret of the API key to use for requests to the release server.')
 
+gflags.DEFINE_integer(
+    'report_runs_batch_size', 1,
+    'Maximum number of run reports to send to the release server in a single '
+    'request. When greater than one, reports from concurrent workflows are '
+    'coalesced into calls to /api/report_runs.')
+
+gflags.DEFINE_integer(
+    'request_runs_batch_size', 500,
+    'Maximum number of runs to request from the release server in a single '
+    'call to /api/request_runs.')
+
+gflags.DEFINE_float(
+    'report_runs_wait_seconds', 0.5,
+    'How long to wait for more run reports to arrive before sending a '
+    'partial batch to /api/report_runs.')
+
 
 class Error(Exception):
     """Base-class for exceptions in this module."""
@@ -163,6 +186,78 @@ class UploadFileWorkflow(workers.WorkflowItem):
             raise workers.Return(None)
 
 
+def _hash_file(file_path):
+    """Returns the sha1 sum of a file, or None if it could not be read."""
+    try:
+        sha1 = hashlib.sha1()
+        with open(file_path, 'rb') as handle:
+            while True:
+                data = handle.read(1024 * 1024)
+                if not data:
+                    break
+                sha1.update(data)
+        return sha1.hexdigest()
+    except IOError:
+        return None
+
+
+class UploadFilesWorkflow(workers.WorkflowItem):
+    """Uploads many files for a build, skipping ones the server already has.
+
+    Hashes the files locally and asks /api/has_artifacts which of them the
+    build already has, so only the rest are uploaded.
+
+    Args:
+        build_id: ID of the build to upload the files for.
+        file_paths: List of paths to the files to upload.
+
+    Returns:
+        List with the sha1 sum of each file's contents, or None for files
+        that could not be found.
+
+    Raises:
+        UploadFileError if a file could not be uploaded.
+    """
+
+    def run(self, build_id, file_paths):
+        sha1sums = [_hash_file(path) for path in file_paths]
+
+        found = set()
+        probe = sorted(set(sha1sum for sha1sum in sha1sums if sha1sum))
+        if probe:
+            call = yield fetch_worker.FetchItem(
+                FLAGS.release_server_prefix + '/has_artifacts',
+                post={
+                    'build_id': build_id,
+                    'sha1sums': json.dumps(probe),
+                },
+                username=FLAGS.release_client_id,
+                password=FLAGS.release_client_secret)
+
+            if call.json and call.json.get('success'):
+                found.update(call.json['sha1sums'])
+            else:
+                # Still works with servers that can't check for artifacts.
+                LOGGER.warning('Could not check for existing artifacts, '
+                               'uploading all files. Bad response: %r', call)
+
+        upload_jobs = []
+        upload_indexes = []
+        for index, (file_path, sha1sum) in enumerate(
+                zip(file_paths, sha1sums)):
+            if sha1sum and sha1sum not in found:
+                found.add(sha1sum)
+                upload_jobs.append(UploadFileWorkflow(build_id, file_path))
+                upload_indexes.append(index)
+
+        if upload_jobs:
+            results = yield upload_jobs
+            for index, sha1sum in zip(upload_indexes, results):
+                sha1sums[index] = sha1sum
+
+        raise workers.Return(sha1sums)
+
+
 class FindRunWorkflow(workers.WorkflowItem):
     """Finds the last good run for a release.
 
@@ -244,6 +339,176 @@ class RequestRunWorkflow(workers.WorkflowItem):
             raise RequestRunError('Bad response: %r' % call)
 
 
+class RequestRunsWorkflow(workers.WorkflowItem):
+    """Requests the API server to do many test runs at once.
+
+    Sends the runs in batches of up to --request_runs_batch_size to
+    /api/request_runs instead of making one request for each run.
+
+    Args:
+        build_id: ID of the build.
+        release_name: Name of the release.
+        release_number: Number of the release candidate.
+        runs: List of dictionaries with the keys run_name, url, and
+            config_data, and the optional keys ref_url and ref_config_data,
+            which have the same meaning as for RequestRunWorkflow.
+
+    Raises:
+        RequestRunError if any of the runs could not be requested.
+    """
+
+    def run(self, build_id, release_name, release_number, runs):
+        pending = []
+        batch_size = max(1, FLAGS.request_runs_batch_size)
+        for i in xrange(0, len(runs), batch_size):
+            run_list = []
+            for run in runs[i:i + batch_size]:
+                run_dict = {
+                    'run_name': run['run_name'],
+                    'url': run['url'],
+                    'config': run['config_data'],
+                }
+                if run.get('ref_url') and run.get('ref_config_data'):
+                    run_dict.update(
+                        ref_url=run['ref_url'],
+                        ref_config=run['ref_config_data'])
+                run_list.append(run_dict)
+
+            pending.append(fetch_worker.FetchItem(
+                FLAGS.release_server_prefix + '/request_runs',
+                post={
+                    'build_id': build_id,
+                    'release_name': release_name,
+                    'release_number': release_number,
+                    'runs': json.dumps(run_list),
+                },
+                username=FLAGS.release_client_id,
+                password=FLAGS.release_client_secret))
+
+        calls = yield pending
+
+        for call in calls:
+            if call.json and call.json.get('error'):
+                raise RequestRunError(call.json.get('error'))
+
+            if not call.json or not call.json.get('success'):
+                raise RequestRunError('Bad response: %r' % call)
+
+
+class ReportRunItem(workers.WorkItem):
+    """Work item for reporting a run as part of a batch.
+
+    Args:
+        post: Dictionary of parameters for /api/report_run, including the
+            build_id, release_name, release_number, and run_name.
+
+    Returns:
+        Sets the status_code and json attributes to the response from the
+        /api/report_runs call that included this run.
+    """
+
+    def __init__(self, post):
+        workers.WorkItem.__init__(self)
+        self.post = post
+        self.status_code = None
+        self.json = None
+
+
+class ReportRunsThread(workers.WorkerThread):
+    """Worker thread that coalesces ReportRunItems into batched requests."""
+
+    def _get_batch(self, item):
+        batch = [item]
+        deadline = time.time() + FLAGS.report_runs_wait_seconds
+        while len(batch) < FLAGS.report_runs_batch_size:
+            wait_seconds = deadline - time.time()
+            if wait_seconds <= 0:
+                break
+            try:
+                next_item = self.input_queue.get(True, wait_seconds)
+            except Queue.Empty:
+                break
+            self.input_queue.task_done()
+            if not isinstance(next_item, ReportRunItem):
+                # Let the main loop handle wake-ups for stopping the thread.
+                self.input_queue.put(next_item)
+                break
+            batch.append(next_item)
+        return batch
+
+    def handle_item(self, item):
+        batch = self._get_batch(item)
+
+        # Only runs for the same release may be reported together.
+        releases = {}
+        for next_item in batch:
+            post = next_item.post
+            key = (post['build_id'], post['release_name'],
+                   post['release_number'])
+            releases.setdefault(key, []).append(next_item)
+
+        for (build_id, release_name, release_number), items in (
+                releases.iteritems()):
+            runs = []
+            for next_item in items:
+                run = next_item.post.copy()
+                del run['build_id']
+                del run['release_name']
+                del run['release_number']
+                runs.append(run)
+
+            LOGGER.info('Reporting %d runs for build_id=%r, '
+                        'release_name=%r, release_number=%r',
+                        len(runs), build_id, release_name, release_number)
+
+            try:
+                call = fetch_worker.fetch(fetch_worker.FetchItem(
+                    FLAGS.release_server_prefix + '/report_runs',
+                    post={
+                        'build_id': build_id,
+                        'release_name': release_name,
+                        'release_number': release_number,
+                        'runs': json.dumps(runs),
+                    },
+                    username=FLAGS.release_client_id,
+                    password=FLAGS.release_client_secret))
+            except Exception:
+                LOGGER.exception('Could not report runs for build_id=%r',
+                                 build_id)
+                error = sys.exc_info()
+                for next_item in items:
+                    next_item.error = error
+                continue
+
+            for next_item in items:
+                next_item.status_code = call.status_code
+                next_item.json = call.json
+
+        # The main loop marks the first item done and returns it. Do the same
+        # for the rest of the batch, which was pulled off the queue here.
+        for next_item in batch[1:]:
+            next_item.done = True
+            self.output_queue.put(next_item)
+
+        return item
+
+
+def _report_run(post):
+    """Returns a WorkItem that reports a run to the release server.
+
+    When --report_runs_batch_size is greater than one, the run is reported as
+    part of a batch. The returned item's json attribute is the response.
+    """
+    if FLAGS.report_runs_batch_size > 1:
+        return ReportRunItem(post)
+
+    return fetch_worker.FetchItem(
+        FLAGS.release_server_prefix + '/report_run',
+        post=post,
+        username=FLAGS.release_client_id,
+        password=FLAGS.release_client_secret)
+
+
 class ReportRunWorkflow(workers.WorkflowItem):
     """Reports a run as finished.
 
@@ -282,18 +547,16 @@ class ReportRunWorkflow(workers.WorkflowItem):
             raise ReportRunError(
                 'Cannot specify "baseline" along with any "ref_*" arguments.')
 
-        upload_jobs = [
-            UploadFileWorkflow(build_id, log_path),
-        ]
+        upload_paths = [log_path]
         if image_path:
-            image_index = len(upload_jobs)
-            upload_jobs.append(UploadFileWorkflow(build_id, image_path))
+            image_index = len(upload_paths)
+            upload_paths.append(image_path)
 
         if config_path:
-            config_index = len(upload_jobs)
-            upload_jobs.append(UploadFileWorkflow(build_id, config_path))
+            config_index = len(upload_paths)
+            upload_paths.append(config_path)
 
-        results = yield upload_jobs
+        results = yield UploadFilesWorkflow(build_id, upload_paths)
         log_id = results[0]
         image_id = None
         config_id = None
@@ -340,11 +603,7 @@ class ReportRunWorkflow(workers.WorkflowItem):
         if ref_config:
             post.update(ref_config=ref_config)
 
-        call = yield fetch_worker.FetchItem(
-            FLAGS.release_server_prefix + '/report_run',
-            post=post,
-            username=FLAGS.release_client_id,
-            password=FLAGS.release_client_secret)
+        call = yield _report_run(post)
 
         if call.json and call.json.get('error'):
             raise ReportRunError(call.json.get('error'))
@@ -365,25 +624,29 @@ class ReportPdiffWorkflow(workers.WorkflowItem):
         log_path: Path to the diff log to upload.
         diff_failed: True when there was a problem computing the diff. False
             when the diff was computed successfully. Defaults to False.
+        distortion: Optional. How different the images are.
+        parameters: Optional. Settings the diff was computed with, so the
+            server only reuses it for diffs made the same way.
+        regions: Optional. List of (left, top, right, bottom, pixels_changed)
+            for each changed region of the new image.
 
     Raises:
         ReportPdiffError if the pdiff status could not be reported.
     """
 
     def run(self, build_id, release_name, release_number, run_name,
-            diff_path=None, log_path=None, diff_failed=False, distortion=None):
+            diff_path=None, log_path=None, diff_failed=False, distortion=None,
+            parameters=None, regions=None):
         diff_id = None
         log_id = None
         if (isinstance(diff_path, basestring) and
                 os.path.isfile(diff_path) and
                 isinstance(log_path, basestring) and
                 os.path.isfile(log_path)):
-            diff_id, log_id = yield [
-                UploadFileWorkflow(build_id, diff_path),
-                UploadFileWorkflow(build_id, log_path),
-            ]
+            diff_id, log_id = yield UploadFilesWorkflow(
+                build_id, [diff_path, log_path])
         elif isinstance(log_path, basestring) and os.path.isfile(log_path):
-            log_id = yield UploadFileWorkflow(build_id, log_path)
+            log_id, = yield UploadFilesWorkflow(build_id, [log_path])
 
         post = {
             'build_id': build_id,
@@ -399,12 +662,12 @@ class ReportPdiffWorkflow(workers.WorkflowItem):
             post.update(diff_failed='yes')
         if distortion:
             post.update(distortion=distortion)
+        if parameters:
+            post.update(diff_parameters=parameters)
+        if regions:
+            post.update(diff_regions=json.dumps(regions))
 
-        call = yield fetch_worker.FetchItem(
-            FLAGS.release_server_prefix + '/report_run',
-            post=post,
-            username=FLAGS.release_client_id,
-            password=FLAGS.release_client_secret)
+        call = yield _report_run(post)
 
         if call.json and call.json.get('error'):
             raise ReportPdiffError(call.json.get('error'))
@@ -472,3 +735,11 @@ class DownloadArtifactWorkflow(workers.WorkflowItem):
             password=FLAGS.release_client_secret)
         if call.status_code != 200:
             raise DownloadArtifactError('Bad response: %r' % call)
+
+
+def register(coordinator):
+    """Registers this module as a worker with the given coordinator."""
+    report_queue = Queue.Queue()
+    coordinator.register(ReportRunItem, report_queue)
+    coordinator.worker_threads.append(
+        ReportRunsThread(report_queue, coordinator.input_queue))
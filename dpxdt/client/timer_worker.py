@@ -35,6 +35,33 @@ class TimerItem(workers.WorkItem):
         workers.WorkItem.__init__(self)
         self.delay_seconds = delay_seconds
         self.ready_time = time.time() + delay_seconds
+        self.waiting = False
+        self.fired = False
+
+    def _get_done(self):
+        return self.fired
+
+    def _set_done(self, done):
+        # Ignore the WorkerThread marking this item done as soon as it is
+        # handled; the timer is only done once the TimerThread fires it.
+        pass
+
+    done = property(_get_done, _set_done)
+
+    def start(self, wake):
+        """Called by the TimerThread when it starts waiting on this item.
+
+        Sub-classes may override this to stop waiting before the delay has
+        passed by calling wake(self) from any thread.
+        """
+        pass
+
+    def fire(self, output_queue):
+        """Called by the TimerThread once this timer is ready.
+
+        Sub-classes may override this to put other work on the queue.
+        """
+        output_queue.put(self)
 
 
 class TimerThread(workers.WorkerThread):
@@ -45,25 +72,44 @@ class TimerThread(workers.WorkerThread):
         workers.WorkerThread.__init__(self, *args)
         self.timers = []
 
+    def wake_early(self, item):
+        """Fires a timer that is being waited on right away.
+
+        Safe to call from any thread. Does nothing if the timer has
+        already fired.
+        """
+        item.ready_time = time.time()
+        self.input_queue.put(item)
+
     def handle_nothing(self):
         now = time.time()
         while self.timers:
-            ready_time, _ = self.timers[0]
+            ready_time, item = self.timers[0]
+            if item.fired:
+                # Already fired early; drop the original deadline.
+                heapq.heappop(self.timers)
+                continue
+
             wait_time = ready_time - now
             if wait_time <= 0:
-                _, item = heapq.heappop(self.timers)
-                self.output_queue.put(item)
+                heapq.heappop(self.timers)
+                item.fired = True
+                item.fire(self.output_queue)
             else:
                 # Wait for new work up to the point that the earliest
                 # timer is ready to fire.
                 self.polltime = wait_time
                 return
 
-        # Nothing to do, use the default poll time.
-        self.polltime = FLAGS.polltime
+        # Nothing to do, block until new work arrives.
+        self.polltime = None
 
     def handle_item(self, item):
-        heapq.heappush(self.timers, (item.ready_time, item))
+        if not item.fired:
+            heapq.heappush(self.timers, (item.ready_time, item))
+            if not item.waiting:
+                item.waiting = True
+                item.start(self.wake_early)
         self.handle_nothing()
 
 
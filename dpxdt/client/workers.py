@@ -31,8 +31,16 @@ LOGGER.setLevel(logging.INFO)
 
 gflags.DEFINE_float(
     'polltime', 1.0,
-    'How long to sleep between polling for work from an input queue, '
-    'a subprocess, or a waiting timer.')
+    'How long the main thread should block waiting for a finished root '
+    'workflow before checking for a keyboard interrupt.')
+
+
+# Put on a WorkerThread's input queue to wake it up when it should stop.
+_WAKEUP = object()
+
+# Returned by WorkerThread.handle_item when the item was handed off to be
+# finished later, so it must not be marked done yet.
+DEFERRED = object()
 
 
 class WorkItem(object):
@@ -117,13 +125,20 @@ class WorkerThread(threading.Thread):
         self.input_queue = input_queue
         self.output_queue = output_queue
         self.interrupted = False
-        self.polltime = FLAGS.polltime
+        # How long to block waiting for new work before calling
+        # handle_nothing(). None means to block until work arrives.
+        self.polltime = None
 
     def stop(self):
         """Stops the thread but does not join it."""
         if self.interrupted:
             return
         self.interrupted = True
+        self.wake()
+
+    def wake(self):
+        """Wakes up the thread if it's blocked waiting for new work."""
+        self.input_queue.put(_WAKEUP)
 
     def run(self):
         while not self.interrupted:
@@ -133,6 +148,10 @@ class WorkerThread(threading.Thread):
                 self.handle_nothing()
                 continue
 
+            if item is _WAKEUP:
+                self.input_queue.task_done()
+                continue
+
             try:
                 next_item = self.handle_item(item)
             except Exception as e:
@@ -140,6 +159,9 @@ class WorkerThread(threading.Thread):
                 LOGGER.exception('%s error item=%r', self.worker_name, item)
                 self.output_queue.put(item)
             else:
+                if next_item is DEFERRED:
+                    LOGGER.debug('%s deferred item=%r', self.worker_name, item)
+                    continue
                 LOGGER.debug('%s processed item=%r', self.worker_name, item)
                 if not isinstance(item, WorkflowItem):
                     item.done = True
@@ -153,7 +175,7 @@ class WorkerThread(threading.Thread):
         return '%s:%s' % (self.__class__.__name__, self.ident)
 
     def handle_nothing(self):
-        """Runs whenever there are no items in the queue."""
+        """Runs when no items arrived in the queue within the polltime."""
         pass
 
     def handle_item(self, item):
@@ -165,7 +187,8 @@ class WorkerThread(threading.Thread):
         Returns:
             A WorkItem that should go on the output queue. If None, then
             the provided work item is considered finished and no
-            additional work is needed.
+            additional work is needed. If DEFERRED, then the work item was
+            handed off elsewhere and will be finished later.
         """
         raise NotImplemented
 
@@ -346,6 +369,11 @@ class PendingBarriers(object):
         return target_queue
 
     def enqueue(self, barrier):
+        # Check this before handing out any work. Otherwise a worker thread
+        # may finish an item before the check below, causing the barrier to
+        # be reinjected here and again when the finished item is dequeued.
+        outstanding = barrier.outstanding
+
         for item in barrier:
             if item.done:
                 # Don't reenqueue items that are already done.
@@ -360,7 +388,7 @@ class PendingBarriers(object):
 
         # If the barrier has no oustanding items, immediately progress the
         # source workflow by reinjecting the barrier itself.
-        if not barrier.outstanding:
+        if not outstanding:
             LOGGER.debug('Immediately re-enqueuing finished barrier: %r',
                          barrier)
             target_queue = self._find_target_queue(barrier.workflow)
@@ -437,9 +465,15 @@ class WorkflowThread(WorkerThread):
         """Stops the coordinator thread and all related threads."""
         if self.interrupted:
             return
+        # Mark every thread as interrupted before waking any of them, since
+        # worker threads may share input queues and consume each other's
+        # wake-ups.
         for thread in self.worker_threads:
             thread.interrupted = True
         self.interrupted = True
+        for thread in self.worker_threads:
+            thread.wake()
+        self.wake()
 
     def join(self):
         """Joins the coordinator thread and all worker threads."""
@@ -450,8 +484,9 @@ class WorkflowThread(WorkerThread):
     def wait_one(self):
         """Waits until this worker has finished one work item or died."""
         while True:
+            # Use a timeout so the main thread can receive KeyboardInterrupt.
             try:
-                item = self.output_queue.get(True, self.polltime)
+                item = self.output_queue.get(True, FLAGS.polltime)
             except Queue.Empty:
                 continue
             except KeyboardInterrupt:
@@ -89,15 +89,18 @@ import time
 # Local libraries
 import flask
 from flask import Flask, abort, g, request, url_for
+from werkzeug.datastructures import MultiDict
 from werkzeug.exceptions import HTTPException
 
 # Local modules
 from . import app
 from . import db
 from dpxdt import constants
+from dpxdt.server import artifact_store
 from dpxdt.server import auth
 from dpxdt.server import emails
 from dpxdt.server import models
+from dpxdt.server import operations
 from dpxdt.server import signals
 from dpxdt.server import work_queue
 from dpxdt.server import utils
@@ -166,17 +169,16 @@ def _check_release_done_processing(release):
                      release.number)
         return False
 
-    query = models.Run.query.filter_by(release_id=release.id)
-    for run in query:
-        if run.status == models.Run.NEEDS_DIFF:
-            # Still waiting for the diff to finish.
-            return False
-        if run.ref_config and not run.ref_image:
-            # Still waiting for the ref capture to process.
-            return False
-        if run.config and not run.image:
-            # Still waiting for the run capture to process.
-            return False
+    stats = models.get_release_stats(release.id)
+    if stats.needs_diff:
+        # Still waiting for the diff to finish.
+        return False
+    if stats.pending_ref_captures:
+        # Still waiting for the ref capture to process.
+        return False
+    if stats.pending_captures:
+        # Still waiting for the run capture to process.
+        return False
 
     logging.info('Release done processing, now reviewing: build_id=%r, '
                  'name=%r, number=%d', release.build_id, release.name,
@@ -207,35 +209,25 @@ def _get_release_params():
 
 
 def _find_last_good_run(build):
-    """Finds the last good release and run for a build."""
+    """Finds the last good release and run for a build.
+
+    Returns:
+        Tuple (release, run) where run is a dictionary of the url, image,
+        log, and config of the run from BuildOps.get_last_good(). Either
+        may be None.
+    """
     run_name = request.form.get('run_name', type=str)
     utils.jsonify_assert(run_name, 'run_name required')
 
-    last_good_release = (
-        models.Release.query
-        .filter_by(
-            build_id=build.id,
-            status=models.Release.GOOD)
-        .order_by(models.Release.created.desc())
-        .first())
-
-    last_good_run = None
+    last_good_release, run_dict = operations.BuildOps(build.id).get_last_good()
+    last_good_run = run_dict.get(run_name)
 
-    if last_good_release:
-        logging.debug('Found last good release for: build_id=%r, '
-                      'release_name=%r, release_number=%d',
+    if last_good_run:
+        logging.debug('Found last good run for: build_id=%r, '
+                      'release_name=%r, release_number=%d, '
+                      'run_name=%r',
                       build.id, last_good_release.name,
-                      last_good_release.number)
-        last_good_run = (
-            models.Run.query
-            .filter_by(release_id=last_good_release.id, name=run_name)
-            .first())
-        if last_good_run:
-            logging.debug('Found last good run for: build_id=%r, '
-                          'release_name=%r, release_number=%d, '
-                          'run_name=%r',
-                          build.id, last_good_release.name,
-                          last_good_release.number, last_good_run.name)
+                      last_good_release.number, run_name)
 
     return last_good_release, last_good_run
 
@@ -253,26 +245,44 @@ def find_run():
             build_id=build.id,
             release_name=last_good_release.name,
             release_number=last_good_release.number,
-            run_name=last_good_run.name,
-            url=last_good_run.url,
-            image=last_good_run.image,
-            log=last_good_run.log,
-            config=last_good_run.config)
+            run_name=request.form.get('run_name', type=str),
+            url=last_good_run['url'],
+            image=last_good_run['image'],
+            log=last_good_run['log'],
+            config=last_good_run['config'])
 
     return utils.jsonify_error('Run not found')
 
 
-def _get_or_create_run(build):
-    """Gets a run for a build or creates it if it does not exist."""
+def _get_release(build):
+    """Gets the release for a build specified by the current request."""
     release_name, release_number = _get_release_params()
-    run_name = request.form.get('run_name', type=str)
-    utils.jsonify_assert(run_name, 'run_name required')
-
     release = (
         models.Release.query
         .filter_by(build_id=build.id, name=release_name, number=release_number)
         .first())
     utils.jsonify_assert(release, 'release does not exist')
+    return release
+
+
+def _create_run(build, release, run_name):
+    """Creates a new run for a release."""
+    logging.info('Created run: build_id=%r, release_name=%r, '
+                 'release_number=%d, run_name=%r',
+                 build.id, release.name, release.number, run_name)
+    run = models.Run(
+        release_id=release.id,
+        name=run_name,
+        status=models.Run.DATA_PENDING)
+    db.session.add(run)
+    return run
+
+
+def _get_or_create_run(build):
+    """Gets a run for a build or creates it if it does not exist."""
+    release = _get_release(build)
+    run_name = request.form.get('run_name', type=str)
+    utils.jsonify_assert(run_name, 'run_name required')
 
     run = (
         models.Run.query
@@ -280,21 +290,87 @@ def _get_or_create_run(build):
         .first())
     if not run:
         # Ignore re-reports of the same run name for this release.
-        logging.info('Created run: build_id=%r, release_name=%r, '
-                     'release_number=%d, run_name=%r',
-                     build.id, release.name, release.number, run_name)
-        run = models.Run(
-            release_id=release.id,
-            name=run_name,
-            status=models.Run.DATA_PENDING)
-        db.session.add(run)
+        run = _create_run(build, release, run_name)
         db.session.flush()
 
     return release, run
 
 
-def _enqueue_capture(build, release, run, url, config_data, baseline=False):
-    """Enqueues a task to run a capture process."""
+def _get_or_create_runs(build, release, run_names):
+    """Gets and locks many runs of a release, creating any that are missing.
+
+    Returns:
+        Dictionary mapping run name to models.Run.
+    """
+    run_names = set(run_names)
+    run_map = {}
+    if run_names:
+        query = (
+            models.Run.query
+            .filter_by(release_id=release.id)
+            .filter(models.Run.name.in_(run_names))
+            .with_lockmode('update'))
+        for run in query:
+            run_map[run.name] = run
+
+    for run_name in sorted(run_names - set(run_map)):
+        run_map[run_name] = _create_run(build, release, run_name)
+
+    db.session.flush()
+    return run_map
+
+
+def _get_viewport_run_names(run_name, config_data):
+    """Gets the names of the sibling runs for a multi-viewport config.
+
+    A config with a 'viewports' list is captured with one page load and
+    produces one screenshot per viewport, each recorded as its own run
+    named '<run_name>@<viewport name>'.
+
+    Returns:
+        List of run names in the same order as the viewports, or None if
+        the config is for a single viewport.
+    """
+    try:
+        config_dict = json.loads(config_data)
+    except Exception, e:
+        abort(utils.jsonify_error(e))
+
+    viewports = config_dict.get('viewports')
+    if not viewports:
+        return None
+
+    utils.jsonify_assert(
+        isinstance(viewports, list) and
+        all(isinstance(v, dict) and v.get('name') for v in viewports),
+        'viewports must be a list of objects with names')
+    run_names = ['%s@%s' % (run_name, v['name']) for v in viewports]
+    utils.jsonify_assert(
+        len(set(run_names)) == len(run_names),
+        'viewport names must be unique')
+    return run_names
+
+
+def _make_capture_task(build, release, run, url, config_data, baseline=False,
+                       config_artifacts=None, viewport_runs=None):
+    """Saves the config for a capture and sets it on the run.
+
+    Args:
+        build, release, run: Where the capture is for.
+        url: URL to capture.
+        config_data: JSON config for the capture.
+        baseline: True if this is the capture of the reference URL.
+        config_artifacts: Optional. Dictionary mapping config data to the
+            models.Artifact already saved for it during this request, so
+            identical configs are only saved once.
+        viewport_runs: Optional. List of sibling models.Run, one for each
+            viewport in the config, that all get their screenshots from
+            this capture. The run argument should be the first of these.
+
+    Returns:
+        Dictionary of keyword arguments for work_queue.add() that enqueue
+        the capture.
+    """
     # Validate the JSON config parses.
     try:
         config_dict = json.loads(config_data)
@@ -306,42 +382,69 @@ def _enqueue_capture(build, release, run, url, config_data, baseline=False):
     config_dict['targetUrl'] = url
     config_data = json.dumps(config_dict)
 
-    config_artifact = _save_artifact(build, config_data, 'application/json')
-    db.session.add(config_artifact)
-    db.session.flush()
+    if config_artifacts is None:
+        config_artifacts = {}
+    config_artifact = config_artifacts.get(config_data)
+    if not config_artifact:
+        config_artifact = _save_artifact(
+            build, config_data, 'application/json')
+        db.session.add(config_artifact)
+        db.session.flush()
+        config_artifacts[config_data] = config_artifact
 
     suffix = ''
     if baseline:
         suffix = ':baseline'
 
-    task_id = '%s:%s%s' % (run.id, hashlib.sha1(url).hexdigest(), suffix)
+    task_id = '%s:%s%s' % (
+        run.id, hashlib.sha1(url.encode('utf-8')).hexdigest(), suffix)
     logging.info('Enqueueing capture task=%r, baseline=%r', task_id, baseline)
 
-    work_queue.add(
-        constants.CAPTURE_QUEUE_NAME,
-        payload=dict(
-            build_id=build.id,
-            release_name=release.name,
-            release_number=release.number,
-            run_name=run.name,
-            url=url,
-            config_sha1sum=config_artifact.id,
-            baseline=baseline,
-        ),
+    # Set the URL and config early to indicate to report_run that there is
+    # still data pending even if 'image' and 'ref_image' are unset.
+    for target_run in viewport_runs or [run]:
+        if baseline:
+            target_run.ref_url = url
+            target_run.ref_config = config_artifact.id
+        else:
+            target_run.url = url
+            target_run.config = config_artifact.id
+
+    payload = dict(
+        build_id=build.id,
+        release_name=release.name,
+        release_number=release.number,
+        run_name=run.name,
+        url=url,
+        config_sha1sum=config_artifact.id,
+        baseline=baseline,
+    )
+    if viewport_runs:
+        payload['viewport_run_names'] = [r.name for r in viewport_runs]
+
+    return dict(
+        payload=payload,
         build_id=build.id,
         release_id=release.id,
         run_id=run.id,
         source='request_run',
         task_id=task_id)
 
-    # Set the URL and config early to indicate to report_run that there is
-    # still data pending even if 'image' and 'ref_image' are unset.
-    if baseline:
-        run.ref_url = url
-        run.ref_config = config_artifact.id
-    else:
-        run.url = url
-        run.config = config_artifact.id
+
+def _enqueue_capture(build, release, run, url, config_data, baseline=False):
+    """Enqueues a task to run a capture process."""
+    work_queue.add(
+        constants.CAPTURE_QUEUE_NAME,
+        **_make_capture_task(
+            build, release, run, url, config_data, baseline=baseline))
+
+
+def _set_last_good_ref(run, last_good_run):
+    """Uses the last good run as the reference for a run."""
+    run.ref_url = last_good_run['url']
+    run.ref_image = last_good_run['image']
+    run.ref_log = last_good_run['log']
+    run.ref_config = last_good_run['config']
 
 
 @app.route('/api/request_run', methods=['POST'])
@@ -356,8 +459,11 @@ def request_run():
     config_data = request.form.get('config', default='{}', type=str)
     utils.jsonify_assert(current_url, 'url to capture required')
     utils.jsonify_assert(config_data, 'config document required')
+    utils.jsonify_assert(
+        not _get_viewport_run_names(current_run.name, config_data),
+        'use /api/request_runs to capture multiple viewports')
 
-    config_artifact = _enqueue_capture(
+    _enqueue_capture(
         build, current_release, current_run, current_url, config_data)
 
     ref_url = request.form.get('ref_url', type=str)
@@ -367,16 +473,13 @@ def request_run():
         'ref_url and ref_config must both be specified or not specified')
 
     if ref_url and ref_config_data:
-        ref_config_artifact = _enqueue_capture(
+        _enqueue_capture(
             build, current_release, current_run, ref_url, ref_config_data,
             baseline=True)
     else:
         _, last_good_run = _find_last_good_run(build)
         if last_good_run:
-            current_run.ref_url = last_good_run.url
-            current_run.ref_image = last_good_run.image
-            current_run.ref_log = last_good_run.log
-            current_run.ref_config = last_good_run.config
+            _set_last_good_ref(current_run, last_good_run)
 
     db.session.add(current_run)
     db.session.commit()
@@ -396,32 +499,167 @@ def request_run():
         ref_config=current_run.ref_config)
 
 
-@app.route('/api/report_run', methods=['POST'])
+@app.route('/api/request_runs', methods=['POST'])
 @auth.build_api_access_required
 @utils.retryable_transaction()
-def report_run():
-    """Reports data for a run for a release candidate."""
+def request_runs():
+    """Requests many new runs for a release candidate at once.
+
+    The 'runs' parameter is a JSON list of objects with the same run_name,
+    url, config, ref_url, and ref_config parameters as /request_run takes.
+    The last good release comes from the build's cache, identical configs are
+    only saved once, and all of the captures are enqueued together.
+
+    A config with a 'viewports' list requests one sibling run per viewport,
+    all captured from a single page load. Its ref_config, if any, must list
+    the same viewports.
+    """
     build = g.build
-    release, run = _get_or_create_run(build)
+    release = _get_release(build)
 
-    db.session.refresh(run, lockmode='update')
+    try:
+        run_requests = json.loads(request.form.get('runs', type=str) or '')
+    except ValueError, e:
+        abort(utils.jsonify_error(e))
+    utils.jsonify_assert(
+        isinstance(run_requests, list), 'runs must be a list')
+
+    all_run_names = []
+    for run_request in run_requests:
+        utils.jsonify_assert(
+            isinstance(run_request, dict) and run_request.get('run_name'),
+            'run_name required for each run')
+        for key in ('url', 'config', 'ref_url', 'ref_config'):
+            utils.jsonify_assert(
+                isinstance(run_request.get(key) or '', basestring),
+                '%s must be a string' % key)
+        utils.jsonify_assert(
+            run_request.get('url'), 'url to capture required')
+        utils.jsonify_assert(
+            bool(run_request.get('ref_url')) ==
+            bool(run_request.get('ref_config')),
+            'ref_url and ref_config must both be specified or not specified')
+
+        run_name = run_request['run_name']
+        viewport_run_names = _get_viewport_run_names(
+            run_name, run_request.get('config') or '{}')
+        if run_request.get('ref_url'):
+            utils.jsonify_assert(
+                viewport_run_names == _get_viewport_run_names(
+                    run_name, run_request['ref_config']),
+                'ref_config must have the same viewports as config')
+
+        run_request['viewport_run_names'] = viewport_run_names
+        all_run_names.extend(viewport_run_names or [run_name])
+
+    run_map = _get_or_create_runs(build, release, all_run_names)
+    _, last_good_map = operations.BuildOps(build.id).get_last_good()
+
+    config_artifacts = {}
+    task_list = []
+    for run_request in run_requests:
+        viewport_runs = None
+        if run_request['viewport_run_names']:
+            viewport_runs = [
+                run_map[name] for name in run_request['viewport_run_names']]
+            runs = viewport_runs
+        else:
+            runs = [run_map[run_request['run_name']]]
+
+        task_list.append(_make_capture_task(
+            build, release, runs[0],
+            run_request['url'],
+            run_request.get('config') or '{}',
+            config_artifacts=config_artifacts,
+            viewport_runs=viewport_runs))
+
+        if run_request.get('ref_url'):
+            task_list.append(_make_capture_task(
+                build, release, runs[0],
+                run_request['ref_url'],
+                run_request['ref_config'],
+                baseline=True,
+                config_artifacts=config_artifacts,
+                viewport_runs=viewport_runs))
+        else:
+            for run in runs:
+                last_good_run = last_good_map.get(run.name)
+                if last_good_run:
+                    _set_last_good_ref(run, last_good_run)
+
+        for run in runs:
+            db.session.add(run)
+
+    work_queue.add_many(constants.CAPTURE_QUEUE_NAME, task_list)
+    db.session.commit()
 
-    current_url = request.form.get('url', type=str)
-    current_image = request.form.get('image', type=str)
-    current_log = request.form.get('log', type=str)
-    current_config = request.form.get('config', type=str)
+    signals.release_updated_via_api.send(app, build=build, release=release)
 
-    ref_url = request.form.get('ref_url', type=str)
-    ref_image = request.form.get('ref_image', type=str)
-    ref_log = request.form.get('ref_log', type=str)
-    ref_config = request.form.get('ref_config', type=str)
+    logging.info('Requested %d runs: build_id=%r, release_name=%r, '
+                 'release_number=%d', len(all_run_names), build.id,
+                 release.name, release.number)
+
+    return flask.jsonify(success=True, run_count=len(all_run_names))
+
+
+def _get_diff_regions(params):
+    """Returns the diff_regions parameter as a JSON string, or None.
+
+    The parameter is a JSON list when it comes from a report_run form, or
+    may be the list itself in a report_runs report.
+    """
+    diff_regions = params.get('diff_regions')
+    if not diff_regions:
+        return None
+
+    if isinstance(diff_regions, basestring):
+        try:
+            diff_regions = json.loads(diff_regions)
+        except ValueError, e:
+            abort(utils.jsonify_error(e))
+
+    utils.jsonify_assert(
+        isinstance(diff_regions, list) and all(
+            isinstance(region, list) and len(region) == 5 and
+            all(isinstance(x, (int, long)) for x in region)
+            for region in diff_regions),
+        'diff_regions must be a list of '
+        '[left, top, right, bottom, pixels_changed]')
+    return json.dumps(diff_regions)
+
+
+def _update_run(build, release, run, params):
+    """Updates a run with data reported by a worker.
+
+    Args:
+        build: Build the run is part of.
+        release: Release the run is part of.
+        run: Run to update.
+        params: Dictionary-like object with the parameters documented for
+            /api/report_run, such as the request form.
+
+    Returns:
+        The pdiff task to enqueue with work_queue.add_many() if the run
+        needs a diff, or None otherwise.
+    """
+    current_url = params.get('url', type=str)
+    current_image = params.get('image', type=str)
+    current_log = params.get('log', type=str)
+    current_config = params.get('config', type=str)
+
+    ref_url = params.get('ref_url', type=str)
+    ref_image = params.get('ref_image', type=str)
+    ref_log = params.get('ref_log', type=str)
+    ref_config = params.get('ref_config', type=str)
 
-    diff_failed = request.form.get('diff_failed', type=str)
-    diff_image = request.form.get('diff_image', type=str)
-    diff_log = request.form.get('diff_log', type=str)
+    diff_failed = params.get('diff_failed', type=str)
+    diff_image = params.get('diff_image', type=str)
+    diff_log = params.get('diff_log', type=str)
 
-    distortion = request.form.get('distortion', default=None, type=float)
-    run_failed = request.form.get('run_failed', type=str)
+    distortion = params.get('distortion', default=None, type=float)
+    diff_regions = _get_diff_regions(params)
+    diff_parameters = params.get('diff_parameters', type=str)
+    run_failed = params.get('run_failed', type=str)
 
     if current_url:
         run.url = current_url
@@ -459,6 +697,8 @@ def report_run():
         run.diff_log = diff_log
     if distortion:
         run.distortion = distortion
+    if diff_regions:
+        run.diff_regions = diff_regions
 
     if diff_image or diff_log:
         logging.info('Saved pdiff: build_id=%r, release_name=%r, '
@@ -467,8 +707,18 @@ def report_run():
                      build.id, release.name, release.number, run.name,
                      run.diff_image, run.diff_log, diff_failed, distortion)
 
+    if (run.image and run.ref_image and run.image != run.ref_image and
+            not run.diff_log):
+        _reuse_pdiff_result(build, release, run)
+    elif (run.image and run.ref_image and run.diff_log and
+            (diff_image or diff_log) and not diff_failed):
+        _save_pdiff_result(run, diff_parameters)
+
     if run.image and run.diff_image:
         run.status = models.Run.DIFF_FOUND
+    elif run.image and run.ref_image and run.image == run.ref_image:
+        # Byte-identical screenshots can't have any differences.
+        run.status = models.Run.DIFF_NOT_FOUND
     elif run.image and run.ref_image and not run.diff_log:
         run.status = models.Run.NEEDS_DIFF
     elif run.image and run.ref_image and not diff_failed:
@@ -488,24 +738,116 @@ def report_run():
     # and still see private data in the diff image.
 
     if run.status == models.Run.NEEDS_DIFF:
-        task_id = '%s:%s:%s' % (run.id, run.image, run.ref_image)
-        logging.info('Enqueuing pdiff task=%r', task_id)
-
-        work_queue.add(
-            constants.PDIFF_QUEUE_NAME,
-            payload=dict(
-                build_id=build.id,
-                release_name=release.name,
-                release_number=release.number,
-                run_name=run.name,
-                run_sha1sum=run.image,
-                reference_sha1sum=run.ref_image,
-            ),
+        return _make_pdiff_task(build, release, run)
+    return None
+
+
+def _add_artifact_owners(build, artifact_ids):
+    """Gives a build ownership of existing artifacts it doesn't own yet."""
+    ownership = models.artifact_ownership_table
+    owned = set(
+        artifact_id for artifact_id, in
+        db.session.query(ownership.c.artifact)
+        .filter(ownership.c.build_id == build.id)
+        .filter(ownership.c.artifact.in_(artifact_ids)))
+    new_owners = [
+        dict(artifact=artifact_id, build_id=build.id)
+        for artifact_id in set(artifact_ids) if artifact_id not in owned]
+    if new_owners:
+        db.session.execute(ownership.insert(), new_owners)
+
+
+def _reuse_pdiff_result(build, release, run):
+    """Copies a saved diff of the run's images to the run, if there is one.
+
+    Returns:
+        True if a saved result was found, False otherwise.
+    """
+    if not app.config['PDIFF_REUSE_RESULTS']:
+        return False
+
+    result = models.PdiffResult.query.get(
+        (run.ref_image, run.image, app.config['PDIFF_PARAMETERS']))
+    if not result:
+        return False
+
+    run.diff_image = result.diff_image
+    run.diff_log = result.diff_log
+    run.distortion = result.distortion
+    run.diff_regions = result.diff_regions
+
+    # The diff may have been computed for another build.
+    _add_artifact_owners(
+        build, [x for x in (result.diff_image, result.diff_log) if x])
+
+    logging.info('Reusing pdiff: build_id=%r, release_name=%r, '
+                 'release_number=%d, run_name=%r, diff_image=%r, '
+                 'diff_log=%r, distortion=%r',
+                 build.id, release.name, release.number, run.name,
+                 run.diff_image, run.diff_log, run.distortion)
+    return True
+
+
+def _save_pdiff_result(run, parameters):
+    """Saves the diff of the run's images so other runs can reuse it.
+
+    Args:
+        run: Run with a finished diff.
+        parameters: Settings the pdiff worker reported for the diff. Diffs
+            from workers that don't report them are not saved.
+    """
+    if not app.config['PDIFF_REUSE_RESULTS'] or not parameters:
+        return
+
+    # Another worker may have saved the same diff already.
+    utils.insert_unless_exists(
+        db.session,
+        models.PdiffResult.__table__.insert().values(
+            ref_image=run.ref_image,
+            image=run.image,
+            parameters=parameters,
+            diff_image=run.diff_image,
+            diff_log=run.diff_log,
+            distortion=run.distortion,
+            diff_regions=run.diff_regions))
+
+
+def _make_pdiff_task(build, release, run):
+    """Returns the work_queue.add_many() task to diff a run against its
+    reference.
+    """
+    task_id = '%s:%s:%s' % (run.id, run.image, run.ref_image)
+    logging.info('Enqueuing pdiff task=%r', task_id)
+
+    return dict(
+        payload=dict(
             build_id=build.id,
-            release_id=release.id,
-            run_id=run.id,
-            source='report_run',
-            task_id=task_id)
+            release_name=release.name,
+            release_number=release.number,
+            run_name=run.name,
+            run_sha1sum=run.image,
+            reference_sha1sum=run.ref_image,
+        ),
+        build_id=build.id,
+        release_id=release.id,
+        run_id=run.id,
+        source='report_run',
+        task_id=task_id)
+
+
+@app.route('/api/report_run', methods=['POST'])
+@auth.build_api_access_required
+@utils.retryable_transaction()
+def report_run():
+    """Reports data for a run for a release candidate."""
+    build = g.build
+    release, run = _get_or_create_run(build)
+
+    db.session.refresh(run, lockmode='update')
+
+    pdiff_task = _update_run(build, release, run, request.form)
+    if pdiff_task:
+        work_queue.add_many(constants.PDIFF_QUEUE_NAME, [pdiff_task])
 
     # Flush the run so querying for Runs in _check_release_done_processing
     # will be find the new run too and we won't deadlock.
@@ -525,6 +867,61 @@ def report_run():
     return flask.jsonify(success=True)
 
 
+@app.route('/api/report_runs', methods=['POST'])
+@auth.build_api_access_required
+@utils.retryable_transaction()
+def report_runs():
+    """Reports data for many runs of a release candidate at once.
+
+    All of the runs are updated in a single transaction and the release is
+    only checked for being done processing once at the end.
+    """
+    build = g.build
+    release = _get_release(build)
+
+    try:
+        reports = json.loads(request.form.get('runs', type=str) or '')
+    except ValueError, e:
+        abort(utils.jsonify_error(e))
+    utils.jsonify_assert(isinstance(reports, list), 'runs must be a list')
+
+    for report in reports:
+        utils.jsonify_assert(
+            isinstance(report, dict) and report.get('run_name'),
+            'run_name required for each run')
+
+    run_map = _get_or_create_runs(
+        build, release, [report['run_name'] for report in reports])
+
+    pdiff_tasks = []
+    for report in reports:
+        run = run_map[report['run_name']]
+        # Skip values that are missing, the same as in a report_run form.
+        params = MultiDict(
+            (key, value) for key, value in report.iteritems()
+            if value is not None and value is not False)
+        pdiff_task = _update_run(build, release, run, params)
+        if pdiff_task:
+            pdiff_tasks.append(pdiff_task)
+        db.session.add(run)
+
+    if pdiff_tasks:
+        work_queue.add_many(constants.PDIFF_QUEUE_NAME, pdiff_tasks)
+
+    db.session.flush()
+
+    _check_release_done_processing(release)
+    db.session.commit()
+
+    signals.release_updated_via_api.send(app, build=build, release=release)
+
+    logging.info('Updated %d runs: build_id=%r, release_name=%r, '
+                 'release_number=%d', len(reports), build.id, release.name,
+                 release.number)
+
+    return flask.jsonify(success=True, run_count=len(reports))
+
+
 @app.route('/api/runs_done', methods=['POST'])
 @auth.build_api_access_required
 @utils.retryable_transaction()
@@ -573,8 +970,25 @@ def _artifact_created(artifact):
 
 
 def _save_artifact(build, data, content_type):
-    """Saves an artifact to the DB and returns it."""
-    sha1sum = hashlib.sha1(data).hexdigest()
+    """Saves an artifact to the DB and returns it.
+
+    When the artifact store is enabled, the data is streamed to disk while
+    its hash is computed and only its location is saved in the DB.
+
+    Args:
+        build: Build that will own the artifact.
+        data: String of data or a file-like object to read it from.
+        content_type: MIME type of the data.
+    """
+    alternate = None
+    if artifact_store.is_enabled():
+        sha1sum, alternate = artifact_store.save(data)
+        data = None
+    else:
+        if not isinstance(data, basestring):
+            data = data.read()
+        sha1sum = hashlib.sha1(data).hexdigest()
+
     artifact = models.Artifact.query.filter_by(id=sha1sum).first()
 
     if artifact:
@@ -585,7 +999,8 @@ def _save_artifact(build, data, content_type):
       artifact = models.Artifact(
           id=sha1sum,
           content_type=content_type,
-          data=data)
+          data=data,
+          alternate=alternate)
       _artifact_created(artifact)
 
     artifact.owners.append(build)
@@ -602,10 +1017,9 @@ def upload():
                          'Need exactly one uploaded file')
 
     file_storage = request.files.values()[0]
-    data = file_storage.read()
     content_type, _ = mimetypes.guess_type(file_storage.filename)
 
-    artifact = _save_artifact(build, data, content_type)
+    artifact = _save_artifact(build, file_storage.stream, content_type)
 
     db.session.add(artifact)
     db.session.commit()
@@ -617,15 +1031,63 @@ def upload():
         content_type=content_type)
 
 
+@app.route('/api/has_artifacts', methods=['POST'])
+@auth.build_api_access_required
+def has_artifacts():
+    """Finds which of the given artifacts the build already has.
+
+    The 'sha1sums' parameter is a JSON list of artifact IDs. Only artifacts
+    the build owns are found, so the client only needs to upload the ones
+    missing from the response. Artifacts that only other builds own are
+    reported as missing; the build must upload them to prove it has their
+    contents, or this would be a way to get any build's files by hash.
+    """
+    build = g.build
+
+    try:
+        sha1sums = json.loads(request.form.get('sha1sums', type=str) or '')
+    except ValueError, e:
+        abort(utils.jsonify_error(e))
+    utils.jsonify_assert(
+        isinstance(sha1sums, list), 'sha1sums must be a list')
+
+    found = []
+    if sha1sums:
+        # Only select IDs so the artifact data is never loaded.
+        ownership = models.artifact_ownership_table
+        found = [
+            artifact_id for artifact_id, in
+            db.session.query(ownership.c.artifact)
+            .filter(ownership.c.build_id == build.id)
+            .filter(ownership.c.artifact.in_(sha1sums))
+            .distinct()]
+
+    logging.debug('Found %d of %d artifacts for build_id=%r',
+                  len(found), len(sha1sums), build.id)
+
+    return flask.jsonify(
+        success=True,
+        build_id=build.id,
+        sha1sums=found)
+
+
 def _get_artifact_response(artifact):
     """Gets the response object for the given artifact.
 
     This method may be overridden in environments that have a different way of
     storing artifact files, such as on-disk or S3.
     """
-    response = flask.Response(
-        artifact.data,
-        mimetype=artifact.content_type)
+    if artifact_store.is_stored(artifact.alternate):
+        # Serves the file with X-Sendfile when the USE_X_SENDFILE config
+        # value is set, or by streaming it with the WSGI file wrapper.
+        response = flask.send_file(
+            artifact_store.get_path(artifact.alternate),
+            mimetype=artifact.content_type,
+            add_etags=False)
+    else:
+        response = flask.Response(
+            artifact.data,
+            mimetype=artifact.content_type)
     response.cache_control.public = True
     response.cache_control.max_age = 8640000
     response.set_etag(artifact.id)
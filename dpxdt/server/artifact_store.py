@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# Copyright 2013 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Content-addressed storage for artifacts on the local filesystem.
+
+When the ARTIFACT_STORE_PATH config value is set, artifact contents are
+written to files under that directory instead of into the Artifact.data
+column. Files are named by their SHA1 hash and sharded into two levels of
+sub-directories, like 'ab/cd/abcdef0123...'. The Artifact.alternate field
+holds the 'file:' prefix followed by the path relative to the store.
+
+Writes go to a temporary file in the same directory tree first and are
+renamed into place, so readers never see a partially written artifact.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+
+# Local modules
+from . import app
+
+
+# Prefix for Artifact.alternate values that point into this store.
+ALTERNATE_PREFIX = 'file:'
+
+# How many bytes to read at a time when streaming data into the store.
+CHUNK_SIZE = 64 * 1024
+
+
+def is_enabled():
+    """Returns True if artifacts should be saved to the filesystem."""
+    return bool(app.config.get('ARTIFACT_STORE_PATH'))
+
+
+def _get_root():
+    return os.path.abspath(app.config['ARTIFACT_STORE_PATH'])
+
+
+def _get_relative_path(sha1sum):
+    return os.path.join(sha1sum[:2], sha1sum[2:4], sha1sum)
+
+
+def is_stored(alternate):
+    """Returns True if the Artifact.alternate value points to this store."""
+    return bool(alternate) and alternate.startswith(ALTERNATE_PREFIX)
+
+
+def get_path(alternate):
+    """Returns the absolute path of a file given its Artifact.alternate."""
+    assert is_stored(alternate), 'Not in artifact store: %r' % alternate
+    relative_path = alternate[len(ALTERNATE_PREFIX):]
+    return os.path.join(_get_root(), relative_path)
+
+
+def _iter_chunks(source):
+    if isinstance(source, basestring):
+        yield source
+        return
+
+    while True:
+        chunk = source.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+def save(source):
+    """Saves data to the store while computing its content hash.
+
+    Args:
+        source: String of data or a file-like object to stream from.
+
+    Returns:
+        Tuple (sha1sum, alternate) where alternate is the value to save in
+        the Artifact.alternate field.
+    """
+    root = _get_root()
+    temp_dir = os.path.join(root, 'tmp')
+    if not os.path.isdir(temp_dir):
+        try:
+            os.makedirs(temp_dir)
+        except OSError:
+            # Another thread or process may have created it concurrently.
+            if not os.path.isdir(temp_dir):
+                raise
+
+    hasher = hashlib.sha1()
+    handle, temp_path = tempfile.mkstemp(dir=temp_dir)
+    try:
+        with os.fdopen(handle, 'wb') as output_file:
+            for chunk in _iter_chunks(source):
+                hasher.update(chunk)
+                output_file.write(chunk)
+            output_file.flush()
+            os.fsync(output_file.fileno())
+
+        sha1sum = hasher.hexdigest()
+        relative_path = _get_relative_path(sha1sum)
+        final_path = os.path.join(root, relative_path)
+
+        if os.path.exists(final_path):
+            logging.debug('Artifact already in store: sha1sum=%r', sha1sum)
+            os.remove(temp_path)
+        else:
+            final_dir = os.path.dirname(final_path)
+            if not os.path.isdir(final_dir):
+                try:
+                    os.makedirs(final_dir)
+                except OSError:
+                    if not os.path.isdir(final_dir):
+                        raise
+            os.rename(temp_path, final_path)
+            logging.debug('Saved artifact to store: sha1sum=%r, path=%r',
+                          sha1sum, final_path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    return sha1sum, ALTERNATE_PREFIX + relative_path
@@ -56,6 +56,48 @@ MAIL_SUPPRESS_SEND = True
 # Cloud storage; currently only works in App Engine deployment
 GOOGLE_CLOUD_STORAGE_BUCKET = None
 
+# Directory for storing artifacts on the local filesystem instead of in the
+# database. Set USE_X_SENDFILE to True when a frontend like Apache or nginx
+# can serve these files directly.
+ARTIFACT_STORE_PATH = None
+
+# Longest time a work queue lease request may wait for new tasks to be
+# added before returning empty. Set to 0 to disable long polling, which
+# must be done when the server can only handle one request at a time.
+WORK_QUEUE_MAX_LEASE_WAIT_SECONDS = 30
+
+# How often a waiting lease request checks the database for tasks added by
+# other server processes or leases that have expired. The check reads one
+# row of an index and only runs a full lease when it finds a task.
+WORK_QUEUE_LEASE_RECHECK_SECONDS = 5
+
+# How work queue leases lock tasks: 'select_for_update', 'skip_locked', or
+# 'atomic_claim'. See work_queue.lease. None picks one for the database.
+WORK_QUEUE_LEASE_STRATEGY = None
+
+# Finished work queue tasks are deleted this many days after they were
+# created, when a queue worker run with --queue_reap_seconds asks the
+# server to reap them.
+WORK_QUEUE_RETENTION_DAYS = 14
+
+# Most finished tasks to delete in one transaction while reaping, and most
+# transactions to run for each reap request.
+WORK_QUEUE_REAP_BATCH_SIZE = 500
+WORK_QUEUE_REAP_MAX_BATCHES = 20
+
+# Copy reaped tasks to the work_queue_archive table instead of discarding
+# them.
+WORK_QUEUE_ARCHIVE = False
+
+# Reuse the saved result of diffing the same reference and new image, from
+# any build, instead of enqueueing another pdiff task.
+PDIFF_REUSE_RESULTS = True
+
+# Saved diffs are only reused if the pdiff worker that computed them
+# reported these settings, which come from its --pdiff_engine and
+# --pdiff_tile_size flags. Match this to how your pdiff workers run.
+PDIFF_PARAMETERS = 'engine=numpy,tile_size=0'
+
 SHOW_VIDEO_AND_PROMO_TEXT = False
 
 # Secret key for CSRF key for WTForms, Login cookie. This will only last
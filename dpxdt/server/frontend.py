@@ -199,6 +199,7 @@ def view_release():
         db.session.commit()
 
         ops.evict()
+        ops.evict_last_good()
 
         return redirect(url_for(
             'view_release',
@@ -17,9 +17,14 @@
 
 import datetime
 
+# Local libraries
+import sqlalchemy
+from sqlalchemy.orm import attributes
+
 # Local modules
 from . import app
 from . import db
+from . import utils
 
 
 class User(db.Model):
@@ -184,21 +189,36 @@ class Run(db.Model):
     created = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     modified = db.Column(db.DateTime, default=datetime.datetime.utcnow,
                          onupdate=datetime.datetime.utcnow)
-    status = db.Column(db.Enum(*STATES, name='run_states'), nullable=False)
-
-    image = db.Column(db.String(100), db.ForeignKey('artifact.id'))
+    # The columns counted by ReleaseStats load their old value before
+    # they're changed, so the old counts can be taken away on flush.
+    status = db.column_property(
+        db.Column(db.Enum(*STATES, name='run_states'), nullable=False),
+        active_history=True)
+
+    image = db.column_property(
+        db.Column(db.String(100), db.ForeignKey('artifact.id')),
+        active_history=True)
     log = db.Column(db.String(100), db.ForeignKey('artifact.id'))
-    config = db.Column(db.String(100), db.ForeignKey('artifact.id'))
+    config = db.column_property(
+        db.Column(db.String(100), db.ForeignKey('artifact.id')),
+        active_history=True)
     url = db.Column(db.String(2048))
 
-    ref_image = db.Column(db.String(100), db.ForeignKey('artifact.id'))
+    ref_image = db.column_property(
+        db.Column(db.String(100), db.ForeignKey('artifact.id')),
+        active_history=True)
     ref_log = db.Column(db.String(100), db.ForeignKey('artifact.id'))
-    ref_config = db.Column(db.String(100), db.ForeignKey('artifact.id'))
+    ref_config = db.column_property(
+        db.Column(db.String(100), db.ForeignKey('artifact.id')),
+        active_history=True)
     ref_url = db.Column(db.String(2048))
 
     diff_image = db.Column(db.String(100), db.ForeignKey('artifact.id'))
     diff_log = db.Column(db.String(100), db.ForeignKey('artifact.id'))
     distortion = db.Column(db.Float())
+    # JSON list of [left, top, right, bottom, pixels_changed] for each
+    # changed region, when the pdiff worker diffed by tiles.
+    diff_regions = db.Column(db.Text())
 
     tasks = db.relationship('WorkQueue',
                             lazy='joined',
@@ -210,6 +230,208 @@ class Run(db.Model):
         return 'Run(id=%r)' % self.id
 
 
+class ReleaseStats(db.Model):
+    """Counts of the runs in a release by their status.
+
+    Kept up to date in the same transaction as any change to a Run, so
+    reading the progress of a release doesn't require scanning its runs.
+    """
+
+    release_id = db.Column(db.Integer, db.ForeignKey('release.id'),
+                           primary_key=True)
+
+    # Runs by status; the column names match the Run status values.
+    data_pending = db.Column(db.Integer, default=0, nullable=False)
+    diff_approved = db.Column(db.Integer, default=0, nullable=False)
+    diff_found = db.Column(db.Integer, default=0, nullable=False)
+    diff_not_found = db.Column(db.Integer, default=0, nullable=False)
+    failed = db.Column(db.Integer, default=0, nullable=False)
+    needs_diff = db.Column(db.Integer, default=0, nullable=False)
+    no_diff_needed = db.Column(db.Integer, default=0, nullable=False)
+
+    # Runs that have a capture config but no image yet.
+    pending_captures = db.Column(db.Integer, default=0, nullable=False)
+    # Runs that have a reference capture config but no reference image yet.
+    pending_ref_captures = db.Column(db.Integer, default=0, nullable=False)
+
+    COUNTERS = frozenset(
+        list(Run.STATES) + ['pending_captures', 'pending_ref_captures'])
+
+    def get_status_counts(self):
+        """Returns a dictionary mapping Run status to number of runs."""
+        return dict((status, getattr(self, status)) for status in Run.STATES)
+
+    # For flask-cache memoize key.
+    def __repr__(self):
+        return 'ReleaseStats(release_id=%r)' % self.release_id
+
+
+class PdiffResult(db.Model):
+    """Result of a perceptual diff between two images, for any build.
+
+    Lets runs with the same reference and new image reuse an earlier diff
+    instead of enqueueing another pdiff task.
+    """
+
+    ref_image = db.Column(db.String(100), db.ForeignKey('artifact.id'),
+                          primary_key=True)
+    image = db.Column(db.String(100), db.ForeignKey('artifact.id'),
+                      primary_key=True)
+    # The settings the pdiff worker reported for the diff.
+    parameters = db.Column(db.String(100), primary_key=True)
+
+    created = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    diff_image = db.Column(db.String(100), db.ForeignKey('artifact.id'))
+    diff_log = db.Column(db.String(100), db.ForeignKey('artifact.id'))
+    distortion = db.Column(db.Float())
+    diff_regions = db.Column(db.Text())
+
+    # For flask-cache memoize key.
+    def __repr__(self):
+        return 'PdiffResult(ref_image=%r, image=%r, parameters=%r)' % (
+            self.ref_image, self.image, self.parameters)
+
+
+def _get_run_counters(status, config, image, ref_config, ref_image):
+    """Returns the ReleaseStats counters that a Run's state contributes to."""
+    counters = []
+    if status:
+        counters.append(status)
+    if config and not image:
+        counters.append('pending_captures')
+    if ref_config and not ref_image:
+        counters.append('pending_ref_captures')
+    return counters
+
+
+_RUN_COUNTER_FIELDS = ('status', 'config', 'image', 'ref_config', 'ref_image')
+
+
+def _get_committed_value(run, field):
+    """Returns the value of a Run field before the current flush."""
+    history = attributes.get_history(run, field)
+    if history.deleted:
+        return history.deleted[0]
+    if history.unchanged:
+        return history.unchanged[0]
+    # The counted fields have active_history, so one that was changed always
+    # has its old value in the history.
+    assert not history.added, 'No old value for Run.%s' % field
+    return getattr(run, field)
+
+
+def get_release_stats(release_id):
+    """Returns the up-to-date ReleaseStats for a release.
+
+    Creates the stats by scanning the release's runs if they are missing,
+    such as for releases created before ReleaseStats existed.
+    """
+    query = ReleaseStats.query.populate_existing()
+    stats = query.get(release_id)
+    if stats is None:
+        _insert_release_stats(db.session, release_id)
+        # Lock the row so the read sees it even if another transaction
+        # inserted it first.
+        stats = query.with_lockmode('read').get(release_id)
+    return stats
+
+
+def _insert_release_stats(session, release_id):
+    """Inserts stats for a release by counting all of its runs.
+
+    Returns:
+        True if the stats were inserted, False if another transaction
+        inserted them first.
+    """
+    values = dict((counter, 0) for counter in ReleaseStats.COUNTERS)
+    with session.no_autoflush:
+        query = (
+            session.query(
+                Run.status, Run.config, Run.image, Run.ref_config,
+                Run.ref_image)
+            .filter_by(release_id=release_id))
+        for run_values in query:
+            for counter in _get_run_counters(*run_values):
+                values[counter] += 1
+
+    # Two transactions may both find the stats missing.
+    return utils.insert_unless_exists(
+        session,
+        ReleaseStats.__table__.insert()
+        .values(release_id=release_id, **values))
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_flush')
+def _update_release_stats(session, flush_context):
+    """Applies changes to Runs in the flush to their ReleaseStats."""
+    deltas = {}
+
+    def add(run, counters, amount):
+        release_deltas = deltas.setdefault(run.release_id, {})
+        for counter in counters:
+            release_deltas[counter] = release_deltas.get(counter, 0) + amount
+
+    for instance in session.new:
+        if isinstance(instance, Run):
+            add(instance, _get_run_counters(
+                *[getattr(instance, f) for f in _RUN_COUNTER_FIELDS]), 1)
+
+    for instance in session.dirty:
+        if isinstance(instance, Run) and session.is_modified(instance):
+            add(instance, _get_run_counters(
+                *[_get_committed_value(instance, f)
+                  for f in _RUN_COUNTER_FIELDS]), -1)
+            add(instance, _get_run_counters(
+                *[getattr(instance, f) for f in _RUN_COUNTER_FIELDS]), 1)
+
+    for instance in session.deleted:
+        if isinstance(instance, Run):
+            add(instance, _get_run_counters(
+                *[_get_committed_value(instance, f)
+                  for f in _RUN_COUNTER_FIELDS]), -1)
+
+    table = ReleaseStats.__table__
+    for release_id, release_deltas in deltas.iteritems():
+        values = dict(
+            (counter, table.c[counter] + amount)
+            for counter, amount in release_deltas.iteritems()
+            if amount)
+        if not release_id or not values:
+            continue
+
+        update = (
+            table.update()
+            .where(table.c.release_id == release_id)
+            .values(**values))
+        result = session.execute(update)
+        if not result.rowcount:
+            # The runs written by this flush are included in the count,
+            # unless another transaction counted the runs first.
+            if not _insert_release_stats(session, release_id):
+                session.execute(update)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_bulk_update')
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_bulk_delete')
+def _check_run_bulk_changes(session, query, query_context, result):
+    """Fails Query.update() and Query.delete() calls on Runs.
+
+    These change rows without a flush, so they would leave ReleaseStats out
+    of date. Load the Runs and change them one at a time instead.
+    """
+    for description in query.column_descriptions:
+        assert description['type'] is not Run, (
+            'Query.update() and Query.delete() skip ReleaseStats for Runs')
+
+
+@sqlalchemy.event.listens_for(Release, 'after_insert')
+def _create_release_stats(mapper, connection, release):
+    """Creates empty stats for a new release."""
+    values = dict((counter, 0) for counter in ReleaseStats.COUNTERS)
+    connection.execute(
+        ReleaseStats.__table__.insert().values(release_id=release.id, **values))
+
+
 class AdminLog(db.Model):
     """Log of admin user actions for a build."""
 
@@ -19,9 +19,6 @@ import functools
 import logging
 import time
 
-# Local libraries
-import sqlalchemy
-
 # Local modules
 from . import app
 from . import cache
@@ -165,6 +162,11 @@ class BuildOps(BaseOps):
     def __init__(self, build_id):
         self.build_id = build_id
         self.cache_key = 'caching.BuildOps(build_id=%r)' % self.build_id
+        # Kept separately from cache_key, which is evicted whenever any run
+        # of the build is updated, while the last good release only changes
+        # when a release is marked good or bad.
+        self.last_good_cache_key = (
+            'caching.BuildOps(build_id=%r).last_good' % self.build_id)
 
     @staticmethod
     def sort_run(run):
@@ -209,15 +211,17 @@ class BuildOps(BaseOps):
 
         if candidate_list:
             candidate_keys = [c.id for c in candidate_list]
-            stats_counts = (
-                db.session.query(
-                    models.Run.release_id,
-                    models.Run.status,
-                    sqlalchemy.func.count(models.Run.id))
-                .join(models.Release)
-                .filter(models.Release.id.in_(candidate_keys))
-                .group_by(models.Run.status, models.Run.release_id)
-                .all())
+            stats_map = dict(
+                (stats.release_id, stats)
+                for stats in models.ReleaseStats.query
+                .filter(models.ReleaseStats.release_id.in_(candidate_keys)))
+            for candidate_id in candidate_keys:
+                stats = stats_map.get(candidate_id)
+                if stats is None:
+                    stats = models.get_release_stats(candidate_id)
+                for status, count in stats.get_status_counts().iteritems():
+                    if count:
+                        stats_counts.append((candidate_id, status, count))
 
         for candidate in candidate_list:
             db.session.expunge(candidate)
@@ -247,9 +251,10 @@ class BuildOps(BaseOps):
             runs_failed=0,
             runs_baseline=0,
             runs_pending=0)
-        for run in run_list:
-            for key in self.get_stats_keys(run.status):
-                stats_dict[key] += 1
+        stats = models.get_release_stats(release.id)
+        for status, count in stats.get_status_counts().iteritems():
+            for key in self.get_stats_keys(status):
+                stats_dict[key] += count
 
         approval_log = None
         if release.status in (models.Release.GOOD, models.Release.BAD):
@@ -270,6 +275,52 @@ class BuildOps(BaseOps):
 
         return release, run_list, stats_dict, approval_log
 
+    def get_last_good(self):
+        """Gets the last good release of the build and its runs.
+
+        Returns:
+            Tuple (release, run_dict) where release is the newest GOOD
+            models.Release, or None if there isn't one, and run_dict maps
+            each run name in that release to a dictionary of the run's
+            url, image, log, and config.
+        """
+        versioned_key = _get_versioned_hash_key(self.last_good_cache_key)
+        result = cache.get(versioned_key)
+        if result is not None:
+            return result
+
+        last_good_release = (
+            models.Release.query
+            .filter_by(
+                build_id=self.build_id,
+                status=models.Release.GOOD)
+            .order_by(models.Release.created.desc())
+            .first())
+
+        run_dict = {}
+        if last_good_release:
+            query = (
+                db.session.query(
+                    models.Run.name,
+                    models.Run.url,
+                    models.Run.image,
+                    models.Run.log,
+                    models.Run.config)
+                .filter_by(release_id=last_good_release.id))
+            for name, url, image, log, config in query:
+                run_dict[name] = dict(
+                    url=url, image=image, log=log, config=config)
+            db.session.expunge(last_good_release)
+
+        result = (last_good_release, run_dict)
+        cache.set(versioned_key, result)
+        return result
+
+    def evict_last_good(self):
+        """Evicts the cached last good release of the build."""
+        logging.debug('Evicting cache for %r', self.last_good_cache_key)
+        _clear_version_cache(self.last_good_cache_key)
+
     def _get_next_previous_runs(self, run):
         next_run = None
         previous_run = None
@@ -370,7 +421,11 @@ def _evict_user_cache(sender, user=None, build=None):
 
 
 def _evict_build_cache(sender, build=None, release=None, run=None):
-    BuildOps(build.id).evict()
+    ops = BuildOps(build.id)
+    ops.evict()
+    # Runs can still be reported after a release is marked good.
+    if release and release.status == models.Release.GOOD:
+        ops.evict_last_good()
 
 
 def _evict_task_cache(sender, task=None):
@@ -42,3 +42,8 @@ run_updated_via_api = _signals.signal('run-updated')
 # Argument is (work_queue.WorkQueue). Signal is sent immediately after the
 # task is updated but before it is committed to the DB.
 task_updated = _signals.signal('task-updated')
+
+# Tasks have been added to a WorkQueue. Sender is the app. Argument is
+# (queue_name). Signal is sent immediately *after* the tasks are committed
+# to the DB.
+task_added = _signals.signal('task-added')
@@ -27,7 +27,7 @@ import uuid
 # Local libraries
 import flask
 from flask import abort, g, jsonify
-from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import IntegrityError, OperationalError
 
 # Local modules
 from . import app
@@ -58,6 +58,31 @@ def retryable_transaction(attempts=3, exceptions=(OperationalError,)):
     return wrapper
 
 
+def insert_unless_exists(session, statement):
+    """Runs an INSERT that another transaction may have already done.
+
+    The savepoint keeps the transaction usable if the insert fails on a
+    duplicate key. SQLite only undoes the failed statement, and its driver
+    commits before a SAVEPOINT, so it goes without.
+
+    Returns:
+        True if the row was inserted, False if it already existed.
+    """
+    connection = session.connection()
+    savepoint = None
+    if connection.dialect.name != 'sqlite':
+        savepoint = connection.begin_nested()
+    try:
+        connection.execute(statement)
+    except IntegrityError:
+        if savepoint:
+            savepoint.rollback()
+        return False
+    if savepoint:
+        savepoint.commit()
+    return True
+
+
 def jsonify_assert(asserted, message, status_code=400):
     """Asserts something is true, aborts the request if not."""
     if asserted:
@@ -15,15 +15,23 @@
 
 """Pull-queue API."""
 
+import collections
 import datetime
 import json
 import logging
+import random
+import threading
 import time
 import uuid
 
+# Local libraries
+import sqlalchemy
+from sqlalchemy.orm import attributes
+
 # Local modules
 from . import app
 from . import db
+from . import utils
 from dpxdt.server import signals
 
 
@@ -48,7 +56,7 @@ class WorkQueue(db.Model):
     - By Index(queue_name, status, eta) for finding the oldest task for a queue
         that is still pending.
     - By Index(status, create) for finding old tasks that should be deleted
-        from the table periodically to free up space.
+        from the table periodically to free up space. See reap().
     """
 
     CANCELED = 'canceled'
@@ -56,10 +64,16 @@ class WorkQueue(db.Model):
     ERROR = 'error'
     LIVE = 'live'
     STATES = frozenset([CANCELED, DONE, ERROR, LIVE])
+    FINISHED_STATES = frozenset([CANCELED, DONE, ERROR])
 
     task_id = db.Column(db.String(100), primary_key=True, nullable=False)
     queue_name = db.Column(db.String(100), primary_key=True, nullable=False)
-    status = db.Column(db.Enum(*STATES, name='work_queue_states'), default=LIVE, nullable=False)
+    # Loads the old status before it's changed so WorkQueueStats can move
+    # the task from one count to another on flush.
+    status = db.column_property(
+        db.Column(db.Enum(*STATES, name='work_queue_states'), default=LIVE,
+                  nullable=False),
+        active_history=True)
     eta = db.Column(db.DateTime, default=datetime.datetime.utcnow,
                     nullable=False)
 
@@ -97,6 +111,105 @@ class WorkQueue(db.Model):
         return now < self.eta
 
 
+class WorkQueueStats(db.Model):
+    """Number of tasks in each status of each queue.
+
+    Kept up to date in the same transaction as any change to a task's
+    status, so get_stats() doesn't need to scan the WorkQueue table. Changes
+    made through the ORM are counted on flush; statements that insert or
+    delete tasks directly must call _add_to_stats() themselves.
+    """
+
+    queue_name = db.Column(db.String(100), primary_key=True)
+    status = db.Column(db.Enum(*WorkQueue.STATES, name='work_queue_states'),
+                       primary_key=True)
+    count = db.Column(db.Integer, default=0, nullable=False)
+
+
+def _insert_stats(session, queue_name, status):
+    """Inserts the stats for a queue status by counting its tasks.
+
+    Returns:
+        True if the stats were inserted, False if another transaction
+        inserted them first.
+    """
+    with session.no_autoflush:
+        count = (
+            session.query(sqlalchemy.func.count(WorkQueue.task_id))
+            .filter_by(queue_name=queue_name, status=status)
+            .scalar())
+
+    return utils.insert_unless_exists(
+        session,
+        WorkQueueStats.__table__.insert()
+        .values(queue_name=queue_name, status=status, count=count))
+
+
+def _add_to_stats(session, deltas):
+    """Applies changes in the number of tasks to WorkQueueStats.
+
+    Args:
+        session: Session to write the changes with.
+        deltas: Dictionary mapping (queue_name, status) to the number of
+            tasks added to (or removed from, when negative) that status.
+            Must already be reflected in the WorkQueue table.
+    """
+    table = WorkQueueStats.__table__
+    # Update in a fixed order so concurrent transactions don't deadlock.
+    for (queue_name, status), amount in sorted(deltas.iteritems()):
+        if not amount:
+            continue
+        update = (
+            table.update()
+            .where(table.c.queue_name == queue_name)
+            .where(table.c.status == status)
+            .values(count=table.c.count + amount))
+        result = session.execute(update)
+        if not result.rowcount:
+            # The tasks written by this transaction are included in the
+            # count, unless another transaction counted the tasks first.
+            if not _insert_stats(session, queue_name, status):
+                session.execute(update)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_flush')
+def _update_work_queue_stats(session, flush_context):
+    """Applies changes to task statuses in the flush to WorkQueueStats."""
+    deltas = collections.defaultdict(int)
+
+    for instance in session.new:
+        if isinstance(instance, WorkQueue):
+            deltas[(instance.queue_name, instance.status)] += 1
+
+    for instance in session.dirty:
+        if isinstance(instance, WorkQueue):
+            history = attributes.get_history(instance, 'status')
+            if history.added and history.deleted:
+                deltas[(instance.queue_name, history.deleted[0])] -= 1
+                deltas[(instance.queue_name, history.added[0])] += 1
+
+    for instance in session.deleted:
+        if isinstance(instance, WorkQueue):
+            history = attributes.get_history(instance, 'status')
+            old_status = (history.deleted or history.unchanged)[0]
+            deltas[(instance.queue_name, old_status)] -= 1
+
+    if deltas:
+        _add_to_stats(session, deltas)
+
+
+# Finished tasks moved out of the WorkQueue table by reap(). Has the same
+# columns without the foreign keys, so archived tasks never keep other
+# rows from being deleted, plus the time each task was archived.
+work_queue_archive = db.Table(
+    'work_queue_archive',
+    *([db.Column(column.name, column.type,
+                 primary_key=column.primary_key,
+                 nullable=column.nullable)
+       for column in WorkQueue.__table__.columns] +
+      [db.Column('archived', db.DateTime, nullable=False)]))
+
+
 def add(queue_name, payload=None, content_type=None, source=None, task_id=None,
         build_id=None, release_id=None, run_id=None):
     """Adds a work item to a queue.
@@ -125,9 +238,7 @@ def add(queue_name, payload=None, content_type=None, source=None, task_id=None,
     else:
         task_id = uuid.uuid4().hex
 
-    if payload and not content_type and not isinstance(payload, basestring):
-        payload = json.dumps(payload)
-        content_type = 'application/json'
+    payload, content_type = _encode_payload(payload, content_type)
 
     now = datetime.datetime.utcnow()
     task = WorkQueue(
@@ -142,9 +253,178 @@ def add(queue_name, payload=None, content_type=None, source=None, task_id=None,
         content_type=content_type)
     db.session.add(task)
 
+    # Wake up lease requests waiting on this queue once the task commits.
+    db.session.info.setdefault('work_queue_added', set()).add(queue_name)
+
     return task.task_id
 
 
+def _encode_payload(payload, content_type):
+    """Returns the (payload, content_type) to store for a new task."""
+    if payload and not content_type and not isinstance(payload, basestring):
+        payload = json.dumps(payload)
+        content_type = 'application/json'
+    return payload, content_type
+
+
+def add_many(queue_name, tasks):
+    """Adds many work items to a queue at once.
+
+    Existing task IDs are found with one query and the new tasks are inserted
+    with one statement, instead of a lookup and an insert for each task.
+
+    Args:
+        queue_name: Name of the queue to add the work items to.
+        tasks: List of dictionaries with the optional keys payload,
+            content_type, source, task_id, build_id, release_id, and run_id,
+            which have the same meaning as the arguments to add(). Tasks
+            with a task_id that already exists, or that appears earlier in
+            the list, are skipped.
+
+    Returns:
+        List of the task IDs, one for each item in tasks.
+    """
+    given_ids = set(task['task_id'] for task in tasks if task.get('task_id'))
+    existing_ids = set()
+    if given_ids:
+        existing_ids.update(
+            task_id for task_id, in
+            db.session.query(WorkQueue.task_id)
+            .filter(WorkQueue.task_id.in_(given_ids)))
+
+    now = datetime.datetime.utcnow()
+    task_ids = []
+    row_list = []
+    for task in tasks:
+        task_id = task.get('task_id')
+        if task_id:
+            task_ids.append(task_id)
+            if task_id in existing_ids:
+                continue
+            existing_ids.add(task_id)
+        else:
+            task_id = uuid.uuid4().hex
+            task_ids.append(task_id)
+
+        payload, content_type = _encode_payload(
+            task.get('payload'), task.get('content_type'))
+
+        # Every row needs the same keys to be inserted in one statement.
+        row_list.append(dict(
+            task_id=task_id,
+            queue_name=queue_name,
+            status=WorkQueue.LIVE,
+            eta=now,
+            created=now,
+            lease_attempts=0,
+            source=task.get('source'),
+            build_id=task.get('build_id'),
+            release_id=task.get('release_id'),
+            run_id=task.get('run_id'),
+            payload=payload,
+            content_type=content_type))
+
+    if row_list:
+        db.session.execute(WorkQueue.__table__.insert(), row_list)
+        _add_to_stats(
+            db.session, {(queue_name, WorkQueue.LIVE): len(row_list)})
+        db.session.info.setdefault('work_queue_added', set()).add(queue_name)
+
+    return task_ids
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+def _send_task_added(session):
+    """Sends the task_added signal for queues with newly committed tasks."""
+    for queue_name in session.info.pop('work_queue_added', ()):
+        signals.task_added.send(app, queue_name=queue_name)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_rollback')
+def _discard_task_added(session):
+    """Forgets tasks that were added but never committed."""
+    session.info.pop('work_queue_added', None)
+
+
+class _AddNotifier(object):
+    """Wakes up threads waiting for tasks to be added to a queue."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        # Number of times tasks have been added to each queue.
+        self.versions = collections.defaultdict(int)
+
+    def get_version(self, queue_name):
+        with self.condition:
+            return self.versions[queue_name]
+
+    def notify(self, queue_name):
+        with self.condition:
+            self.versions[queue_name] += 1
+            self.condition.notify_all()
+
+    def wait(self, queue_name, version, timeout_seconds):
+        deadline = time.time() + timeout_seconds
+        with self.condition:
+            while self.versions[queue_name] == version:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+
+_notifier = _AddNotifier()
+
+
+def _notify_task_added(sender, queue_name=None):
+    _notifier.notify(queue_name)
+
+
+signals.task_added.connect(_notify_task_added, app)
+
+
+def get_add_version(queue_name):
+    """Returns a value that changes whenever tasks are added to a queue.
+
+    Call this before looking for tasks and pass the result to wait_for_add
+    so tasks added in between are not missed.
+    """
+    return _notifier.get_version(queue_name)
+
+
+def wait_for_add(queue_name, version, timeout_seconds):
+    """Waits until tasks are added to a queue in this process.
+
+    Args:
+        queue_name: Name of the queue to wait for.
+        version: Return value of get_add_version from before the caller
+            last looked for tasks.
+        timeout_seconds: Longest time to wait.
+
+    Returns:
+        True if tasks were added, False if the timeout was reached.
+    """
+    return _notifier.wait(queue_name, version, timeout_seconds)
+
+
+def has_available(queue_name):
+    """Returns True if a queue has a task that could be leased now.
+
+    This only reads a single row of the lease index and takes no locks, so
+    waiting lessees can use it to notice tasks added by other server
+    processes, or leases that expired, much more cheaply than by leasing.
+    """
+    now = datetime.datetime.utcnow()
+    task_id = (
+        db.session.query(WorkQueue.task_id)
+        .filter_by(queue_name=queue_name, status=WorkQueue.LIVE)
+        .filter(WorkQueue.eta <= now)
+        .limit(1)
+        .scalar())
+    return task_id is not None
+
+
 def _datetime_to_epoch_seconds(dt):
     """Converts a datetime.datetime to seconds since the epoch."""
     if dt is None:
@@ -174,9 +454,131 @@ def _task_to_dict(task):
 # would let users run their own workers for server-side capture queues.
 
 
+# How many of the oldest tasks an atomic claim picks from at random, as a
+# multiple of the number of tasks being leased.
+CLAIM_CANDIDATE_FACTOR = 4
+
+# How many rounds of atomic claims to try before giving up on a full lease.
+CLAIM_ATTEMPTS = 3
+
+
+def _get_lease_strategy():
+    """Returns the name of the lease strategy to use for this database."""
+    strategy = app.config.get('WORK_QUEUE_LEASE_STRATEGY')
+    if strategy:
+        return strategy
+
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        return 'skip_locked'
+    elif dialect == 'sqlite':
+        return 'atomic_claim'
+    else:
+        return 'select_for_update'
+
+
+def _lease_select_for_update(queue_name, count, now):
+    """Locks the oldest available tasks, waiting for any other lessees."""
+    return (
+        WorkQueue.query
+        .filter_by(queue_name=queue_name, status=WorkQueue.LIVE)
+        .filter(WorkQueue.eta <= now)
+        .order_by(WorkQueue.eta)
+        .with_lockmode('update')
+        .limit(count)
+        .all())
+
+
+def _lease_skip_locked(queue_name, count, now):
+    """Locks the oldest available tasks not already locked by others."""
+    # SQLAlchemy 0.9 can't render SKIP LOCKED, so select the IDs directly.
+    result = db.session.execute(
+        'SELECT task_id FROM %s '
+        'WHERE queue_name = :queue_name AND status = :status '
+        'AND eta <= :now '
+        'ORDER BY eta LIMIT :count '
+        'FOR UPDATE SKIP LOCKED' % WorkQueue.__tablename__,
+        dict(queue_name=queue_name, status=WorkQueue.LIVE, now=now,
+             count=count))
+    task_ids = [task_id for task_id, in result]
+    if not task_ids:
+        return []
+
+    return (
+        WorkQueue.query
+        .filter_by(queue_name=queue_name)
+        .filter(WorkQueue.task_id.in_(task_ids))
+        .order_by(WorkQueue.eta)
+        .populate_existing()
+        .all())
+
+
+def _lease_atomic_claim(queue_name, count, now, next_eta):
+    """Claims available tasks with conditional updates instead of locks.
+
+    Each round picks tasks at random from the oldest available ones and
+    claims them in a single UPDATE that only matches tasks that are still
+    available. The UPDATE marks them with a random token so this lessee can
+    tell which ones it won. Concurrent lessees mostly pick different tasks,
+    and never claim the same one.
+    """
+    claimed_ids = []
+    for _ in xrange(CLAIM_ATTEMPTS):
+        remaining = count - len(claimed_ids)
+        candidate_ids = [
+            task_id for task_id, in
+            db.session.query(WorkQueue.task_id)
+            .filter_by(queue_name=queue_name, status=WorkQueue.LIVE)
+            .filter(WorkQueue.eta <= now)
+            .order_by(WorkQueue.eta)
+            .limit(remaining * CLAIM_CANDIDATE_FACTOR)]
+        if not candidate_ids:
+            break
+
+        chosen_ids = random.sample(
+            candidate_ids, min(remaining, len(candidate_ids)))
+        token = uuid.uuid4().hex
+        (WorkQueue.query
+            .filter_by(queue_name=queue_name, status=WorkQueue.LIVE)
+            .filter(WorkQueue.eta <= now)
+            .filter(WorkQueue.task_id.in_(chosen_ids))
+            .update(dict(eta=next_eta, last_owner=token),
+                    synchronize_session=False))
+        claimed_ids.extend(
+            task_id for task_id, in
+            db.session.query(WorkQueue.task_id)
+            .filter_by(queue_name=queue_name, last_owner=token))
+
+        if len(claimed_ids) >= count or len(chosen_ids) == len(candidate_ids):
+            break
+
+    if not claimed_ids:
+        return []
+
+    return (
+        WorkQueue.query
+        .filter_by(queue_name=queue_name)
+        .filter(WorkQueue.task_id.in_(claimed_ids))
+        .order_by(WorkQueue.created)
+        .populate_existing()
+        .all())
+
+
 def lease(queue_name, owner, count=1, timeout_seconds=60):
     """Leases a work item from a queue, usually the oldest task available.
 
+    How tasks are locked depends on the WORK_QUEUE_LEASE_STRATEGY config:
+
+    - select_for_update: Locks the oldest tasks. Concurrent lessees wait
+        for each other.
+    - skip_locked: Locks the oldest tasks that aren't already locked by
+        another lessee. Requires PostgreSQL 9.5 or MySQL 8.
+    - atomic_claim: Claims tasks with conditional updates and no explicit
+        locks. Works with any database.
+
+    When not configured, PostgreSQL uses skip_locked, SQLite uses
+    atomic_claim, and everything else uses select_for_update.
+
     Args:
         queue_name: Name of the queue to lease work from.
         owner: Who or what is leasing the task.
@@ -190,20 +592,19 @@ def lease(queue_name, owner, count=1, timeout_seconds=60):
         an empty list if no tasks are available to be leased.
     """
     now = datetime.datetime.utcnow()
-    query = (
-        WorkQueue.query
-        .filter_by(queue_name=queue_name, status=WorkQueue.LIVE)
-        .filter(WorkQueue.eta <= now)
-        .order_by(WorkQueue.eta)
-        .with_lockmode('update')
-        .limit(count))
+    next_eta = now + datetime.timedelta(seconds=timeout_seconds)
+
+    strategy = _get_lease_strategy()
+    if strategy == 'atomic_claim':
+        task_list = _lease_atomic_claim(queue_name, count, now, next_eta)
+    elif strategy == 'skip_locked':
+        task_list = _lease_skip_locked(queue_name, count, now)
+    else:
+        task_list = _lease_select_for_update(queue_name, count, now)
 
-    task_list = query.all()
     if not task_list:
         return None
 
-    next_eta = now + datetime.timedelta(seconds=timeout_seconds)
-
     for task in task_list:
         task.eta = next_eta
         task.lease_attempts += 1
@@ -216,6 +617,28 @@ def lease(queue_name, owner, count=1, timeout_seconds=60):
     return [_task_to_dict(task) for task in task_list]
 
 
+def _check_task_policy(task, queue_name, task_id, owner, now):
+    """Enforces ownership policy for a task.
+
+    Raises:
+        TaskDoesNotExistError if the task does not exist.
+        LeaseExpiredError if the lease is no longer active.
+        NotOwnerError if the specified owner no longer owns the task.
+    """
+    if not task:
+        raise TaskDoesNotExistError('task_id=%r' % task_id)
+
+    # Lease delta should be positive, meaning it has not yet expired!
+    lease_delta = now - task.eta
+    if lease_delta > datetime.timedelta(0):
+        raise LeaseExpiredError('queue=%r, task_id=%r expired %s' % (
+                                task.queue_name, task_id, lease_delta))
+
+    if task.last_owner != owner:
+        raise NotOwnerError('queue=%r, task_id=%r, owner=%r' % (
+                            task.queue_name, task_id, task.last_owner))
+
+
 def _get_task_with_policy(queue_name, task_id, owner):
     """Fetches the specified task and enforces ownership policy.
 
@@ -238,22 +661,50 @@ def _get_task_with_policy(queue_name, task_id, owner):
         .filter_by(queue_name=queue_name, task_id=task_id)
         .with_lockmode('update')
         .first())
-    if not task:
-        raise TaskDoesNotExistError('task_id=%r' % task_id)
+    try:
+        _check_task_policy(task, queue_name, task_id, owner, now)
+    except Error:
+        if task:
+            db.session.rollback()
+        raise
 
-    # Lease delta should be positive, meaning it has not yet expired!
-    lease_delta = now - task.eta
-    if lease_delta > datetime.timedelta(0):
-        db.session.rollback()
-        raise LeaseExpiredError('queue=%r, task_id=%r expired %s' % (
-                                task.queue_name, task_id, lease_delta))
+    return task
 
-    if task.last_owner != owner:
-        db.session.rollback()
-        raise NotOwnerError('queue=%r, task_id=%r, owner=%r' % (
-                            task.queue_name, task_id, task.last_owner))
 
-    return task
+def _get_tasks_with_policy(queue_name, task_ids, owner):
+    """Fetches many tasks at once and enforces ownership policy.
+
+    Unlike _get_task_with_policy, a task failing the policy does not roll
+    back the transaction, so the other tasks may still be updated.
+
+    Args:
+        queue_name: Name of the queue the work items are on.
+        task_ids: IDs of the tasks to fetch.
+        owner: Who or what has the current lease on the tasks.
+
+    Returns:
+        Dictionary mapping each task ID to its valid WorkQueue task, or to
+        the Error instance explaining why it failed the policy.
+    """
+    now = datetime.datetime.utcnow()
+    task_list = (
+        WorkQueue.query
+        .filter_by(queue_name=queue_name)
+        .filter(WorkQueue.task_id.in_(task_ids))
+        .with_lockmode('update')
+        .all())
+    task_dict = dict((task.task_id, task) for task in task_list)
+
+    result = {}
+    for task_id in task_ids:
+        task = task_dict.get(task_id)
+        try:
+            _check_task_policy(task, queue_name, task_id, owner, now)
+        except Error, e:
+            result[task_id] = e
+        else:
+            result[task_id] = task
+    return result
 
 
 def heartbeat(queue_name, task_id, owner, message, index):
@@ -284,6 +735,11 @@ def heartbeat(queue_name, task_id, owner, message, index):
         NotOwnerError if the specified owner no longer owns the task.
     """
     task = _get_task_with_policy(queue_name, task_id, owner)
+    return _set_heartbeat(task, message, index)
+
+
+def _set_heartbeat(task, message, index):
+    """Sets the heartbeat of a task that has passed the ownership policy."""
     if task.heartbeat_number > index:
         return False
 
@@ -303,6 +759,32 @@ def heartbeat(queue_name, task_id, owner, message, index):
     return True
 
 
+def heartbeat_many(queue_name, owner, heartbeats):
+    """Sets the heartbeat status of many tasks in one transaction.
+
+    Args:
+        queue_name: Name of the queue the work items are on.
+        owner: Who or what has the current lease on the tasks.
+        heartbeats: List of tuples (task_id, message, index), with the same
+            meaning as the arguments to heartbeat().
+
+    Returns:
+        Dictionary mapping each task ID to the return value of heartbeat()
+        for that task, or to the Error instance it would have raised.
+    """
+    task_dict = _get_tasks_with_policy(
+        queue_name, [task_id for task_id, _, _ in heartbeats], owner)
+
+    result = {}
+    for task_id, message, index in heartbeats:
+        task = task_dict[task_id]
+        if isinstance(task, Error):
+            result[task_id] = task
+        else:
+            result[task_id] = _set_heartbeat(task, message, index)
+    return result
+
+
 def finish(queue_name, task_id, owner, error=False):
     """Marks a work item on a queue as finished.
 
@@ -322,11 +804,15 @@ def finish(queue_name, task_id, owner, error=False):
         NotOwnerError if the specified owner no longer owns the task.
     """
     task = _get_task_with_policy(queue_name, task_id, owner)
+    return _set_finished(task, owner, error)
+
 
+def _set_finished(task, owner, error):
+    """Finishes a task that has passed the ownership policy."""
     if not task.status == WorkQueue.LIVE:
         logging.warning('Finishing already dead task. queue=%r, task_id=%r, '
                         'owner=%r, status=%r',
-                        task.queue_name, task_id, owner, task.status)
+                        task.queue_name, task.task_id, owner, task.status)
         return False
 
     if not error:
@@ -342,6 +828,134 @@ def finish(queue_name, task_id, owner, error=False):
     return True
 
 
+def finish_many(queue_name, owner, finishes):
+    """Marks many work items on a queue as finished in one transaction.
+
+    Args:
+        queue_name: Name of the queue the work items are on.
+        owner: Who or what has the current lease on the tasks.
+        finishes: List of tuples (task_id, error), with the same meaning as
+            the arguments to finish().
+
+    Returns:
+        Dictionary mapping each task ID to the return value of finish()
+        for that task, or to the Error instance it would have raised.
+    """
+    task_dict = _get_tasks_with_policy(
+        queue_name, [task_id for task_id, _ in finishes], owner)
+
+    result = {}
+    for task_id, error in finishes:
+        task = task_dict[task_id]
+        if isinstance(task, Error):
+            result[task_id] = task
+        else:
+            result[task_id] = _set_finished(task, owner, error)
+    return result
+
+
+def reap(max_age_seconds, batch_size, archive=False):
+    """Deletes a batch of old tasks that have finished.
+
+    Only deletes up to batch_size tasks so each call holds its locks
+    briefly. Commit the transaction and call this again until it returns
+    fewer than batch_size to reap everything that is old enough.
+
+    Args:
+        max_age_seconds: Tasks that finished and were created more than
+            this many seconds ago are deleted.
+        batch_size: Most tasks to delete.
+        archive: When True, copy the tasks to the work_queue_archive
+            table before deleting them.
+
+    Returns:
+        The number of tasks that were deleted.
+    """
+    now = datetime.datetime.utcnow()
+    cutoff = now - datetime.timedelta(seconds=max_age_seconds)
+
+    # Find the oldest tasks first with the reap_index, then delete exactly
+    # those rows, since DELETE ... LIMIT isn't portable. The rows are locked
+    # so the statuses taken out of WorkQueueStats are still right.
+    rows = list(
+        db.session.query(
+            WorkQueue.task_id, WorkQueue.queue_name, WorkQueue.status)
+        .filter(WorkQueue.status.in_(WorkQueue.FINISHED_STATES))
+        .filter(WorkQueue.created < cutoff)
+        .order_by(WorkQueue.created)
+        .limit(batch_size)
+        .with_lockmode('update'))
+    if not rows:
+        return 0
+
+    criteria = sqlalchemy.and_(
+        WorkQueue.task_id.in_([task_id for task_id, _, _ in rows]),
+        WorkQueue.status.in_(WorkQueue.FINISHED_STATES),
+        WorkQueue.created < cutoff)
+
+    if archive:
+        columns = list(WorkQueue.__table__.columns)
+        db.session.execute(
+            work_queue_archive.insert().from_select(
+                [column.name for column in columns] + ['archived'],
+                sqlalchemy.select(columns + [sqlalchemy.literal(now)])
+                .where(criteria)))
+
+    deleted = (
+        WorkQueue.query
+        .filter(criteria)
+        .delete(synchronize_session=False))
+
+    deltas = collections.defaultdict(int)
+    for _, queue_name, status in rows:
+        deltas[(queue_name, status)] -= 1
+    _add_to_stats(db.session, deltas)
+
+    return deleted
+
+
+def get_stats():
+    """Gets statistics for each status of each queue.
+
+    Counts come from WorkQueueStats. The newest and oldest times for each
+    status are single lookups in the created_index and lease_index, so the
+    cost doesn't grow with the number of tasks.
+
+    Returns:
+        List of dictionaries with the keys name, status, count,
+        newest_created, and oldest_eta, sorted by name and status.
+    """
+    query = (
+        WorkQueueStats.query
+        .filter(WorkQueueStats.count > 0)
+        .order_by(WorkQueueStats.queue_name, WorkQueueStats.status))
+
+    stats_list = []
+    for stats in query:
+        newest_created, oldest_eta = (
+            db.session.query(
+                sqlalchemy.func.max(WorkQueue.created),
+                sqlalchemy.func.min(WorkQueue.eta))
+            .filter_by(queue_name=stats.queue_name, status=stats.status)
+            .one())
+        stats_list.append(dict(
+            name=stats.queue_name,
+            status=stats.status,
+            count=stats.count,
+            newest_created=newest_created,
+            oldest_eta=oldest_eta))
+    return stats_list
+
+
+def stats_to_dict(stats):
+    """Converts an item returned by get_stats() to a JSON-able dictionary."""
+    stats = dict(stats)
+    stats['newest_created'] = _datetime_to_epoch_seconds(
+        stats['newest_created'])
+    stats['oldest_eta'] = _datetime_to_epoch_seconds(stats['oldest_eta'])
+    return stats
+
+
 def _query(queue_name=None, build_id=None, release_id=None, run_id=None,
            count=None):
     """Queries for work items based on their criteria.
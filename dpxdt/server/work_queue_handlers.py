@@ -15,12 +15,13 @@
 
 """Pull-queue web handlers."""
 
+import json
 import logging
+import time
 
 # Local libraries
 import flask
 from flask import Flask, redirect, render_template, request, url_for
-from sqlalchemy import func
 
 # Local modules
 from . import app
@@ -53,29 +54,108 @@ def handle_add(queue_name):
     return flask.jsonify(task_id=task_id)
 
 
-@app.route('/api/work_queue/<string:queue_name>/lease', methods=['POST'])
+@app.route('/api/work_queue/<string:queue_name>/add_tasks', methods=['POST'])
 @auth.superuser_api_key_required
 @utils.retryable_transaction()
+def handle_add_tasks(queue_name):
+    """Adds many tasks to a queue at once.
+
+    The 'tasks' parameter is a JSON list of objects with the same optional
+    payload, content_type, source, and task_id parameters as /add takes.
+    Returns the task IDs in the same order.
+    """
+    default_source = request.form.get('source', request.remote_addr, type=str)
+    try:
+        task_list = json.loads(request.form.get('tasks', '[]'))
+        tasks = []
+        for task in task_list:
+            payload = task.get('payload')
+            if isinstance(payload, unicode):
+                payload = payload.encode('utf-8')
+            task_id = task.get('task_id')
+            tasks.append(dict(
+                payload=payload,
+                content_type=task.get('content_type'),
+                source=task.get('source', default_source),
+                task_id=task_id and str(task_id)))
+    except (ValueError, TypeError, AttributeError, UnicodeError), e:
+        return utils.jsonify_error(e)
+
+    task_ids = work_queue.add_many(queue_name, tasks)
+
+    db.session.commit()
+    logging.info('Tasks added: queue=%r, count=%d, source=%r',
+                 queue_name, len(task_ids), default_source)
+    return flask.jsonify(success=True, task_ids=task_ids)
+
+
+@utils.retryable_transaction()
+def _lease_tasks(queue_name, owner, count, timeout_seconds):
+    """Leases tasks and commits, retrying only this one attempt.
+
+    Ends the transaction even when nothing was leased, so the next attempt
+    sees newly committed tasks.
+    """
+    task_list = work_queue.lease(queue_name, owner, count, timeout_seconds)
+    if task_list:
+        db.session.commit()
+    else:
+        db.session.rollback()
+    return task_list
+
+
+@utils.retryable_transaction()
+def _has_available(queue_name):
+    """Checks for leasable tasks in a transaction of its own."""
+    try:
+        return work_queue.has_available(queue_name)
+    finally:
+        db.session.rollback()
+
+
+@app.route('/api/work_queue/<string:queue_name>/lease', methods=['POST'])
+@auth.superuser_api_key_required
 def handle_lease(queue_name):
-    """Leases a task from a queue."""
+    """Leases a task from a queue.
+
+    When the 'wait' parameter is supplied and no tasks are available, holds
+    the request open for up to that many seconds until tasks are added.
+    Tasks added by this server process wake the request right away; other
+    changes are found by a cheap check every WORK_QUEUE_LEASE_RECHECK_SECONDS.
+    """
     owner = request.form.get('owner', request.remote_addr, type=str)
+    count = request.form.get('count', 1, type=int)
+    timeout_seconds = request.form.get('timeout', 60, type=int)
+    wait_seconds = max(0, min(
+        request.form.get('wait', 0, type=float),
+        app.config['WORK_QUEUE_MAX_LEASE_WAIT_SECONDS']))
+    deadline = time.time() + wait_seconds
+
+    version = work_queue.get_add_version(queue_name)
     try:
-        task_list = work_queue.lease(
-            queue_name,
-            owner,
-            request.form.get('count', 1, type=int),
-            request.form.get('timeout', 60, type=int))
+        task_list = _lease_tasks(queue_name, owner, count, timeout_seconds)
+        while not task_list:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+
+            added = work_queue.wait_for_add(
+                queue_name, version,
+                min(remaining, app.config['WORK_QUEUE_LEASE_RECHECK_SECONDS']))
+            version = work_queue.get_add_version(queue_name)
+            if added or _has_available(queue_name):
+                task_list = _lease_tasks(
+                    queue_name, owner, count, timeout_seconds)
     except work_queue.Error, e:
         return utils.jsonify_error(e)
 
     if not task_list:
-        return flask.jsonify(tasks=[])
+        return flask.jsonify(tasks=[], wait_seconds=wait_seconds)
 
-    db.session.commit()
     task_ids = [t['task_id'] for t in task_list]
     logging.debug('Task leased: queue=%r, task_ids=%r, owner=%r',
                   queue_name, task_ids, owner)
-    return flask.jsonify(tasks=task_list)
+    return flask.jsonify(tasks=task_list, wait_seconds=wait_seconds)
 
 
 @app.route('/api/work_queue/<string:queue_name>/heartbeat', methods=['POST'])
@@ -102,6 +182,46 @@ def handle_heartbeat(queue_name):
     return flask.jsonify(success=True)
 
 
+def _get_task_results(result_dict):
+    """Converts the return value of a bulk work_queue call to JSON."""
+    results = []
+    for task_id, result in result_dict.iteritems():
+        if isinstance(result, work_queue.Error):
+            results.append(dict(task_id=task_id, error=str(result)))
+        else:
+            results.append(dict(task_id=task_id, success=True))
+    return results
+
+
+@app.route('/api/work_queue/<string:queue_name>/heartbeat_tasks',
+           methods=['POST'])
+@auth.superuser_api_key_required
+@utils.retryable_transaction()
+def handle_heartbeat_tasks(queue_name):
+    """Updates the heartbeat messages for many tasks at once.
+
+    The 'heartbeats' parameter is a JSON list of objects with the same
+    task_id, message, and index parameters as /heartbeat takes. Tasks that
+    fail are reported individually and do not stop the others.
+    """
+    owner = request.form.get('owner', request.remote_addr, type=str)
+    try:
+        heartbeat_list = json.loads(request.form.get('heartbeats', '[]'))
+        heartbeats = [
+            (str(h['task_id']), h['message'], int(h['index']))
+            for h in heartbeat_list]
+    except (ValueError, TypeError, KeyError), e:
+        return utils.jsonify_error(e)
+
+    result_dict = work_queue.heartbeat_many(queue_name, owner, heartbeats)
+
+    db.session.commit()
+    logging.debug('Task heartbeats: queue=%r, count=%d, owner=%r',
+                  queue_name, len(heartbeats), owner)
+    return flask.jsonify(
+        success=True, results=_get_task_results(result_dict))
+
+
 @app.route('/api/work_queue/<string:queue_name>/finish', methods=['POST'])
 @auth.superuser_api_key_required
 @utils.retryable_transaction()
@@ -121,47 +241,85 @@ def handle_finish(queue_name):
     return flask.jsonify(success=True)
 
 
+@app.route('/api/work_queue/<string:queue_name>/finish_tasks',
+           methods=['POST'])
+@auth.superuser_api_key_required
+@utils.retryable_transaction()
+def handle_finish_tasks(queue_name):
+    """Marks many tasks on a queue as finished at once.
+
+    The 'finishes' parameter is a JSON list of objects with a task_id and
+    an optional error boolean. Tasks that fail are reported individually
+    and do not stop the others.
+    """
+    owner = request.form.get('owner', request.remote_addr, type=str)
+    try:
+        finish_list = json.loads(request.form.get('finishes', '[]'))
+        finishes = [
+            (str(f['task_id']), bool(f.get('error')))
+            for f in finish_list]
+    except (ValueError, TypeError, KeyError, AttributeError), e:
+        return utils.jsonify_error(e)
+
+    result_dict = work_queue.finish_many(queue_name, owner, finishes)
+
+    db.session.commit()
+    logging.debug('Tasks finished: queue=%r, count=%d, owner=%r',
+                  queue_name, len(finishes), owner)
+    return flask.jsonify(
+        success=True, results=_get_task_results(result_dict))
+
+
+@app.route('/api/work_queue/reap', methods=['POST'])
+@auth.superuser_api_key_required
+@utils.retryable_transaction()
+def handle_reap():
+    """Deletes finished tasks older than the retention window.
+
+    Reaps in batches, committing after each one so no transaction holds its
+    locks for long. Stops after WORK_QUEUE_REAP_MAX_BATCHES; the 'done'
+    value in the response is False when more tasks are left to reap.
+    """
+    max_age_seconds = app.config['WORK_QUEUE_RETENTION_DAYS'] * 24 * 60 * 60
+    batch_size = app.config['WORK_QUEUE_REAP_BATCH_SIZE']
+    archive = app.config['WORK_QUEUE_ARCHIVE']
+
+    start = time.time()
+    reaped = 0
+    batches = 0
+    done = False
+    while batches < app.config['WORK_QUEUE_REAP_MAX_BATCHES']:
+        count = work_queue.reap(max_age_seconds, batch_size, archive=archive)
+        db.session.commit()
+        reaped += count
+        batches += 1
+        if count < batch_size:
+            done = True
+            break
+
+    seconds = time.time() - start
+    logging.info('Tasks reaped: count=%d, batches=%d, archive=%r, '
+                 'seconds=%.3f, done=%r',
+                 reaped, batches, archive, seconds, done)
+    return flask.jsonify(
+        success=True, reaped=reaped, batches=batches, archived=archive,
+        seconds=seconds, done=done)
+
+
+@app.route('/api/work_queue/stats')
+@auth.superuser_api_key_required
+def handle_stats():
+    """Returns the statistics for each status of each queue."""
+    stats_list = [
+        work_queue.stats_to_dict(stats) for stats in work_queue.get_stats()]
+    return flask.jsonify(success=True, stats=stats_list)
+
+
 @app.route('/api/work_queue')
 @auth.superuser_required
 def view_all_work_queues():
     """Page for viewing the index of all active work queues."""
-    count_list = list(
-        db.session.query(
-            work_queue.WorkQueue.queue_name,
-            work_queue.WorkQueue.status,
-            func.count(work_queue.WorkQueue.task_id))
-        .group_by(work_queue.WorkQueue.queue_name,
-                  work_queue.WorkQueue.status))
-
-    queue_dict = {}
-    for name, status, count in count_list:
-        queue_dict[(name, status)] = dict(
-            name=name, status=status, count=count)
-
-    max_created_list = list(
-        db.session.query(
-            work_queue.WorkQueue.queue_name,
-            work_queue.WorkQueue.status,
-            func.max(work_queue.WorkQueue.created))
-        .group_by(work_queue.WorkQueue.queue_name,
-                  work_queue.WorkQueue.status))
-
-    for name, status, newest_created in max_created_list:
-        queue_dict[(name, status)]['newest_created'] = newest_created
-
-    min_eta_list = list(
-        db.session.query(
-            work_queue.WorkQueue.queue_name,
-            work_queue.WorkQueue.status,
-            func.min(work_queue.WorkQueue.eta))
-        .group_by(work_queue.WorkQueue.queue_name,
-                  work_queue.WorkQueue.status))
-
-    for name, status, oldest_eta in min_eta_list:
-        queue_dict[(name, status)]['oldest_eta'] = oldest_eta
-
-    queue_list = list(queue_dict.values())
-    queue_list.sort(key=lambda x: (x['name'], x['status']))
+    queue_list = work_queue.get_stats()
 
     context = dict(
         queue_list=queue_list,
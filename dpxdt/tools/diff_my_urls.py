@@ -121,16 +121,17 @@ class DiffMyUrls(workers.WorkflowItem):
         release_number = yield release_worker.CreateReleaseWorkflow(
             upload_build_id, upload_release_name, release_url)
 
-        pending_uploads = []
+        run_requests = []
         for test in tests:
-            item = release_worker.RequestRunWorkflow(
-                upload_build_id, upload_release_name, release_number,
-                test.name, url=test.run_url, config_data=test.run_config_data,
-                ref_url=test.ref_url, ref_config_data=test.ref_config_data)
-            pending_uploads.append(item)
-
-        yield heartbeat('Requesting %d runs' % len(pending_uploads))
-        yield pending_uploads
+            run_requests.append(dict(
+                run_name=test.name, url=test.run_url,
+                config_data=test.run_config_data,
+                ref_url=test.ref_url, ref_config_data=test.ref_config_data))
+
+        yield heartbeat('Requesting %d runs' % len(run_requests))
+        yield release_worker.RequestRunsWorkflow(
+            upload_build_id, upload_release_name, release_number,
+            run_requests)
 
         yield heartbeat('Marking runs as complete')
         release_url = yield release_worker.RunsDoneWorkflow(
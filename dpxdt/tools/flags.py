@@ -42,6 +42,11 @@ gflags.DEFINE_string(
     'cookies', None,
     'Filename containing a JSON array of cookies to set.')
 
+gflags.DEFINE_bool(
+    'resource_cache', False,
+    'Let captures in the same build share a cache of static resources. '
+    'Capture workers must also be run with --capture_cache_dir.')
+
 gflags.DEFINE_string(
     'release_cut_url', None,
     'URL that describes the release that you are testing. Usually a link to '
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# Copyright 2013 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Moves artifact data out of the database and into the artifact store.
+
+Set ARTIFACT_STORE_PATH in the server config before running this. Artifacts
+are copied in batches, each in its own transaction, so the tool can be
+interrupted and run again to pick up where it left off.
+
+Example usage:
+
+YOURAPPLICATION_SETTINGS=settings.cfg \
+    ./dpxdt/tools/migrate_artifacts.py --batch_size=50
+"""
+
+import logging
+import sys
+
+# Local Libraries
+import gflags
+FLAGS = gflags.FLAGS
+
+# Local modules
+from dpxdt import server
+from dpxdt.server import artifact_store
+from dpxdt.server import db
+from dpxdt.server import models
+
+
+gflags.DEFINE_integer(
+    'batch_size', 20,
+    'How many artifacts to move out of the database in each transaction.')
+
+gflags.DEFINE_integer(
+    'limit', None,
+    'Stop after moving this many artifacts. Defaults to moving all of them.')
+
+
+def migrate_batch(batch_size):
+    """Moves a batch of artifacts to the store.
+
+    Returns:
+        The number of artifacts moved.
+    """
+    # Only load the IDs first so a batch of large BLOBs is never held in
+    # memory at the same time.
+    query = (
+        db.session.query(models.Artifact.id)
+        .filter(models.Artifact.data != None)
+        .limit(batch_size))
+    artifact_ids = [artifact_id for artifact_id, in query]
+
+    for artifact_id in artifact_ids:
+        artifact = models.Artifact.query.get(artifact_id)
+        sha1sum, alternate = artifact_store.save(artifact.data)
+        if sha1sum != artifact.id:
+            logging.warning('Artifact data does not match its hash: '
+                            'artifact_id=%r, sha1sum=%r', artifact.id, sha1sum)
+        artifact.alternate = alternate
+        artifact.data = None
+        db.session.add(artifact)
+        db.session.flush()
+        # Let the BLOB be garbage collected before loading the next one.
+        db.session.expunge(artifact)
+
+    db.session.commit()
+    return len(artifact_ids)
+
+
+def main(argv):
+    try:
+        argv = FLAGS(argv)
+    except gflags.FlagsError, e:
+        print '%s\nUsage: %s ARGS\n%s' % (e, sys.argv[0], FLAGS)
+        sys.exit(1)
+
+    logging.getLogger().setLevel(logging.INFO)
+
+    if not artifact_store.is_enabled():
+        logging.error('Must set ARTIFACT_STORE_PATH in the server config')
+        sys.exit(1)
+
+    total = 0
+    while FLAGS.limit is None or total < FLAGS.limit:
+        batch_size = FLAGS.batch_size
+        if FLAGS.limit is not None:
+            batch_size = min(batch_size, FLAGS.limit - total)
+
+        moved = migrate_batch(batch_size)
+        if not moved:
+            break
+        total += moved
+        logging.info('Moved %d artifacts to the store so far', total)
+
+    logging.info('Done. Moved %d artifacts total', total)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -33,6 +33,8 @@ FLAGS = gflags.FLAGS
 from dpxdt.client import capture_worker
 from dpxdt.client import fetch_worker
 from dpxdt.client import pdiff_worker
+from dpxdt.client import queue_worker
+from dpxdt.client import release_worker
 from dpxdt.client import timer_worker
 from dpxdt.client import workers
 from dpxdt import server
@@ -65,6 +67,8 @@ def run_workers():
     capture_worker.register(coordinator)
     fetch_worker.register(coordinator)
     pdiff_worker.register(coordinator)
+    queue_worker.register(coordinator)
+    release_worker.register(coordinator)
     timer_worker.register(coordinator)
     coordinator.start()
     logging.info('Workers started')
@@ -104,11 +108,15 @@ def main(block=True):
 
     if block:
         if FLAGS.enable_api_server:
+            threaded = server.utils.is_production()
+            if not threaded:
+                # A waiting lease request would block every other request.
+                server.app.config['WORK_QUEUE_MAX_LEASE_WAIT_SECONDS'] = 0
             server.app.run(
                 debug=FLAGS.reload_code,
                 host=FLAGS.host,
                 port=FLAGS.port,
-                threaded=server.utils.is_production())
+                threaded=threaded)
         elif FLAGS.enable_queue_workers:
             coordinator.join()
         else:
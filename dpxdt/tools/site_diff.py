@@ -63,6 +63,26 @@ gflags.DEFINE_bool(
     'keep_query_string', False,
     'Keep the query string when cleaning URLs')
 
+gflags.DEFINE_spaceseplist(
+    'viewports', [],
+    'Viewports to screenshot each page at, as NAME=WIDTHxHEIGHT, e.g. '
+    '"mobile=375x667 desktop=1280x1024". Each page is loaded once and '
+    'each viewport is saved as its own run named PATH@NAME. Overrides '
+    '--width and --height.')
+
+
+def parse_viewports(values):
+    """Parses viewports from --viewports into capture config entries."""
+    viewports = []
+    for value in values:
+        name, _, size = value.partition('=')
+        width, _, height = size.partition('x')
+        if not (name and width.isdigit() and height.isdigit()):
+            raise ValueError('Bad viewport %r, should be NAME=WIDTHxHEIGHT'
+                             % value)
+        viewports.append(dict(name=name, width=int(width), height=int(height)))
+    return viewports
+
 
 # URL regex rewriting code originally from mirrorrr
 # http://code.google.com/p/mirrorrr/source/browse/trunk/transform_content.py
@@ -279,9 +299,9 @@ class SiteDiff(workers.WorkflowItem):
         release_number = yield release_worker.CreateReleaseWorkflow(
             upload_build_id, upload_release_name, start_url)
 
+        viewports = parse_viewports(FLAGS.viewports)
         run_requests = []
         for url in good_urls:
-            yield heartbeat('Requesting run for %s' % url)
             parts = urlparse.urlparse(url)
             run_name = parts.path
 
@@ -301,6 +321,8 @@ class SiteDiff(workers.WorkflowItem):
             if FLAGS.cookies:
                 config_dict['cookies'] = json.loads(
                     open(FLAGS.cookies).read())
+            if FLAGS.resource_cache:
+                config_dict['resourceCache'] = True
             if http_username:
                 config_dict['httpUserName'] = http_username
             if http_password:
@@ -309,14 +331,19 @@ class SiteDiff(workers.WorkflowItem):
                 config_dict['viewportSize']['width'] = FLAGS.width
             if FLAGS.height:
                 config_dict['viewportSize']['height'] = FLAGS.height
+            if viewports:
+                del config_dict['viewportSize']
+                config_dict['viewports'] = viewports
 
             config_data = json.dumps(config_dict)
 
-            run_requests.append(release_worker.RequestRunWorkflow(
-                upload_build_id, upload_release_name, release_number,
-                run_name, url, config_data))
+            run_requests.append(dict(
+                run_name=run_name, url=url, config_data=config_data))
 
-        yield run_requests
+        yield heartbeat('Requesting %d runs' % len(run_requests))
+        yield release_worker.RequestRunsWorkflow(
+            upload_build_id, upload_release_name, release_number,
+            run_requests)
 
         yield heartbeat('Marking runs as complete')
         release_url = yield release_worker.RunsDoneWorkflow(
@@ -362,6 +389,12 @@ def main(argv):
     assert FLAGS.upload_build_id
     assert FLAGS.release_server_prefix
 
+    try:
+        parse_viewports(FLAGS.viewports)
+    except ValueError, e:
+        print e
+        sys.exit(1)
+
     if FLAGS.verbose:
         logging.getLogger().setLevel(logging.DEBUG)
 
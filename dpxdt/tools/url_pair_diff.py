@@ -94,6 +94,8 @@ class UrlPairDiff(workers.WorkflowItem):
             config_dict['injectCss'] = FLAGS.inject_css
         if FLAGS.inject_js:
             config_dict['injectJs'] = FLAGS.inject_js
+        if FLAGS.resource_cache:
+            config_dict['resourceCache'] = True
 
         if FLAGS.http_username:
             config_dict['httpUserName'] = FLAGS.http_username
@@ -112,15 +114,15 @@ class UrlPairDiff(workers.WorkflowItem):
         url_parts = urlparse.urlparse(new_url)
 
         yield heartbeat('Requesting captures')
-        yield release_worker.RequestRunWorkflow(
+        yield release_worker.RequestRunsWorkflow(
                 upload_build_id,
                 upload_release_name,
                 release_number,
-                url_parts.path or '/',
-                new_url,
-                config_data,
-                ref_url=baseline_url,
-                ref_config_data=config_data)
+                [dict(run_name=url_parts.path or '/',
+                      url=new_url,
+                      config_data=config_data,
+                      ref_url=baseline_url,
+                      ref_config_data=config_data)])
 
         yield heartbeat('Marking runs as complete')
         release_url = yield release_worker.RunsDoneWorkflow(
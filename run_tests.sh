@@ -3,9 +3,17 @@
 # Terminate immediately with an error if any child command fails.
 set -e
 
+./tests/artifact_store_test.py
+./tests/async_fetch_worker_test.py
+./tests/capture_worker_test.py
 ./tests/local_pdiff_test.py
 ./tests/fetch_worker_test.py
+./tests/models_test.py
+./tests/pdiff_engine_test.py
+./tests/process_worker_test.py
 ./tests/queue_worker_test.py
+./tests/release_worker_test.py
 ./tests/site_diff_test.py
 ./tests/timer_worker_test.py
+./tests/work_queue_test.py
 ./tests/workers_test.py
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# Copyright 2013 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the artifact_store module."""
+
+import StringIO
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Local Libraries
+import gflags
+FLAGS = gflags.FLAGS
+
+# Local modules
+from dpxdt import server
+from dpxdt.server import artifact_store
+from dpxdt.server import db
+from dpxdt.server import models
+from dpxdt.tools import migrate_artifacts
+
+
+class ArtifactStoreTest(unittest.TestCase):
+    """Tests for storing artifacts on the filesystem."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        self.store_dir = tempfile.mkdtemp()
+        self.db_path = tempfile.mktemp(suffix='.db')
+        server.app.config['ARTIFACT_STORE_PATH'] = self.store_dir
+        server.app.config['SQLALCHEMY_DATABASE_URI'] = (
+            'sqlite:///' + self.db_path)
+        server.app.config['IGNORE_AUTH'] = True
+        server.app.config['TESTING'] = True
+        db.drop_all()
+        db.create_all()
+
+        self.build = models.Build(name='My build')
+        db.session.add(self.build)
+        db.session.commit()
+
+        self.client = server.app.test_client()
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        server.app.config['ARTIFACT_STORE_PATH'] = None
+        db.session.remove()
+        shutil.rmtree(self.store_dir)
+        os.remove(self.db_path)
+
+    def testSave(self):
+        """Tests saving strings and streams to the store."""
+        data = 'hello world' * 100000
+        expected = hashlib.sha1(data).hexdigest()
+
+        sha1sum, alternate = artifact_store.save(data)
+        self.assertEquals(expected, sha1sum)
+        self.assertTrue(artifact_store.is_stored(alternate))
+        self.assertEquals(
+            'file:%s/%s/%s' % (expected[:2], expected[2:4], expected),
+            alternate)
+        path = artifact_store.get_path(alternate)
+        self.assertEquals(data, open(path, 'rb').read())
+
+        # Saving the same data again is a no-op.
+        self.assertEquals(
+            (sha1sum, alternate),
+            artifact_store.save(StringIO.StringIO(data)))
+        self.assertEquals(
+            [], os.listdir(os.path.join(self.store_dir, 'tmp')))
+
+    def testUploadAndDownload(self):
+        """Tests that the API reads and writes artifacts in the store."""
+        data = 'fake png data'
+        sha1sum = hashlib.sha1(data).hexdigest()
+
+        response = self.client.post('/api/upload', data={
+            'build_id': self.build.id,
+            'file': (StringIO.StringIO(data), 'screenshot.png'),
+        })
+        self.assertEquals(200, response.status_code, response.data)
+
+        artifact = models.Artifact.query.get(sha1sum)
+        self.assertTrue(artifact.data is None)
+        self.assertTrue(artifact_store.is_stored(artifact.alternate))
+
+        response = self.client.get(
+            '/api/download?build_id=%d&sha1sum=%s' % (self.build.id, sha1sum))
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(data, response.data)
+        self.assertEquals('image/png', response.mimetype)
+        self.assertEquals(sha1sum, response.get_etag()[0])
+
+    def testMigrate(self):
+        """Tests moving existing artifacts out of the database."""
+        contents = ['first', 'second', 'third']
+        for data in contents:
+            artifact = models.Artifact(
+                id=hashlib.sha1(data).hexdigest(),
+                content_type='text/plain',
+                data=data)
+            db.session.add(artifact)
+        db.session.commit()
+
+        self.assertEquals(2, migrate_artifacts.migrate_batch(2))
+        self.assertEquals(1, migrate_artifacts.migrate_batch(2))
+        self.assertEquals(0, migrate_artifacts.migrate_batch(2))
+
+        for data in contents:
+            artifact = models.Artifact.query.get(hashlib.sha1(data).hexdigest())
+            self.assertTrue(artifact.data is None)
+            path = artifact_store.get_path(artifact.alternate)
+            self.assertEquals(data, open(path, 'rb').read())
+
+
+def main(argv):
+    logging.getLogger().setLevel(logging.DEBUG)
+    argv = FLAGS(argv)
+    unittest.main(argv=argv)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# Copyright 2013 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the async_fetch_worker module."""
+
+import BaseHTTPServer
+import Queue
+import SocketServer
+import cgi
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+# Local Libraries
+import gflags
+FLAGS = gflags.FLAGS
+
+# Local modules
+from dpxdt.client import async_fetch_worker
+from dpxdt.client import fetch_worker
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handler with endpoints for exercising the event loop."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, data, status=200, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in headers.iteritems():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/slow':
+            with self.server.lock:
+                self.server.in_flight += 1
+                self.server.max_in_flight = max(
+                    self.server.max_in_flight, self.server.in_flight)
+            time.sleep(0.2)
+            with self.server.lock:
+                self.server.in_flight -= 1
+            self.respond('slow')
+        elif self.path == '/chunked':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for piece in ('hello', ' ', 'world' * 10000):
+                self.wfile.write('%x\r\n%s\r\n' % (len(piece), piece))
+            self.wfile.write('0\r\n\r\n')
+        elif self.path == '/until_close':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.end_headers()
+            self.wfile.write('all of it')
+            self.close_connection = 1
+        elif self.path == '/hang':
+            time.sleep(0.5)
+            self.respond('too late')
+        elif self.path == '/redirect':
+            self.respond('', status=302, headers={'Location': '/target'})
+        else:
+            self.respond('GET %s' % self.path)
+
+    def do_POST(self):
+        form = cgi.FieldStorage(
+            fp=self.rfile,
+            headers=self.headers,
+            environ={
+                'REQUEST_METHOD': 'POST',
+                'CONTENT_TYPE': self.headers['Content-Type'],
+            })
+        self.respond(','.join(
+            '%s=%s' % (key, form[key].value) for key in sorted(form.keys())))
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Server that tracks how many slow requests run at once."""
+
+    daemon_threads = True
+    request_queue_size = 100
+
+    def __init__(self, *args):
+        BaseHTTPServer.HTTPServer.__init__(self, *args)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def handle_error(self, request, client_address):
+        # Clients that time out close their sockets early.
+        pass
+
+
+class AsyncFetchWorkerTest(unittest.TestCase):
+    """Tests for the AsyncFetchThread."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        FLAGS.fetch_async_max_connections = 500
+        FLAGS.fetch_async_max_per_host = 100
+        FLAGS.fetch_frequency = 0
+        fetch_worker.LIMITER = fetch_worker.RateLimiter()
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server_thread = threading.Thread(
+            target=self.server.serve_forever)
+        self.server_thread.setDaemon(True)
+        self.server_thread.start()
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_port
+
+        self.input_queue = async_fetch_worker.NotifyingQueue()
+        self.output_queue = Queue.Queue()
+        self.worker = async_fetch_worker.AsyncFetchThread(
+            self.input_queue, self.output_queue)
+        self.worker.start()
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        self.worker.stop()
+        self.worker.join()
+        self.server.shutdown()
+        self.server.server_close()
+        FLAGS.fetch_frequency = 1
+
+    def fetch_all(self, items):
+        for item in items:
+            self.input_queue.put(item)
+        results = [self.output_queue.get(True, 10) for _ in items]
+        for result in results:
+            self.assertTrue(result.done)
+            self.assertEquals(None, result.error)
+        return results
+
+    def fetch(self, path, **kwargs):
+        return self.fetch_all([
+            fetch_worker.FetchItem(self.base_url + path, **kwargs)])[0]
+
+    def testGet(self):
+        """Tests a simple fetch."""
+        result = self.fetch('/hello')
+        self.assertEquals(200, result.status_code)
+        self.assertEquals('text/plain', result.content_type)
+        self.assertEquals('GET /hello', result.data)
+
+    def testConcurrent(self):
+        """Tests that many fetches run at the same time."""
+        start = time.time()
+        results = self.fetch_all([
+            fetch_worker.FetchItem(self.base_url + '/slow')
+            for _ in xrange(50)])
+        self.assertTrue(time.time() - start < 2)
+        self.assertEquals(['slow'] * 50, [r.data for r in results])
+        self.assertTrue(self.server.max_in_flight > 10)
+
+    def testPerHostLimit(self):
+        """Tests that the number of fetches to one host is capped."""
+        FLAGS.fetch_async_max_per_host = 3
+        results = self.fetch_all([
+            fetch_worker.FetchItem(self.base_url + '/slow')
+            for _ in xrange(9)])
+        self.assertEquals(['slow'] * 9, [r.data for r in results])
+        self.assertEquals(3, self.server.max_in_flight)
+
+    def testRateLimit(self):
+        """Tests that fetches over the rate limit are deferred."""
+        FLAGS.fetch_frequency = 10
+        start = time.time()
+        results = self.fetch_all([
+            fetch_worker.FetchItem(self.base_url + '/hello')
+            for _ in xrange(5)])
+        duration = time.time() - start
+        self.assertEquals(['GET /hello'] * 5, [r.data for r in results])
+        self.assertTrue(0.35 < duration < 1, duration)
+
+    def testChunked(self):
+        """Tests a response with chunked transfer encoding."""
+        result = self.fetch('/chunked')
+        self.assertEquals(200, result.status_code)
+        self.assertEquals('text/html', result.content_type)
+        self.assertEquals('hello ' + 'world' * 10000, result.data)
+
+    def testUntilClose(self):
+        """Tests a response with no length that ends when closed."""
+        self.assertEquals('all of it', self.fetch('/until_close').data)
+
+    def testResultPath(self):
+        """Tests streaming a response to a file."""
+        result_path = tempfile.mktemp()
+        try:
+            result = self.fetch('/chunked', result_path=result_path)
+            self.assertEquals(None, result.data)
+            self.assertEquals(
+                'hello ' + 'world' * 10000, open(result_path).read())
+        finally:
+            os.remove(result_path)
+
+    def testPost(self):
+        """Tests form encoded and multipart posts."""
+        result = self.fetch('/post', post={'a': 'b', 'c': None})
+        self.assertEquals('a=b', result.data)
+
+        with tempfile.NamedTemporaryFile() as upload:
+            upload.write('file contents' * 10000)
+            upload.flush()
+            upload.seek(0)
+            result = self.fetch('/post', post={'file': upload.file})
+        self.assertEquals('file=' + 'file contents' * 10000, result.data)
+
+    def testRedirect(self):
+        """Tests following a redirect."""
+        result = self.fetch('/redirect')
+        self.assertEquals(200, result.status_code)
+        self.assertEquals('GET /target', result.data)
+
+    def testTimeout(self):
+        """Tests a fetch that takes too long."""
+        result = self.fetch('/hang', timeout_seconds=0.1)
+        self.assertEquals(
+            fetch_worker.CONNECTION_ERROR_STATUS, result.status_code)
+        self.assertEquals('timeout: timed out', result.connection_error)
+
+    def testConnectionRefused(self):
+        """Tests fetching from a server that is not running."""
+        self.server.shutdown()
+        self.server.server_close()
+        result = self.fetch('/hello')
+        self.assertEquals(
+            fetch_worker.CONNECTION_ERROR_STATUS, result.status_code)
+        self.assertTrue(result.connection_error)
+
+    def testForbiddenScheme(self):
+        """Tests that some schemes are not allowed."""
+        result = self.fetch_all([fetch_worker.FetchItem('file:///etc/passwd')])
+        self.assertEquals(403, result[0].status_code)
+
+
+def main(argv):
+    logging.getLogger().setLevel(logging.DEBUG)
+    argv = FLAGS(argv)
+    unittest.main(argv=argv)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
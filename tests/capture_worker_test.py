@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# Copyright 2013 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the capture_worker module."""
+
+import Queue
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+# Local Libraries
+import gflags
+FLAGS = gflags.FLAGS
+
+# Local modules
+from dpxdt.client import capture_worker
+from dpxdt.client import process_worker
+from dpxdt.client import timer_worker
+from dpxdt.client import workers
+
+
+# Stands in for capture.js in --server and --manifest mode. Writes its pid
+# to the output path so tests can tell which process took each capture.
+FAKE_CAPTURE_SCRIPT = r"""
+import json
+import os
+import sys
+import time
+
+def capture(job):
+    config = open(job['configPath']).read()
+    if config == 'hang':
+        time.sleep(60)
+    if config == 'crash':
+        sys.exit(7)
+    print 'Capturing', config
+    open(job['outputPath'], 'w').write(str(os.getpid()))
+    print 'DPXDT-CAPTURE-DONE {"returncode": %d}' % (config == 'fail')
+    sys.stdout.flush()
+
+if sys.argv[1] == '--manifest':
+    for job in json.load(open(sys.argv[2])):
+        capture(job)
+else:
+    assert sys.argv[1:] == ['--server']
+    for line in iter(sys.stdin.readline, ''):
+        capture(json.loads(line))
+"""
+
+
+class CaptureTestWorkflow(workers.WorkflowItem):
+    """Waits for a CaptureItem and returns it."""
+
+    def run(self, item):
+        result = yield item
+        raise workers.Return(result)
+
+
+class CaptureThreadTest(unittest.TestCase):
+    """Tests for the CaptureThread."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        self.temp_dir = tempfile.mkdtemp()
+        script_path = os.path.join(self.temp_dir, 'capture.py')
+        with open(script_path, 'w') as script_file:
+            script_file.write(FAKE_CAPTURE_SCRIPT)
+
+        FLAGS.capture_binary = sys.executable
+        FLAGS.capture_script = script_path
+        FLAGS.capture_timeout = 60
+        FLAGS.capture_pool_max_jobs = 100
+
+        self.coordinator = workers.get_coordinator()
+        capture_queue = Queue.Queue()
+        self.coordinator.register(capture_worker.CaptureItem, capture_queue)
+        self.coordinator.worker_threads.append(
+            capture_worker.CaptureThread(
+                capture_queue, self.coordinator.input_queue))
+        self.coordinator.start()
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        self.coordinator.stop()
+        self.coordinator.join()
+        shutil.rmtree(self.temp_dir, True)
+
+    def capture(self, name, config):
+        """Runs a capture with the given config and returns the workflow."""
+        config_path = os.path.join(self.temp_dir, name + '.json')
+        with open(config_path, 'w') as config_file:
+            config_file.write(config)
+
+        work = CaptureTestWorkflow(capture_worker.CaptureItem(
+            os.path.join(self.temp_dir, name + '.log'),
+            config_path,
+            os.path.join(self.temp_dir, name + '.png')))
+        work.root = True
+        self.coordinator.input_queue.put(work)
+        return self.coordinator.output_queue.get(True, 10)
+
+    def read(self, path):
+        """Returns the contents of a file in the temp directory."""
+        return open(os.path.join(self.temp_dir, path)).read()
+
+    def testReuseProcess(self):
+        """Tests that one process takes many captures."""
+        first = self.capture('first', 'one')
+        second = self.capture('second', 'two')
+
+        self.assertEquals(0, first.result.returncode)
+        self.assertEquals(0, second.result.returncode)
+        self.assertEquals(self.read('first.png'), self.read('second.png'))
+        self.assertEquals('Capturing one\n', self.read('first.log'))
+        self.assertEquals('Capturing two\n', self.read('second.log'))
+
+    def testFailed(self):
+        """Tests that a failed capture's returncode is passed along."""
+        work = self.capture('first', 'fail')
+        self.assertEquals(1, work.result.returncode)
+
+    def testMaxJobs(self):
+        """Tests that the process is restarted after too many captures."""
+        FLAGS.capture_pool_max_jobs = 1
+        self.capture('first', 'one')
+        self.capture('second', 'two')
+        self.assertNotEquals(self.read('first.png'), self.read('second.png'))
+
+    def testCrash(self):
+        """Tests that a process exiting mid-capture fails and is replaced."""
+        work = self.capture('first', 'crash')
+        self.assertEquals(7, work.result.returncode)
+
+        work = self.capture('second', 'two')
+        self.assertEquals(0, work.result.returncode)
+
+    def testTimeout(self):
+        """Tests that a stuck process is killed and replaced."""
+        FLAGS.capture_timeout = 0.5
+        begin = time.time()
+        work = self.capture('first', 'hang')
+        end = time.time()
+
+        self.assertTrue(isinstance(
+            work.error[1], process_worker.TimeoutError))
+        self.assertTrue(end - begin < 5)
+
+        FLAGS.capture_timeout = 60
+        work = self.capture('second', 'two')
+        self.assertEquals(0, work.result.returncode)
+
+
+class CaptureManifestWorkflowTest(unittest.TestCase):
+    """Tests for capturing a batch of screenshots with one process."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        FLAGS.polltime = 0.01
+        self.temp_dir = tempfile.mkdtemp()
+        script_path = os.path.join(self.temp_dir, 'capture.py')
+        with open(script_path, 'w') as script_file:
+            script_file.write(FAKE_CAPTURE_SCRIPT)
+
+        FLAGS.capture_binary = sys.executable
+        FLAGS.capture_script = script_path
+        FLAGS.capture_timeout = 60
+
+        self.coordinator = workers.get_coordinator()
+        timer_worker.register(self.coordinator)
+        self.coordinator.start()
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        self.coordinator.stop()
+        self.coordinator.join()
+        shutil.rmtree(self.temp_dir, True)
+
+    def capture(self, configs):
+        """Captures a batch with the given configs and returns the jobs."""
+        jobs = []
+        for i, config in enumerate(configs):
+            config_path = os.path.join(self.temp_dir, '%d.json' % i)
+            with open(config_path, 'w') as config_file:
+                config_file.write(config)
+            jobs.append(dict(
+                config_path=config_path,
+                image_path=os.path.join(self.temp_dir, '%d.png' % i),
+                log_path=os.path.join(self.temp_dir, '%d.log' % i)))
+
+        work = capture_worker.CaptureManifestWorkflow(
+            os.path.join(self.temp_dir, 'batch'), jobs, [])
+        work.root = True
+        self.coordinator.input_queue.put(work)
+        work = self.coordinator.output_queue.get(True, 10)
+        self.assertTrue(work.error is None, work.error)
+        return jobs
+
+    def read(self, path):
+        """Returns the contents of a file in the temp directory."""
+        return open(os.path.join(self.temp_dir, path)).read()
+
+    def testBatch(self):
+        """Tests that one process takes every capture in the batch."""
+        jobs = self.capture(['one', 'fail', 'three'])
+
+        self.assertEquals(
+            [None, 'returncode=1', None],
+            [job['failure_reason'] for job in jobs])
+        self.assertEquals(self.read('0.png'), self.read('2.png'))
+        self.assertEquals('Capturing one\n', self.read('0.log'))
+        self.assertEquals('Capturing fail\n', self.read('1.log'))
+        self.assertEquals('Capturing three\n', self.read('2.log'))
+
+    def testCrash(self):
+        """Tests that captures after a crash fail."""
+        jobs = self.capture(['one', 'crash', 'three'])
+
+        self.assertEquals(
+            [None, 'returncode=7', 'returncode=7'],
+            [job['failure_reason'] for job in jobs])
+        self.assertEquals('Capturing one\n', self.read('0.log'))
+
+
+class ResourceCacheTest(unittest.TestCase):
+    """Tests for sharing resource caches between captures."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        self.temp_dir = tempfile.mkdtemp()
+        FLAGS.capture_cache_dir = os.path.join(self.temp_dir, 'cache')
+        FLAGS.capture_cache_build_mb = 1
+        FLAGS.capture_cache_size_mb = 2
+        os.makedirs(FLAGS.capture_cache_dir)
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        FLAGS.capture_cache_dir = None
+        shutil.rmtree(self.temp_dir, True)
+
+    def write_config(self, config):
+        """Writes a capture config and returns its path."""
+        config_path = os.path.join(self.temp_dir, 'config.json')
+        with open(config_path, 'w') as config_file:
+            json.dump(config, config_file)
+        return config_path
+
+    def fill_cache(self, build_id, size):
+        """Adds a file of the given size to a build's cache."""
+        cache_path = os.path.join(
+            FLAGS.capture_cache_dir, 'build-%s' % build_id)
+        with open(os.path.join(cache_path, 'data'), 'w') as data_file:
+            data_file.write('x' * size)
+
+    def testDisabled(self):
+        """Tests that captures don't share a cache unless asked to."""
+        config_path = self.write_config({'targetUrl': 'http://example.com'})
+        self.assertEquals([], capture_worker.get_cache_flags(1, config_path))
+
+        config_path = self.write_config({'resourceCache': True})
+        FLAGS.capture_cache_dir = None
+        self.assertEquals([], capture_worker.get_cache_flags(1, config_path))
+
+    def testFlags(self):
+        """Tests the phantomjs flags for a build's cache."""
+        config_path = self.write_config({'resourceCache': True})
+        cache_flags = capture_worker.get_cache_flags(1, config_path)
+
+        cache_path = os.path.join(FLAGS.capture_cache_dir, 'build-1')
+        self.assertTrue(os.path.isdir(cache_path))
+        self.assertEquals(
+            ['--disk-cache=true',
+             '--disk-cache-path=%s' % cache_path,
+             '--max-disk-cache-size=1024'],
+            cache_flags)
+
+        flags = capture_worker.get_phantomjs_flags(cache_flags)
+        self.assertFalse('--disk-cache=false' in flags)
+        self.assertTrue('--disk-cache=true' in flags)
+
+    def testEvictLeastRecentlyUsed(self):
+        """Tests that old build caches are evicted to stay under the cap."""
+        config_path = self.write_config({'resourceCache': True})
+        capture_worker.get_cache_flags(1, config_path)
+        self.fill_cache(1, 600 * 1024)
+        time.sleep(0.01)
+        capture_worker.get_cache_flags(2, config_path)
+        self.fill_cache(2, 600 * 1024)
+
+        # Using build 1 again makes build 2 the least recently used.
+        time.sleep(0.01)
+        capture_worker.get_cache_flags(1, config_path)
+        time.sleep(0.01)
+        capture_worker.get_cache_flags(3, config_path)
+
+        self.assertEquals(
+            ['build-1', 'build-3'],
+            sorted(os.listdir(FLAGS.capture_cache_dir)))
+
+
+class ViewportOutputPathTest(unittest.TestCase):
+    """Tests for get_viewport_output_path."""
+
+    def testPaths(self):
+        """Tests that the viewport index goes before the extension."""
+        self.assertEquals(
+            '/tmp/a.b/capture.1.png',
+            capture_worker.get_viewport_output_path(
+                '/tmp/a.b/capture.png', 1))
+        self.assertEquals(
+            '/tmp/a.b/capture.2',
+            capture_worker.get_viewport_output_path('/tmp/a.b/capture', 2))
+
+
+def main(argv):
+    logging.getLogger().setLevel(logging.DEBUG)
+    argv = FLAGS(argv)
+    unittest.main(argv=argv)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -15,9 +15,15 @@
 
 """Tests for the fetch_worker module."""
 
+import BaseHTTPServer
 import Queue
+import SocketServer
+import cgi
 import logging
+import os
 import sys
+import tempfile
+import threading
 import time
 import unittest
 
@@ -27,6 +33,8 @@ FLAGS = gflags.FLAGS
 
 # Local modules
 from dpxdt.client import fetch_worker
+from dpxdt.client import queue_worker
+from dpxdt.client import workers
 
 
 class FetchWorkerTest(unittest.TestCase):
@@ -47,6 +55,350 @@ class FetchWorkerTest(unittest.TestCase):
         self.assertEquals(403, result.status_code)
 
 
+class RateLimiterTest(unittest.TestCase):
+    """Tests for the RateLimiter."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        FLAGS.fetch_frequency = 2
+        FLAGS.fetch_burst = 1
+        FLAGS.fetch_rate_limit = []
+        self.limiter = fetch_worker.RateLimiter()
+
+    def testPerHost(self):
+        """Tests that each host has its own limit."""
+        self.assertEquals(0, self.limiter.reserve('http://a.com/1', now=10))
+        self.assertEquals(0.5, self.limiter.reserve('http://a.com/2', now=10))
+        self.assertEquals(0, self.limiter.reserve('http://b.com/1', now=10))
+
+    def testBookSlots(self):
+        """Tests that waiting fetches are given the next free slots."""
+        self.assertEquals(0, self.limiter.reserve('http://a.com/1', now=10))
+        self.assertEquals(0.5, self.limiter.reserve('http://a.com/2', now=10))
+        self.assertEquals(1, self.limiter.reserve('http://a.com/3', now=10))
+        self.assertEquals(
+            1.25, self.limiter.reserve('http://a.com/4', now=10.25))
+
+        # Tokens are earned back once every booked slot has passed.
+        self.assertEquals(0, self.limiter.reserve('http://a.com/5', now=12))
+
+    def testBurst(self):
+        """Tests that a burst of fetches are allowed at once."""
+        FLAGS.fetch_burst = 3
+        for i in xrange(3):
+            self.assertEquals(0, self.limiter.reserve('http://a.com/', now=10))
+        self.assertEquals(0.5, self.limiter.reserve('http://a.com/', now=10))
+
+        # Tokens refill up to the burst size.
+        for i in xrange(3):
+            self.assertEquals(0, self.limiter.reserve('http://a.com/', now=20))
+        self.assertEquals(0.5, self.limiter.reserve('http://a.com/', now=20))
+
+    def testPrefix(self):
+        """Tests limits for URL prefixes."""
+        FLAGS.fetch_rate_limit = [
+            'http://a.com/=0',
+            'http://a.com/slow/=1/2',
+        ]
+        for i in xrange(10):
+            self.assertEquals(0, self.limiter.reserve('http://a.com/fast'))
+        self.assertEquals(0, self.limiter.reserve('http://a.com/slow/1', now=10))
+        self.assertEquals(0, self.limiter.reserve('http://a.com/slow/2', now=10))
+        self.assertEquals(1, self.limiter.reserve('http://a.com/slow/3', now=10))
+
+    def testApiServer(self):
+        """Tests that fetches to the API server are never limited."""
+        FLAGS.queue_server_prefix = 'http://api.com/api/work_queue'
+        try:
+            for i in xrange(10):
+                self.assertEquals(
+                    0, self.limiter.reserve('http://api.com/api/work_queue/a'))
+            self.assertEquals(
+                0, self.limiter.reserve('http://api.com/other', now=10))
+            self.assertEquals(
+                0.5, self.limiter.reserve('http://api.com/other', now=10))
+        finally:
+            FLAGS.queue_server_prefix = None
+
+    def testParse(self):
+        """Tests parsing rate limit flags."""
+        self.assertEquals(('http://a.com/?b=c', 1.5, 1),
+                          fetch_worker.parse_rate_limit('http://a.com/?b=c=1.5'))
+        self.assertEquals(('http://a.com/', 2.0, 5),
+                          fetch_worker.parse_rate_limit('http://a.com/=2/5'))
+        self.assertRaises(ValueError, fetch_worker.parse_rate_limit, '=1')
+        self.assertRaises(ValueError, fetch_worker.parse_rate_limit, 'a=b')
+
+
+class FetchListWorkflow(workers.WorkflowItem):
+    """Workflow that fetches a list of URLs at once."""
+
+    def run(self, urls):
+        results = yield [fetch_worker.FetchItem(url) for url in urls]
+        raise workers.Return([result.status_code for result in results])
+
+
+class DeferredFetchTest(unittest.TestCase):
+    """Tests that rate limited fetches are deferred, not slept on."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        FLAGS.fetch_frequency = 10
+        FLAGS.fetch_burst = 1
+        FLAGS.fetch_rate_limit = []
+        FLAGS.fetch_threads = 1
+        FLAGS.polltime = 0.01
+        fetch_worker.LIMITER = fetch_worker.RateLimiter()
+        self.coordinator = workers.get_coordinator()
+        fetch_worker.register(self.coordinator)
+        self.coordinator.start()
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        self.coordinator.stop()
+        self.coordinator.join()
+        FLAGS.fetch_frequency = 1
+
+    def testDeferred(self):
+        """Tests fetches over the limit finish once the limit allows."""
+        # Fetches of file URLs are quick because they are forbidden.
+        urls = ['file:///%d' % i for i in xrange(5)]
+        start = time.time()
+        work = FetchListWorkflow(urls)
+        work.root = True
+        self.coordinator.input_queue.put(work)
+        finished = self.coordinator.output_queue.get(True, 5)
+        duration = time.time() - start
+
+        self.assertEquals([403] * 5, finished.result)
+        self.assertTrue(0.35 < duration < 1, duration)
+
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handler that echos requests back over persistent connections."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, data, status=200, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in headers.iteritems():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def drop_request(self):
+        """Closes the connection without responding if asked to."""
+        if getattr(self, 'drop_next', False):
+            self.server.dropped += 1
+            self.close_connection = 1
+            return True
+        return False
+
+    def do_GET(self):
+        if self.drop_request():
+            return
+        if self.path == '/redirect':
+            self.respond('', status=302, headers={'Location': '/target'})
+        elif self.path == '/redirect_loop':
+            self.respond('loop', status=302,
+                         headers={'Location': '/redirect_loop'})
+        elif self.path == '/hangup':
+            # Respond as if keeping the connection open, then close it.
+            self.respond('hangup')
+            self.close_connection = 1
+        elif self.path == '/drop_next':
+            # Keep the connection open but never answer the next request.
+            self.respond('drop next')
+            self.drop_next = True
+        else:
+            self.respond('GET %s' % self.path)
+
+    def do_POST(self):
+        if self.drop_request():
+            return
+        form = cgi.FieldStorage(
+            fp=self.rfile,
+            headers=self.headers,
+            environ={
+                'REQUEST_METHOD': 'POST',
+                'CONTENT_TYPE': self.headers['Content-Type'],
+            })
+        self.respond(','.join(
+            '%s=%s' % (key, form[key].value) for key in sorted(form.keys())))
+
+
+class KeepAliveServer(SocketServer.ThreadingMixIn,
+                      BaseHTTPServer.HTTPServer):
+    """Server that counts the connections it accepts."""
+
+    daemon_threads = True
+    connections = 0
+    dropped = 0
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    """Tests for fetching with persistent connections."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        FLAGS.fetch_pool_size = 4
+        FLAGS.fetch_pool_idle_seconds = 30
+        FLAGS.fetch_pool_stale_retries = 1
+        fetch_worker.POOL.close_all()
+
+        self.server = KeepAliveServer(('127.0.0.1', 0), KeepAliveHandler)
+        self.server_thread = threading.Thread(
+            target=self.server.serve_forever)
+        self.server_thread.setDaemon(True)
+        self.server_thread.start()
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_port
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        fetch_worker.POOL.close_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fetch(self, path, **kwargs):
+        return fetch_worker.fetch(
+            fetch_worker.FetchItem(self.base_url + path, **kwargs))
+
+    def testReuseConnection(self):
+        """Tests that sequential fetches share one connection."""
+        for i in xrange(3):
+            result = self.fetch('/get/%d' % i)
+            self.assertEquals(200, result.status_code)
+            self.assertEquals('text/plain', result.content_type)
+            self.assertEquals('GET /get/%d' % i, result.data)
+        self.assertEquals(1, self.server.connections)
+
+    def testPoolDisabled(self):
+        """Tests that every fetch opens a connection without a pool."""
+        FLAGS.fetch_pool_size = 0
+        for i in xrange(2):
+            self.assertEquals('GET /get', self.fetch('/get').data)
+        self.assertEquals(2, self.server.connections)
+
+    def testIdleTimeout(self):
+        """Tests that connections idle for too long are not reused."""
+        FLAGS.fetch_pool_idle_seconds = 0
+        self.fetch('/get')
+        time.sleep(0.01)
+        self.fetch('/get')
+        self.assertEquals(2, self.server.connections)
+
+    def testStaleConnection(self):
+        """Tests retrying when the server closed a pooled connection."""
+        self.assertEquals('hangup', self.fetch('/hangup').data)
+        time.sleep(0.1)
+        result = self.fetch('/get')
+        self.assertEquals(200, result.status_code)
+        self.assertEquals('GET /get', result.data)
+        self.assertEquals(2, self.server.connections)
+
+    def testStaleConnectionPost(self):
+        """Tests that a closed pooled connection isn't used for a post."""
+        self.fetch('/hangup')
+        time.sleep(0.1)
+        result = self.fetch('/post', post={'a': 'b'})
+        self.assertEquals(200, result.status_code)
+        self.assertEquals('a=b', result.data)
+        self.assertEquals(2, self.server.connections)
+
+    def testNoResponseRetry(self):
+        """Tests that a get with no response is sent again."""
+        self.fetch('/drop_next')
+        result = self.fetch('/get')
+        self.assertEquals(200, result.status_code)
+        self.assertEquals('GET /get', result.data)
+        self.assertEquals(1, self.server.dropped)
+        self.assertEquals(2, self.server.connections)
+
+    def testNoResponseNoRetries(self):
+        """Tests that stale connection failures are reported."""
+        FLAGS.fetch_pool_stale_retries = 0
+        self.fetch('/drop_next')
+        result = self.fetch('/get')
+        self.assertEquals(
+            fetch_worker.CONNECTION_ERROR_STATUS, result.status_code)
+        self.assertTrue(result.connection_error)
+
+    def testNoResponsePost(self):
+        """Tests that a post with no response is not sent again."""
+        self.fetch('/drop_next')
+        result = self.fetch('/post', post={'a': 'b'})
+        self.assertEquals(
+            fetch_worker.CONNECTION_ERROR_STATUS, result.status_code)
+        self.assertTrue(result.connection_error)
+        self.assertEquals(1, self.server.dropped)
+        self.assertEquals(1, self.server.connections)
+
+    def testPost(self):
+        """Tests form encoded and multipart posts."""
+        result = self.fetch('/post', post={'a': 'b', 'c': 'd', 'e': None})
+        self.assertEquals('a=b,c=d', result.data)
+
+        with tempfile.NamedTemporaryFile() as upload:
+            upload.write('file contents')
+            upload.flush()
+            upload.seek(0)
+            result = self.fetch('/post', post={'a': 'b', 'file': upload.file})
+        self.assertEquals('a=b,file=file contents', result.data)
+        self.assertEquals(1, self.server.connections)
+
+    def testResultPath(self):
+        """Tests streaming a response to a file."""
+        result_path = tempfile.mktemp()
+        try:
+            result = self.fetch('/streamed', result_path=result_path)
+            self.assertEquals(200, result.status_code)
+            self.assertEquals(None, result.data)
+            self.assertEquals('GET /streamed', open(result_path).read())
+        finally:
+            os.remove(result_path)
+
+        self.assertEquals('GET /get', self.fetch('/get').data)
+        self.assertEquals(1, self.server.connections)
+
+    def testRedirect(self):
+        """Tests following redirects on the same connection."""
+        result = self.fetch('/redirect')
+        self.assertEquals(200, result.status_code)
+        self.assertEquals('GET /target', result.data)
+        self.assertEquals(None, result.connection_error)
+        self.assertEquals(1, self.server.connections)
+
+    def testRedirectLoop(self):
+        """Tests that the last redirect is returned after too many."""
+        result = self.fetch('/redirect_loop')
+        self.assertEquals(302, result.status_code)
+        self.assertEquals('loop', result.data)
+        self.assertEquals(1, self.server.connections)
+
+        # The connection is only returned to the pool once.
+        host = '127.0.0.1:%d' % self.server.server_port
+        self.assertEquals(1, len(fetch_worker.POOL.idle[('http', host)]))
+
+    def testConnectionRefused(self):
+        """Tests fetching from a server that is not running."""
+        self.server.shutdown()
+        self.server.server_close()
+        fetch_worker.POOL.close_all()
+        result = self.fetch('/get')
+        self.assertEquals(
+            fetch_worker.CONNECTION_ERROR_STATUS, result.status_code)
+        self.assertTrue(result.connection_error)
+
+
 def main(argv):
     logging.getLogger().setLevel(logging.DEBUG)
     argv = FLAGS(argv)
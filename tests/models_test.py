@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# Copyright 2013 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the models module."""
+
+import logging
+import os
+import sys
+import tempfile
+import unittest
+
+# Local Libraries
+import gflags
+FLAGS = gflags.FLAGS
+
+# Local modules
+from dpxdt import server
+from dpxdt.server import db
+from dpxdt.server import models
+
+
+class ReleaseStatsTest(unittest.TestCase):
+    """Tests for keeping ReleaseStats up to date."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        self.db_path = tempfile.mktemp(suffix='.db')
+        server.app.config['SQLALCHEMY_DATABASE_URI'] = (
+            'sqlite:///' + self.db_path)
+        db.drop_all()
+        db.create_all()
+
+        build = models.Build(name='My build')
+        db.session.add(build)
+        db.session.commit()
+
+        self.release = models.Release(
+            name='My release',
+            number=1,
+            build_id=build.id,
+            status=models.Release.PROCESSING)
+        db.session.add(self.release)
+        db.session.commit()
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        db.session.remove()
+        os.remove(self.db_path)
+
+    def add_runs(self, count):
+        runs = []
+        for i in xrange(count):
+            run = models.Run(
+                release_id=self.release.id,
+                name='run %d' % i,
+                status=models.Run.DATA_PENDING,
+                config='config',
+                ref_config='ref config')
+            db.session.add(run)
+            runs.append(run)
+        db.session.commit()
+        return runs
+
+    def assertStats(self, **expected):
+        stats = models.get_release_stats(self.release.id)
+        actual = dict(
+            (counter, getattr(stats, counter))
+            for counter in models.ReleaseStats.COUNTERS)
+        for counter in models.ReleaseStats.COUNTERS:
+            expected.setdefault(counter, 0)
+        self.assertEquals(expected, actual)
+
+    def testNewRelease(self):
+        """Tests the stats for a release with no runs."""
+        self.assertStats()
+
+    def testAddAndUpdate(self):
+        """Tests that counts change as runs are added and updated."""
+        runs = self.add_runs(3)
+        self.assertStats(
+            data_pending=3, pending_captures=3, pending_ref_captures=3)
+
+        runs[0].image = 'image'
+        runs[0].ref_image = 'ref image'
+        runs[0].status = models.Run.NEEDS_DIFF
+        runs[1].ref_image = 'ref image'
+        db.session.commit()
+        self.assertStats(
+            data_pending=2, needs_diff=1,
+            pending_captures=2, pending_ref_captures=1)
+
+        runs[0].status = models.Run.DIFF_FOUND
+        db.session.commit()
+        self.assertStats(
+            data_pending=2, diff_found=1,
+            pending_captures=2, pending_ref_captures=1)
+
+        db.session.delete(runs[2])
+        db.session.commit()
+        self.assertStats(
+            data_pending=1, diff_found=1,
+            pending_captures=1, pending_ref_captures=0)
+
+    def testMissingStats(self):
+        """Tests that stats missing for older releases are recounted."""
+        runs = self.add_runs(2)
+        runs[0].status = models.Run.FAILED
+        db.session.commit()
+
+        db.session.execute(models.ReleaseStats.__table__.delete())
+        db.session.commit()
+        self.assertStats(
+            data_pending=1, failed=1,
+            pending_captures=2, pending_ref_captures=2)
+
+        # Updates work again once the stats have been recounted.
+        runs[1].status = models.Run.FAILED
+        db.session.commit()
+        self.assertStats(
+            failed=2, pending_captures=2, pending_ref_captures=2)
+
+    def testExpiredAttribute(self):
+        """Tests changing a run field that was expired and not reloaded."""
+        runs = self.add_runs(1)
+        runs[0].status = models.Run.FAILED
+        db.session.commit()
+
+        db.session.expire(runs[0], ['status'])
+        runs[0].status = models.Run.NEEDS_DIFF
+        db.session.commit()
+        self.assertStats(
+            needs_diff=1, pending_captures=1, pending_ref_captures=1)
+
+    def testInsertRace(self):
+        """Tests that stats inserted by another transaction are reused."""
+        self.add_runs(1)
+        self.assertFalse(
+            models._insert_release_stats(db.session, self.release.id))
+        db.session.commit()
+        self.assertStats(
+            data_pending=1, pending_captures=1, pending_ref_captures=1)
+
+    def testBulkUpdate(self):
+        """Tests that Query.update() on Runs is refused."""
+        self.add_runs(1)
+        self.assertRaises(
+            AssertionError,
+            models.Run.query.update,
+            {'status': models.Run.FAILED})
+        db.session.rollback()
+        self.assertStats(
+            data_pending=1, pending_captures=1, pending_ref_captures=1)
+
+
+
+def main(argv):
+    logging.getLogger().setLevel(logging.DEBUG)
+    argv = FLAGS(argv)
+    unittest.main(argv=argv)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
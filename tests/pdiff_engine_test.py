@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+# Copyright 2013 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the pdiff_engine module."""
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+# Local libraries
+import numpy
+from PIL import Image
+
+# Local modules
+from dpxdt.client import pdiff_engine
+
+
+def write_filtered_png(path, pixels):
+    """Writes RGBA pixels to a PNG that uses every row filter type in turn.
+
+    The image data is split over many IDAT chunks.
+    """
+    def paeth(a, b, c):
+        p = a + b - c
+        pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+        if pa <= pb and pa <= pc:
+            return a
+        if pb <= pc:
+            return b
+        return c
+
+    height, width = pixels.shape[:2]
+    previous = [0] * (width * 4)
+    rows = []
+    for y in xrange(height):
+        row = [int(x) for x in pixels[y].ravel()]
+        filter_type = y % 5
+        filtered = []
+        for i, x in enumerate(row):
+            a = row[i - 4] if i >= 4 else 0
+            b = previous[i]
+            c = previous[i - 4] if i >= 4 else 0
+            predictor = [0, a, b, (a + b) // 2, paeth(a, b, c)][filter_type]
+            filtered.append((x - predictor) % 256)
+        rows.append(chr(filter_type) + ''.join(map(chr, filtered)))
+        previous = row
+
+    def chunk(chunk_type, data):
+        return (struct.pack('>I', len(data)) + chunk_type + data +
+                struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+    data = zlib.compress(''.join(rows))
+    with open(path, 'wb') as png_file:
+        png_file.write('\x89PNG\r\n\x1a\n')
+        png_file.write(chunk('IHDR', struct.pack(
+            '>IIBBBBB', width, height, 8, 6, 0, 0, 0)))
+        for start in xrange(0, len(data), 100):
+            png_file.write(chunk('IDAT', data[start:start + 100]))
+        png_file.write(chunk('IEND', ''))
+
+
+class OpenImageTest(unittest.TestCase):
+    """Tests for reading images one band of rows at a time."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        shutil.rmtree(self.tmp_dir, True)
+
+    def check_bands(self, image, band_class):
+        """Checks reading an image in bands matches decoding all of it."""
+        path = os.path.join(self.tmp_dir, 'image.png')
+        image.save(path, 'PNG')
+        expected = numpy.asarray(Image.open(path).convert('RGBA'))
+
+        bands = pdiff_engine.open_image(path)
+        try:
+            self.assertTrue(type(bands) is band_class, type(bands))
+            self.assertEquals(image.size, bands.size)
+            actual = numpy.concatenate(
+                [bands.read_band(rows, image.size[0])
+                 for rows in (1, 7, 20, 12)])
+        finally:
+            bands.close()
+
+        self.assertEquals(expected.shape, actual.shape)
+        self.assertTrue(numpy.array_equal(expected, actual))
+
+    def testPngModes(self):
+        """Tests each kind of 8-bit PNG is read one band at a time."""
+        gradient = numpy.arange(40 * 30 * 4).reshape(40, 30, 4) * 7 % 256
+        image = Image.fromarray(gradient.astype(numpy.uint8), 'RGBA')
+        for mode in ('RGBA', 'RGB', 'LA', 'L'):
+            self.check_bands(image.convert(mode), pdiff_engine.PngBands)
+        self.check_bands(
+            image.convert('RGB').convert('P', palette=Image.ADAPTIVE),
+            pdiff_engine.PngBands)
+
+    def testPngFilters(self):
+        """Tests rows that refer back to the band before are decoded."""
+        path = os.path.join(self.tmp_dir, 'image.png')
+        pixels = (numpy.arange(40 * 30 * 4).reshape(40, 30, 4) * 7 +
+                  numpy.arange(40).reshape(40, 1, 1) ** 2) % 256
+        write_filtered_png(path, pixels.astype(numpy.uint8))
+
+        bands = pdiff_engine.open_image(path)
+        self.assertTrue(type(bands) is pdiff_engine.PngBands)
+        actual = numpy.concatenate(
+            [bands.read_band(rows, 30) for rows in (1, 7, 20, 12)])
+        bands.close()
+        self.assertTrue(numpy.array_equal(pixels, actual))
+
+    def testOtherImages(self):
+        """Tests images that are not 8-bit PNGs are decoded in full."""
+        image = Image.new('1', (30, 40))
+        image.putpixel((3, 4), 1)
+        self.check_bands(image, pdiff_engine.ImageBands)
+
+    def testPadding(self):
+        """Tests reading past the edges of an image pads it."""
+        path = os.path.join(self.tmp_dir, 'image.png')
+        Image.new('RGB', (2, 2), (10, 20, 30)).save(path, 'PNG')
+
+        bands = pdiff_engine.open_image(path)
+        band = bands.read_band(3, 3)
+        self.assertEquals((3, 3, 4), band.shape)
+        self.assertEquals([10, 20, 30, 255], list(band[1, 1]))
+        self.assertEquals([0, 0, 0, 0], list(band[1, 2]))
+        self.assertEquals([0, 0, 0, 0], list(band[2, 0]))
+        bands.close()
+
+    def testTruncated(self):
+        """Tests that a truncated PNG raises an error."""
+        path = os.path.join(self.tmp_dir, 'image.png')
+        image = numpy.arange(40 * 30 * 3).reshape(40, 30, 3) % 256
+        Image.fromarray(image.astype(numpy.uint8), 'RGB').save(path, 'PNG')
+        data = open(path, 'rb').read()
+        open(path, 'wb').write(data[:len(data) // 2])
+
+        bands = pdiff_engine.open_image(path)
+        self.assertRaises(pdiff_engine.DecodeError, bands.read_band, 40, 30)
+        bands.close()
+
+
+class DiffFilesTest(unittest.TestCase):
+    """Tests for diffing image files in-process."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.output_path = os.path.join(self.tmp_dir, 'diff.png')
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        shutil.rmtree(self.tmp_dir, True)
+
+    def write_image(self, name, pixels, mode='RGB'):
+        path = os.path.join(self.tmp_dir, name)
+        Image.fromarray(numpy.asarray(pixels, dtype=numpy.uint8), mode).save(
+            path, 'PNG')
+        return path
+
+    def testSame(self):
+        """Tests that identical images have no distortion or output."""
+        pixels = numpy.full((30, 20, 3), 128)
+        ref_path = self.write_image('ref.png', pixels)
+        run_path = self.write_image('run.png', pixels)
+
+        result = pdiff_engine.diff_files(ref_path, run_path, self.output_path)
+        self.assertEquals(0, result.distortion)
+        self.assertEquals(0, result.pixels_changed)
+        self.assertFalse(os.path.exists(self.output_path))
+
+    def testDifferent(self):
+        """Tests the RMSE and highlight image of different images."""
+        ref_path = self.write_image('ref.png', numpy.zeros((1, 2, 3)))
+        run_path = self.write_image('run.png', [[[255, 255, 255], [0, 0, 0]]])
+
+        result = pdiff_engine.diff_files(ref_path, run_path, self.output_path)
+        self.assertAlmostEqual(0.5 ** 0.5, result.distortion, places=6)
+        self.assertEquals(1, result.pixels_changed)
+
+        highlight = numpy.asarray(Image.open(self.output_path))
+        self.assertEquals(
+            list(pdiff_engine.HIGHLIGHT_COLOR), list(highlight[0, 0]))
+        self.assertEquals(
+            list(pdiff_engine.LOWLIGHT_COLOR), list(highlight[0, 1]))
+
+    def testPadAndCrop(self):
+        """Tests the reference is fit to the size of the new image."""
+        ref_path = self.write_image(
+            'ref.png', numpy.full((2, 4, 4), 255), mode='RGBA')
+        run_path = self.write_image(
+            'run.png', numpy.full((4, 2, 4), 255), mode='RGBA')
+
+        result = pdiff_engine.diff_files(ref_path, run_path, self.output_path)
+        self.assertEquals(2, result.width)
+        self.assertEquals(4, result.height)
+        self.assertEquals((4, 2), result.ref_size)
+        # Bottom half of the new image is missing from the reference.
+        self.assertEquals(4, result.pixels_changed)
+        self.assertAlmostEqual(0.5 ** 0.5, result.distortion, places=6)
+
+    def testBands(self):
+        """Tests that changes are found in every band of rows."""
+        old_band_rows = pdiff_engine.BAND_ROWS
+        pdiff_engine.BAND_ROWS = 3
+        try:
+            ref_path = self.write_image('ref.png', numpy.zeros((10, 4, 3)))
+            run_pixels = numpy.zeros((10, 4, 3))
+            run_pixels[2:4, 1] = 255
+            run_pixels[9, 3] = 255
+            run_path = self.write_image('run.png', run_pixels)
+
+            result = pdiff_engine.diff_files(
+                ref_path, run_path, self.output_path)
+        finally:
+            pdiff_engine.BAND_ROWS = old_band_rows
+
+        self.assertEquals(3, result.pixels_changed)
+        self.assertAlmostEqual(
+            (9.0 / 120) ** 0.5, result.distortion, places=6)
+
+        highlight = numpy.asarray(Image.open(self.output_path))
+        self.assertEquals((10, 4, 4), highlight.shape)
+        changed = numpy.all(
+            highlight == pdiff_engine.HIGHLIGHT_COLOR, axis=2)
+        self.assertEquals(
+            [(2, 1), (3, 1), (9, 3)], zip(*numpy.nonzero(changed)))
+
+    def testPadPalette(self):
+        """Tests that padding a palette image uses transparent pixels."""
+        ref_path = os.path.join(self.tmp_dir, 'ref.png')
+        Image.new('P', (2, 1), 0).save(ref_path, 'PNG')
+        run_path = self.write_image(
+            'run.png', numpy.zeros((2, 2, 4)), mode='RGBA')
+
+        result = pdiff_engine.diff_files(ref_path, run_path)
+        # Only the opaque reference row differs from the transparent image.
+        self.assertEquals(2, result.pixels_changed)
+
+    def testTiles(self):
+        """Tests diffing by tiles finds the same changes in regions."""
+        ref_pixels = numpy.zeros((100, 20, 3))
+        run_pixels = ref_pixels.copy()
+        run_pixels[2:4, 3:5] = 255
+        # Crosses from one tile into the next, so the tiles are merged.
+        run_pixels[48:52, 10] = 255
+        ref_path = self.write_image('ref.png', ref_pixels)
+        run_path = self.write_image('run.png', run_pixels)
+
+        full = pdiff_engine.diff_files(ref_path, run_path)
+        result = pdiff_engine.diff_files(
+            ref_path, run_path, self.output_path, tile_size=10)
+
+        self.assertAlmostEqual(full.distortion, result.distortion, places=6)
+        self.assertEquals(8, result.pixels_changed)
+        self.assertEquals(
+            [(3, 2, 5, 4, 4), (10, 48, 11, 52, 4)], result.regions)
+
+        # The highlight image lines up with the new image.
+        highlight = numpy.asarray(Image.open(self.output_path))
+        self.assertEquals((100, 20, 4), highlight.shape)
+        self.assertEquals(
+            list(pdiff_engine.HIGHLIGHT_COLOR), list(highlight[2, 3]))
+        self.assertEquals(
+            list(pdiff_engine.HIGHLIGHT_COLOR), list(highlight[51, 10]))
+        self.assertEquals(
+            list(pdiff_engine.LOWLIGHT_COLOR), list(highlight[0, 0]))
+        self.assertEquals(
+            list(pdiff_engine.LOWLIGHT_COLOR), list(highlight[2, 5]))
+
+        log_data = pdiff_engine.format_log('ref', 'run', result)
+        self.assertIn('Changed regions: 2', log_data)
+        self.assertIn('1x4+10+48: 4 pixels', log_data)
+
+    def testTilesSame(self):
+        """Tests diffing identical images by tiles writes nothing."""
+        pixels = numpy.full((100, 20, 3), 128)
+        ref_path = self.write_image('ref.png', pixels)
+        run_path = self.write_image('run.png', pixels)
+
+        result = pdiff_engine.diff_files(
+            ref_path, run_path, self.output_path, tile_size=10)
+        self.assertEquals(0, result.distortion)
+        self.assertEquals([], result.regions)
+        self.assertFalse(os.path.exists(self.output_path))
+
+    def testBadImage(self):
+        """Tests that undecodable images raise an error."""
+        ref_path = os.path.join(self.tmp_dir, 'ref.png')
+        open(ref_path, 'w').write('not an image')
+        run_path = self.write_image('run.png', numpy.zeros((1, 1, 3)))
+
+        self.assertRaises(
+            pdiff_engine.DecodeError,
+            pdiff_engine.diff_files, ref_path, run_path, self.output_path)
+
+    def testLogMatchesImageMagick(self):
+        """Tests the log can be parsed the same way as ImageMagick's."""
+        from dpxdt.client import pdiff_worker
+        result = pdiff_engine.DiffResult(0.25, 10, 20, 30, (20, 30))
+        log_data = pdiff_engine.format_log('ref', 'run', result)
+        self.assertEquals(['0.25'], pdiff_worker.DIFF_REGEX.findall(log_data))
+
+        result = pdiff_engine.DiffResult(0, 0, 20, 30, (20, 30))
+        log_data = pdiff_engine.format_log('ref', 'run', result)
+        self.assertIn('all: 0 (0)', log_data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# Copyright 2013 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the process_worker module."""
+
+import Queue
+import logging
+import sys
+import tempfile
+import time
+import unittest
+
+# Local Libraries
+import gflags
+FLAGS = gflags.FLAGS
+
+# Local modules
+from dpxdt.client import process_worker
+from dpxdt.client import timer_worker
+from dpxdt.client import workers
+
+
+class PythonWorkflow(process_worker.ProcessWorkflow):
+    """Runs a snippet of Python code in a subprocess."""
+
+    def __init__(self, code, log_path, timeout_seconds=30):
+        process_worker.ProcessWorkflow.__init__(
+            self, log_path, timeout_seconds=timeout_seconds)
+        self.code = code
+
+    def get_args(self):
+        return [sys.executable, '-c', self.code]
+
+
+class ProcessWorkflowTest(unittest.TestCase):
+    """Tests for the ProcessWorkflow."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        FLAGS.polltime = 0.01
+        self.coordinator = workers.get_coordinator()
+        timer_worker.register(self.coordinator)
+        self.coordinator.start()
+        self.log_path = tempfile.mktemp()
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        self.coordinator.stop()
+        self.coordinator.join()
+
+    def run_workflow(self, work):
+        """Runs a workflow and returns it once it has finished."""
+        work.root = True
+        self.coordinator.input_queue.put(work)
+        return self.coordinator.output_queue.get(True, 10)
+
+    def testReturnCode(self):
+        """Tests that the subprocess exit code is returned right away."""
+        begin = time.time()
+        work = self.run_workflow(
+            PythonWorkflow('import sys; sys.exit(3)', self.log_path))
+        end = time.time()
+
+        self.assertTrue(work.error is None)
+        self.assertEquals(3, work.result)
+        self.assertTrue(end - begin < 2)
+
+    def testTimeout(self):
+        """Tests that a subprocess that runs too long is killed."""
+        begin = time.time()
+        work = self.run_workflow(PythonWorkflow(
+            'import time; time.sleep(60)', self.log_path,
+            timeout_seconds=0.5))
+        end = time.time()
+
+        self.assertTrue(isinstance(
+            work.error[1], process_worker.TimeoutError))
+        self.assertTrue(end - begin < 5)
+
+
+def main(argv):
+    logging.getLogger().setLevel(logging.DEBUG)
+    argv = FLAGS(argv)
+    unittest.main(argv=argv)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -30,6 +30,7 @@ from dpxdt.client import fetch_worker
 from dpxdt.client import queue_worker
 from dpxdt.client import timer_worker
 from dpxdt.client import workers
+from dpxdt import server
 from dpxdt.server import db
 from dpxdt.server import work_queue
 from dpxdt.tools import run_server
@@ -56,6 +57,37 @@ class TestQueueWorkflow(workers.WorkflowItem):
         yield heartbeat('Inside the workflow!')
 
 
+class TestQueueBatchWorkflow(workers.WorkflowItem):
+    batches = []
+    running = 0
+    max_running = 0
+
+    def run(self, payloads):
+        TestQueueBatchWorkflow.batches.append([p['foo'] for p in payloads])
+        TestQueueBatchWorkflow.running += 1
+        TestQueueBatchWorkflow.max_running = max(
+            TestQueueBatchWorkflow.max_running,
+            TestQueueBatchWorkflow.running)
+        try:
+            yield [p['heartbeat']('Inside the batch!') for p in payloads]
+        finally:
+            TestQueueBatchWorkflow.running -= 1
+
+        exceptions = []
+        for payload in payloads:
+            if payload['foo'] == 0:
+                exceptions.append(queue_worker.GiveUpAfterAttemptsError(1))
+            else:
+                exceptions.append(None)
+        raise workers.Return(exceptions)
+
+
+class SlowQueueBatchWorkflow(workers.WorkflowItem):
+    def run(self, payloads):
+        yield timer_worker.TimerItem(1.5)
+        raise workers.Return([None] * len(payloads))
+
+
 class RemoteQueueWorkflowTest(unittest.TestCase):
     """Tests for the RemoteQueueWorkflow."""
 
@@ -63,8 +95,10 @@ class RemoteQueueWorkflowTest(unittest.TestCase):
         """Sets up the test harness."""
         FLAGS.queue_idle_poll_seconds = 0.01
         FLAGS.queue_busy_poll_seconds = 0.01
+        FLAGS.queue_lease_wait_seconds = 1
         self.coordinator = workers.get_coordinator()
         fetch_worker.register(self.coordinator)
+        queue_worker.register(self.coordinator)
         timer_worker.register(self.coordinator)
         self.coordinator.start()
 
@@ -101,6 +135,223 @@ class RemoteQueueWorkflowTest(unittest.TestCase):
             found = work_queue.WorkQueue.query.get((task_id, TEST_QUEUE))
             self.assertEquals(work_queue.WorkQueue.DONE, found.status)
 
+    def testLeaseBatches(self):
+        """Tests leasing tasks in batches and finishing them one by one."""
+        queue_name = TEST_QUEUE + '-batch'
+        task_ids = []
+        for i in xrange(10):
+            next_id = work_queue.add(queue_name, payload={'foo': i})
+            task_ids.append(next_id)
+        db.session.commit()
+
+        TestQueueBatchWorkflow.batches = []
+        TestQueueBatchWorkflow.max_running = 0
+        item = queue_worker.RemoteQueueWorkflow(
+            queue_name,
+            TestQueueWorkflow,
+            max_tasks=1,
+            local_batch_workflow=TestQueueBatchWorkflow,
+            batch_size=3,
+            batch_key=lambda payload: payload['foo'] % 2)
+        item.root = True
+        self.coordinator.input_queue.put(item)
+        time.sleep(5)
+        item.stop()
+        self.coordinator.wait_one()
+
+        db.session.flush()
+        for i, task_id in enumerate(task_ids):
+            found = work_queue.WorkQueue.query.get((task_id, queue_name))
+            if i == 0:
+                self.assertEquals(work_queue.WorkQueue.ERROR, found.status)
+            else:
+                self.assertEquals(work_queue.WorkQueue.DONE, found.status)
+
+        for batch in TestQueueBatchWorkflow.batches:
+            self.assertTrue(len(batch) <= 3)
+            self.assertEquals(1, len(set(foo % 2 for foo in batch)))
+
+        # Tasks with both keys are leased together, but only one batch may
+        # run at a time.
+        self.assertEquals(1, TestQueueBatchWorkflow.max_running)
+        self.assertEquals(
+            range(10),
+            sorted(sum(TestQueueBatchWorkflow.batches, [])))
+
+    def testPendingLeaseExpires(self):
+        """Tests that tasks waiting too long for a batch are left to retry."""
+        queue_name = TEST_QUEUE + '-pending'
+        task_ids = [
+            work_queue.add(queue_name, payload={'foo': i})
+            for i in xrange(2)]
+        db.session.commit()
+
+        item = queue_worker.RemoteQueueWorkflow(
+            queue_name,
+            TestQueueWorkflow,
+            max_tasks=1,
+            local_batch_workflow=SlowQueueBatchWorkflow,
+            batch_size=2,
+            batch_key=lambda payload: payload['foo'],
+            batch_lease_seconds=2)
+        item.root = True
+        self.coordinator.input_queue.put(item)
+        time.sleep(5)
+        item.stop()
+        self.coordinator.wait_one()
+
+        # The second task waited longer than half its lease for the first
+        # batch, so it was only run after the server leased it again.
+        db.session.flush()
+        first, second = [
+            work_queue.WorkQueue.query.get((task_id, queue_name))
+            for task_id in task_ids]
+        self.assertEquals(work_queue.WorkQueue.DONE, first.status)
+        self.assertEquals(1, first.lease_attempts)
+        self.assertEquals(work_queue.WorkQueue.DONE, second.status)
+        self.assertEquals(2, second.lease_attempts)
+
+    def testLongPoll(self):
+        """Tests that an idle worker is woken up when a task is added."""
+        # Only a waiting lease can pick up the task in time.
+        FLAGS.queue_idle_poll_seconds = 60
+        FLAGS.queue_lease_wait_seconds = 4
+
+        item = queue_worker.RemoteQueueWorkflow(
+            TEST_QUEUE + '-long-poll',
+            TestQueueWorkflow,
+            max_tasks=1)
+        item.root = True
+        self.coordinator.input_queue.put(item)
+        time.sleep(0.5)
+
+        task_id = work_queue.add(TEST_QUEUE + '-long-poll', payload={'foo': 1})
+        db.session.commit()
+
+        start = time.time()
+        while time.time() - start < 2:
+            db.session.rollback()
+            found = work_queue.WorkQueue.query.get(
+                (task_id, TEST_QUEUE + '-long-poll'))
+            if found.status == work_queue.WorkQueue.DONE:
+                break
+            time.sleep(0.1)
+        self.assertEquals(work_queue.WorkQueue.DONE, found.status)
+
+        item.stop()
+        self.coordinator.wait_one()
+
+    def testLongPollOtherProcess(self):
+        """Tests that a waiting lease finds tasks added by another process."""
+        FLAGS.queue_idle_poll_seconds = 60
+        FLAGS.queue_lease_wait_seconds = 4
+        server.app.config['WORK_QUEUE_LEASE_RECHECK_SECONDS'] = 0.2
+
+        try:
+            item = queue_worker.RemoteQueueWorkflow(
+                TEST_QUEUE + '-other-process',
+                TestQueueWorkflow,
+                max_tasks=1)
+            item.root = True
+            self.coordinator.input_queue.put(item)
+            time.sleep(0.5)
+
+            # Tasks added by another process don't wake up this one.
+            task_id = work_queue.add(
+                TEST_QUEUE + '-other-process', payload={'foo': 1})
+            db.session.info.pop('work_queue_added')
+            db.session.commit()
+
+            start = time.time()
+            while time.time() - start < 2:
+                db.session.rollback()
+                found = work_queue.WorkQueue.query.get(
+                    (task_id, TEST_QUEUE + '-other-process'))
+                if found.status == work_queue.WorkQueue.DONE:
+                    break
+                time.sleep(0.1)
+            self.assertEquals(work_queue.WorkQueue.DONE, found.status)
+
+            item.stop()
+            self.coordinator.wait_one()
+        finally:
+            server.app.config['WORK_QUEUE_LEASE_RECHECK_SECONDS'] = 5
+
+
+class TaskUpdateThreadTest(unittest.TestCase):
+    """Tests for batching heartbeats and finishes with TaskUpdateThread."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        FLAGS.queue_update_seconds = 0.5
+        self.queue_url = '%s/%s' % (
+            FLAGS.queue_server_prefix, TEST_QUEUE + '-updates')
+        self.input_queue = Queue.Queue()
+        self.output_queue = Queue.Queue()
+        self.worker = queue_worker.TaskUpdateThread(
+            self.input_queue, self.output_queue)
+        self.worker.start()
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        FLAGS.queue_update_seconds = 0
+        self.worker.stop()
+        self.worker.join()
+
+    def lease_tasks(self, count):
+        for i in xrange(count):
+            work_queue.add(TEST_QUEUE + '-updates', payload={'foo': i})
+        db.session.commit()
+        tasks = work_queue.lease(
+            TEST_QUEUE + '-updates', '127.0.0.1', count=count)
+        db.session.commit()
+        return [task['task_id'] for task in tasks]
+
+    def testBatch(self):
+        """Tests that updates are coalesced and applied together."""
+        first_id, second_id = self.lease_tasks(2)
+        items = [
+            queue_worker.HeartbeatItem(self.queue_url, first_id, 'one', 0),
+            queue_worker.HeartbeatItem(self.queue_url, first_id, 'three', 2),
+            queue_worker.HeartbeatItem(self.queue_url, first_id, 'two', 1),
+            queue_worker.HeartbeatItem(self.queue_url, 'bad', 'nope', 0),
+            queue_worker.FinishItem(self.queue_url, second_id),
+        ]
+        for item in items:
+            self.input_queue.put(item)
+        results = [self.output_queue.get(True, 5) for _ in items]
+
+        for result in results:
+            self.assertTrue(result.done)
+            self.assertEquals(200, result.status_code)
+        for item in items[:3] + items[4:]:
+            self.assertEquals(True, item.json['success'])
+        self.assertTrue('bad' in items[3].json['error'])
+
+        db.session.rollback()
+        first = work_queue.WorkQueue.query.get(
+            (first_id, TEST_QUEUE + '-updates'))
+        self.assertEquals('three', first.heartbeat)
+        self.assertEquals(2, first.heartbeat_number)
+        self.assertEquals(work_queue.WorkQueue.LIVE, first.status)
+
+        second = work_queue.WorkQueue.query.get(
+            (second_id, TEST_QUEUE + '-updates'))
+        self.assertEquals(work_queue.WorkQueue.DONE, second.status)
+
+    def testFinishError(self):
+        """Tests finishing a task as an error."""
+        task_id, = self.lease_tasks(1)
+        item = queue_worker.FinishItem(self.queue_url, task_id, error=True)
+        self.input_queue.put(item)
+        self.output_queue.get(True, 5)
+        self.assertEquals(True, item.json['success'])
+
+        db.session.rollback()
+        found = work_queue.WorkQueue.query.get(
+            (task_id, TEST_QUEUE + '-updates'))
+        self.assertEquals(work_queue.WorkQueue.ERROR, found.status)
+
 
 def main(argv):
     logging.getLogger().setLevel(logging.DEBUG)
@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+# Copyright 2013 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the release_worker module."""
+
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import unittest
+import uuid
+
+# Local Libraries
+import gflags
+FLAGS = gflags.FLAGS
+
+# Local modules
+from dpxdt import server
+from dpxdt.client import fetch_worker
+from dpxdt.client import release_worker
+from dpxdt.client import timer_worker
+from dpxdt.client import workers
+from dpxdt.server import db
+from dpxdt.server import models
+from dpxdt.server import work_queue
+from dpxdt.tools import run_server
+
+# Test-only modules
+import test_utils
+
+
+# Will be set by one-time setUp
+server_thread = None
+
+
+def setUpModule():
+    """Sets up the environment for testing."""
+    global server_thread
+    server_thread = test_utils.start_server()
+
+
+class ReportRunsWorkflow(workers.WorkflowItem):
+    """Reports many runs in parallel."""
+
+    def run(self, build_id, release_name, release_number, log_path, count):
+        yield [
+            release_worker.ReportRunWorkflow(
+                build_id, release_name, release_number, 'run-%d' % i,
+                log_path=log_path, url='http://example.com/%d' % i,
+                run_failed=(i % 2 == 0))
+            for i in xrange(count)
+        ]
+
+
+class ReportRunsTest(unittest.TestCase):
+    """Tests for reporting runs in batches."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        FLAGS.report_runs_batch_size = 4
+        FLAGS.report_runs_wait_seconds = 0.1
+
+        self.coordinator = workers.get_coordinator()
+        fetch_worker.register(self.coordinator)
+        release_worker.register(self.coordinator)
+        timer_worker.register(self.coordinator)
+        self.coordinator.start()
+
+        self.build = models.Build(name='My build')
+        db.session.add(self.build)
+        db.session.commit()
+
+        self.release = models.Release(
+            name=uuid.uuid4().hex,
+            number=1,
+            build_id=self.build.id,
+            status=models.Release.PROCESSING)
+        db.session.add(self.release)
+        db.session.commit()
+
+        self.log_path = tempfile.mktemp()
+        with open(self.log_path, 'w') as log_file:
+            log_file.write('Some log output')
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        FLAGS.report_runs_batch_size = 1
+        self.coordinator.stop()
+        self.coordinator.join()
+        os.remove(self.log_path)
+
+    def testReportRuns(self):
+        """Tests that concurrent reports are coalesced."""
+        item = ReportRunsWorkflow(
+            self.build.id, self.release.name, self.release.number,
+            self.log_path, 10)
+        item.root = True
+        self.coordinator.input_queue.put(item)
+        self.coordinator.wait_one()
+        self.assertTrue(item.error is None, item.error)
+
+        runs = (
+            models.Run.query
+            .filter_by(release_id=self.release.id)
+            .order_by(models.Run.name)
+            .all())
+        self.assertEquals(10, len(runs))
+        for run in runs:
+            index = int(run.name.split('-')[1])
+            self.assertEquals('http://example.com/%d' % index, run.url)
+            self.assertTrue(run.log)
+            if index % 2 == 0:
+                self.assertEquals(models.Run.FAILED, run.status)
+            else:
+                self.assertEquals(models.Run.DATA_PENDING, run.status)
+
+    def testReportIdenticalImages(self):
+        """Tests that identical images are not diffed."""
+        sha1sum = hashlib.sha1(open(self.log_path).read()).hexdigest()
+        item = release_worker.ReportRunWorkflow(
+            self.build.id, self.release.name, self.release.number, 'run',
+            log_path=self.log_path, image_path=self.log_path,
+            url='http://example.com', ref_url='http://example.com',
+            ref_image=sha1sum, ref_log=sha1sum)
+        item.root = True
+        self.coordinator.input_queue.put(item)
+        self.coordinator.wait_one()
+        self.assertTrue(item.error is None, item.error)
+
+        run = models.Run.query.filter_by(release_id=self.release.id).one()
+        self.assertEquals(models.Run.DIFF_NOT_FOUND, run.status)
+        self.assertEquals([], work_queue.query(run_id=run.id))
+
+    def run_workflow(self, item):
+        item.root = True
+        self.coordinator.input_queue.put(item)
+        self.coordinator.wait_one()
+        self.assertTrue(item.error is None, item.error)
+        return item.result
+
+    def report_diff_twice(self, parameters):
+        """Diffs the same images in two builds, reporting only the first.
+
+        Returns:
+            Tuple (first_run, second_run).
+        """
+        image_path = tempfile.mktemp()
+        ref_path = tempfile.mktemp()
+        with open(image_path, 'w') as handle:
+            handle.write(uuid.uuid4().hex)
+        with open(ref_path, 'w') as handle:
+            handle.write(uuid.uuid4().hex)
+
+        try:
+            ref_image, = self.run_workflow(release_worker.UploadFilesWorkflow(
+                self.build.id, [ref_path]))
+
+            other_build = models.Build(name='Other build')
+            db.session.add(other_build)
+            db.session.commit()
+            other_release = models.Release(
+                name=uuid.uuid4().hex,
+                number=1,
+                build_id=other_build.id,
+                status=models.Release.PROCESSING)
+            db.session.add(other_release)
+            db.session.commit()
+
+            for build, release in ((self.build, self.release),
+                                   (other_build, other_release)):
+                self.run_workflow(release_worker.ReportRunWorkflow(
+                    build.id, release.name, release.number, 'run',
+                    log_path=self.log_path, image_path=image_path,
+                    url='http://example.com', ref_url='http://example.com',
+                    ref_image=ref_image, ref_log=ref_image))
+
+                if build is self.build:
+                    self.run_workflow(release_worker.ReportPdiffWorkflow(
+                        build.id, release.name, release.number, 'run',
+                        diff_path=ref_path, log_path=self.log_path,
+                        distortion=0.5, parameters=parameters,
+                        regions=[(1, 2, 3, 4, 5)]))
+        finally:
+            os.remove(image_path)
+            os.remove(ref_path)
+
+        db.session.expire_all()
+        first_run = models.Run.query.filter_by(
+            release_id=self.release.id).one()
+        second_run = models.Run.query.filter_by(
+            release_id=other_release.id).one()
+        return first_run, second_run
+
+    def testReusePdiffResult(self):
+        """Tests that a saved diff of the same images is reused."""
+        first_run, second_run = self.report_diff_twice(
+            server.app.config['PDIFF_PARAMETERS'])
+        self.assertEquals(models.Run.DIFF_FOUND, first_run.status)
+        self.assertEquals(models.Run.DIFF_FOUND, second_run.status)
+        self.assertEquals(first_run.diff_image, second_run.diff_image)
+        self.assertEquals(0.5, second_run.distortion)
+        self.assertEquals([[1, 2, 3, 4, 5]],
+                          json.loads(first_run.diff_regions))
+        self.assertEquals(first_run.diff_regions, second_run.diff_regions)
+        self.assertEquals([], work_queue.query(run_id=second_run.id))
+
+    def testPdiffResultParameters(self):
+        """Tests that diffs made with other worker settings are not reused."""
+        first_run, second_run = self.report_diff_twice(
+            'engine=numpy,tile_size=64')
+        self.assertEquals(models.Run.DIFF_FOUND, first_run.status)
+        self.assertEquals(models.Run.NEEDS_DIFF, second_run.status)
+        self.assertEquals(1, len(work_queue.query(run_id=second_run.id)))
+
+    def testReportRunsError(self):
+        """Tests that an error reporting a batch is raised for each run."""
+        item = ReportRunsWorkflow(
+            self.build.id, 'does-not-exist', 1, self.log_path, 3)
+        item.root = True
+        self.coordinator.input_queue.put(item)
+        self.assertRaises(release_worker.ReportRunError,
+                          self.coordinator.wait_one)
+
+
+class UploadFilesTest(unittest.TestCase):
+    """Tests for uploading files the server may already have."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        self.coordinator = workers.get_coordinator()
+        fetch_worker.register(self.coordinator)
+        timer_worker.register(self.coordinator)
+        self.coordinator.start()
+
+        self.first_build = models.Build(name='First build')
+        self.second_build = models.Build(name='Second build')
+        db.session.add(self.first_build)
+        db.session.add(self.second_build)
+        db.session.commit()
+
+        self.file_path = tempfile.mktemp()
+        with open(self.file_path, 'w') as handle:
+            handle.write(uuid.uuid4().hex)
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        self.coordinator.stop()
+        self.coordinator.join()
+        os.remove(self.file_path)
+
+    def upload(self, build_id, file_paths):
+        item = release_worker.UploadFilesWorkflow(build_id, file_paths)
+        item.root = True
+        self.coordinator.input_queue.put(item)
+        self.coordinator.wait_one()
+        self.assertTrue(item.error is None, item.error)
+        return item.result
+
+    def has_artifacts(self, build_id, sha1sums):
+        call = fetch_worker.fetch(fetch_worker.FetchItem(
+            FLAGS.release_server_prefix + '/has_artifacts',
+            post={'build_id': build_id, 'sha1sums': json.dumps(sha1sums)},
+            username=FLAGS.release_client_id,
+            password=FLAGS.release_client_secret))
+        self.assertEquals(200, call.status_code)
+        return call.json['sha1sums']
+
+    def testUploadFiles(self):
+        """Tests that other builds must upload artifacts to own them."""
+        missing_path = tempfile.mktemp()
+        first = self.upload(self.first_build.id, [self.file_path])
+        second = self.upload(
+            self.second_build.id, [self.file_path, missing_path])
+
+        self.assertEquals(1, len(first))
+        self.assertTrue(first[0])
+        self.assertEquals([first[0], None], second)
+
+        # Only the first build's own artifacts are reported to it.
+        self.assertEquals([], self.has_artifacts(
+            self.first_build.id, [hashlib.sha1('missing').hexdigest()]))
+        self.assertEquals(
+            [first[0]], self.has_artifacts(self.first_build.id, first))
+
+        db.session.expire_all()
+        artifact = models.Artifact.query.get(first[0])
+        self.assertEquals(
+            set([self.first_build.id, self.second_build.id]),
+            set(build.id for build in artifact.owners))
+
+    def testOtherBuildArtifacts(self):
+        """Tests that artifacts owned by other builds are not reported."""
+        first = self.upload(self.first_build.id, [self.file_path])
+        self.assertEquals([], self.has_artifacts(self.second_build.id, first))
+
+        db.session.expire_all()
+        artifact = models.Artifact.query.get(first[0])
+        self.assertEquals(
+            [self.first_build.id], [build.id for build in artifact.owners])
+
+
+class RequestRunsTest(unittest.TestCase):
+    """Tests for requesting many runs at once."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        FLAGS.request_runs_batch_size = 2
+
+        self.coordinator = workers.get_coordinator()
+        fetch_worker.register(self.coordinator)
+        timer_worker.register(self.coordinator)
+        self.coordinator.start()
+
+        self.build = models.Build(name='My build')
+        db.session.add(self.build)
+        db.session.commit()
+
+        self.release = models.Release(
+            name=uuid.uuid4().hex,
+            number=1,
+            build_id=self.build.id,
+            status=models.Release.RECEIVING)
+        db.session.add(self.release)
+        db.session.commit()
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        FLAGS.request_runs_batch_size = 500
+        self.coordinator.stop()
+        self.coordinator.join()
+
+    def testRequestRuns(self):
+        """Tests requesting runs in batches, with and without baselines."""
+        runs = [
+            dict(run_name='run-%d' % i,
+                 url='http://example.com/%d' % i,
+                 config_data='{}')
+            for i in xrange(3)]
+        runs[0].update(
+            ref_url='http://example.com/ref', ref_config_data='{}')
+
+        item = release_worker.RequestRunsWorkflow(
+            self.build.id, self.release.name, self.release.number, runs)
+        item.root = True
+        self.coordinator.input_queue.put(item)
+        self.coordinator.wait_one()
+        self.assertTrue(item.error is None, item.error)
+
+        run_list = (
+            models.Run.query
+            .filter_by(release_id=self.release.id)
+            .order_by(models.Run.name)
+            .all())
+        self.assertEquals(3, len(run_list))
+        for i, run in enumerate(run_list):
+            self.assertEquals('http://example.com/%d' % i, run.url)
+            self.assertTrue(run.config)
+        self.assertEquals('http://example.com/ref', run_list[0].ref_url)
+        self.assertEquals(None, run_list[1].ref_url)
+
+        tasks = work_queue.query(release_id=self.release.id, count=10)
+        self.assertEquals(4, len(tasks))
+
+    def testRequestRunsUnicode(self):
+        """Tests requesting runs with non-ASCII URLs and configs."""
+        item = release_worker.RequestRunsWorkflow(
+            self.build.id, self.release.name, self.release.number,
+            [dict(run_name='run', url=u'http://example.com/caf\xe9',
+                  config_data=json.dumps({'injectCss': u'\u2713'}))])
+        item.root = True
+        self.coordinator.input_queue.put(item)
+        self.coordinator.wait_one()
+        self.assertTrue(item.error is None, item.error)
+
+        run = models.Run.query.filter_by(release_id=self.release.id).one()
+        self.assertEquals(u'http://example.com/caf\xe9', run.url)
+
+    def testRequestRunsLastGood(self):
+        """Tests that runs use the last good release as their reference."""
+        good_release = models.Release(
+            name=uuid.uuid4().hex,
+            number=1,
+            build_id=self.build.id,
+            status=models.Release.GOOD)
+        db.session.add(good_release)
+        db.session.flush()
+        good_run = models.Run(
+            release_id=good_release.id,
+            name='run-0',
+            status=models.Run.NO_DIFF_NEEDED,
+            url='http://example.com/good')
+        db.session.add(good_run)
+        db.session.commit()
+
+        item = release_worker.RequestRunsWorkflow(
+            self.build.id, self.release.name, self.release.number,
+            [dict(run_name='run-%d' % i, url='http://example.com/%d' % i,
+                  config_data='{}')
+             for i in xrange(2)])
+        item.root = True
+        self.coordinator.input_queue.put(item)
+        self.coordinator.wait_one()
+        self.assertTrue(item.error is None, item.error)
+
+        run_list = (
+            models.Run.query
+            .filter_by(release_id=self.release.id)
+            .order_by(models.Run.name)
+            .all())
+        self.assertEquals('http://example.com/good', run_list[0].ref_url)
+        self.assertEquals(None, run_list[1].ref_url)
+
+    def testRequestRunsViewports(self):
+        """Tests that a run with many viewports makes one run for each."""
+        config_data = json.dumps(dict(viewports=[
+            dict(name='mobile', width=375, height=667),
+            dict(name='desktop', width=1280, height=1024)]))
+        item = release_worker.RequestRunsWorkflow(
+            self.build.id, self.release.name, self.release.number,
+            [dict(run_name='run', url='http://example.com',
+                  config_data=config_data, ref_url='http://example.com/ref',
+                  ref_config_data=config_data)])
+        item.root = True
+        self.coordinator.input_queue.put(item)
+        self.coordinator.wait_one()
+        self.assertTrue(item.error is None, item.error)
+
+        run_list = (
+            models.Run.query
+            .filter_by(release_id=self.release.id)
+            .order_by(models.Run.name)
+            .all())
+        self.assertEquals(
+            ['run@desktop', 'run@mobile'], [run.name for run in run_list])
+        for run in run_list:
+            self.assertEquals('http://example.com', run.url)
+            self.assertEquals('http://example.com/ref', run.ref_url)
+
+        tasks = work_queue.query(release_id=self.release.id, count=10)
+        self.assertEquals(2, len(tasks))
+        for task in tasks:
+            self.assertEquals(
+                ['run@mobile', 'run@desktop'],
+                task['payload']['viewport_run_names'])
+
+    def testRequestRunsError(self):
+        """Tests that an error requesting runs is raised."""
+        item = release_worker.RequestRunsWorkflow(
+            self.build.id, 'does-not-exist', 1,
+            [dict(run_name='run', url='http://example.com', config_data='{}')])
+        item.root = True
+        self.coordinator.input_queue.put(item)
+        self.assertRaises(release_worker.RequestRunError,
+                          self.coordinator.wait_one)
+
+
+def main(argv):
+    logging.getLogger().setLevel(logging.DEBUG)
+    argv = FLAGS(argv)
+    unittest.main(argv=argv)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
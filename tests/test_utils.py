@@ -57,7 +57,8 @@ def start_server():
     server.app.config['CSRF_ENABLED'] = False
     server.app.config['IGNORE_AUTH'] = True
     server.app.config['TESTING'] = True
-    run = lambda: server.app.run(debug=False, host='0.0.0.0', port=server_port)
+    run = lambda: server.app.run(
+        debug=False, host='0.0.0.0', port=server_port, threaded=True)
 
     server_thread = threading.Thread(target=run)
     server_thread.setDaemon(True)
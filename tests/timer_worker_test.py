@@ -72,6 +72,33 @@ class TimerThreadTest(unittest.TestCase):
         elapsed = end - begin
         self.assertTrue(1.0 > elapsed > 0.7)
 
+    def testWakeEarly(self):
+        """Tests firing a timer before its delay has passed."""
+        self.worker.start()
+        item = timer_worker.TimerItem(60)
+
+        begin = time.time()
+        self.timer_queue.put(item)
+        self.worker.wake_early(item)
+        output = self.output_queue.get(True, 1)
+        end = time.time()
+
+        self.assertTrue(output is item)
+        self.assertTrue(item.fired)
+        self.assertTrue(end - begin < 0.5)
+
+        # Waking again after the timer has fired does nothing.
+        self.worker.wake_early(item)
+        self.assertRaises(Queue.Empty, self.output_queue.get, True, 0.2)
+
+    def testStop(self):
+        """Tests that stopping wakes up a thread with no timers."""
+        self.worker.start()
+        time.sleep(0.1)
+        self.worker.stop()
+        self.worker.join(1)
+        self.assertFalse(self.worker.isAlive())
+
 
 def main(argv):
     logging.getLogger().setLevel(logging.DEBUG)
@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+# Copyright 2013 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the work_queue module."""
+
+import datetime
+import logging
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+# Local Libraries
+import gflags
+FLAGS = gflags.FLAGS
+from sqlalchemy.exc import OperationalError
+
+# Local modules
+from dpxdt import server
+from dpxdt.server import db
+from dpxdt.server import work_queue
+
+
+TEST_QUEUE = 'test-queue'
+
+
+class LeaseTest(unittest.TestCase):
+    """Tests for leasing tasks with each lease strategy."""
+
+    strategy = 'select_for_update'
+
+    def setUp(self):
+        """Sets up the test harness."""
+        self.db_path = tempfile.mktemp(suffix='.db')
+        server.app.config['SQLALCHEMY_DATABASE_URI'] = (
+            'sqlite:///' + self.db_path)
+        server.app.config['WORK_QUEUE_LEASE_STRATEGY'] = self.strategy
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        server.app.config['WORK_QUEUE_LEASE_STRATEGY'] = None
+        db.session.remove()
+        os.remove(self.db_path)
+
+    def add_tasks(self, count):
+        task_ids = [
+            work_queue.add(TEST_QUEUE, payload={'index': i})
+            for i in xrange(count)]
+        db.session.commit()
+        return task_ids
+
+    def testLease(self):
+        """Tests leasing tasks until the queue is empty."""
+        task_ids = self.add_tasks(5)
+
+        first = work_queue.lease(TEST_QUEUE, 'owner', count=3)
+        db.session.commit()
+        second = work_queue.lease(TEST_QUEUE, 'owner', count=3)
+        db.session.commit()
+        self.assertEquals(None, work_queue.lease(TEST_QUEUE, 'owner'))
+
+        self.assertEquals(3, len(first))
+        self.assertEquals(2, len(second))
+        leased_ids = [task['task_id'] for task in first + second]
+        self.assertEquals(sorted(task_ids), sorted(leased_ids))
+
+        for task_id in task_ids:
+            task = work_queue.WorkQueue.query.get((task_id, TEST_QUEUE))
+            self.assertEquals('owner', task.last_owner)
+            self.assertEquals(1, task.lease_attempts)
+
+    def testLeaseExpired(self):
+        """Tests that tasks can be leased again after the lease expires."""
+        task_id, = self.add_tasks(1)
+        work_queue.lease(TEST_QUEUE, 'first', timeout_seconds=-1)
+        db.session.commit()
+
+        task, = work_queue.lease(TEST_QUEUE, 'second')
+        db.session.commit()
+        self.assertEquals(task_id, task['task_id'])
+        self.assertEquals(2, task['lease_attempts'])
+
+    def testHasAvailable(self):
+        """Tests checking for tasks without leasing them."""
+        self.assertFalse(work_queue.has_available(TEST_QUEUE))
+        self.add_tasks(1)
+        self.assertTrue(work_queue.has_available(TEST_QUEUE))
+
+        work_queue.lease(TEST_QUEUE, 'owner', timeout_seconds=-1)
+        db.session.commit()
+        self.assertTrue(work_queue.has_available(TEST_QUEUE))
+
+        work_queue.lease(TEST_QUEUE, 'owner')
+        db.session.commit()
+        self.assertFalse(work_queue.has_available(TEST_QUEUE))
+
+
+class AtomicClaimLeaseTest(LeaseTest):
+    """Tests for leasing tasks with atomic claims."""
+
+    strategy = 'atomic_claim'
+
+    def testConcurrentLeases(self):
+        """Tests that concurrent lessees never lease the same task.
+
+        SQLite ignores SELECT ... FOR UPDATE, so only atomic claims can
+        keep concurrent lessees apart there.
+        """
+        task_ids = self.add_tasks(100)
+        leased_ids = []
+        lock = threading.Lock()
+
+        def lessee(owner):
+            try:
+                while True:
+                    try:
+                        tasks = work_queue.lease(TEST_QUEUE, owner, count=3)
+                        db.session.commit()
+                    except OperationalError:
+                        db.session.rollback()
+                        continue
+                    if not tasks:
+                        return
+                    with lock:
+                        leased_ids.extend(t['task_id'] for t in tasks)
+            finally:
+                db.session.remove()
+
+        threads = [
+            threading.Thread(target=lessee, args=('owner%d' % i,))
+            for i in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(sorted(task_ids), sorted(leased_ids))
+
+
+class ReapTest(unittest.TestCase):
+    """Tests for reaping old finished tasks."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        self.db_path = tempfile.mktemp(suffix='.db')
+        server.app.config['SQLALCHEMY_DATABASE_URI'] = (
+            'sqlite:///' + self.db_path)
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        db.session.remove()
+        os.remove(self.db_path)
+
+    def add_task(self, status, age_days):
+        task_id = work_queue.add(TEST_QUEUE)
+        task = work_queue.WorkQueue.query.get((task_id, TEST_QUEUE))
+        task.status = status
+        task.created = (
+            datetime.datetime.utcnow() - datetime.timedelta(days=age_days))
+        db.session.add(task)
+        db.session.commit()
+        return task_id
+
+    def get_task_ids(self):
+        return set(
+            task_id for task_id, in
+            db.session.query(work_queue.WorkQueue.task_id))
+
+    def testReap(self):
+        """Tests that only old finished tasks are reaped."""
+        self.add_task(work_queue.WorkQueue.DONE, 10)
+        self.add_task(work_queue.WorkQueue.ERROR, 10)
+        self.add_task(work_queue.WorkQueue.CANCELED, 10)
+        old_live = self.add_task(work_queue.WorkQueue.LIVE, 10)
+        new_done = self.add_task(work_queue.WorkQueue.DONE, 0)
+
+        self.assertEquals(3, work_queue.reap(24 * 60 * 60, 100))
+        db.session.commit()
+
+        self.assertEquals(set([old_live, new_done]), self.get_task_ids())
+        self.assertEquals(
+            0, db.session.query(work_queue.work_queue_archive).count())
+
+    def testReapBatches(self):
+        """Tests that reaping deletes the oldest tasks in batches."""
+        oldest = [self.add_task(work_queue.WorkQueue.DONE, 10 - i)
+                  for i in xrange(5)]
+
+        self.assertEquals(2, work_queue.reap(24 * 60 * 60, 2))
+        db.session.commit()
+        self.assertEquals(set(oldest[2:]), self.get_task_ids())
+
+        self.assertEquals(2, work_queue.reap(24 * 60 * 60, 2))
+        db.session.commit()
+        self.assertEquals(1, work_queue.reap(24 * 60 * 60, 2))
+        db.session.commit()
+        self.assertEquals(0, work_queue.reap(24 * 60 * 60, 2))
+        self.assertEquals(set(), self.get_task_ids())
+
+    def testReapArchive(self):
+        """Tests moving reaped tasks to the archive table."""
+        task_id = self.add_task(work_queue.WorkQueue.ERROR, 10)
+
+        self.assertEquals(1, work_queue.reap(24 * 60 * 60, 100, archive=True))
+        db.session.commit()
+
+        self.assertEquals(set(), self.get_task_ids())
+        archived = db.session.query(work_queue.work_queue_archive).one()
+        self.assertEquals(task_id, archived.task_id)
+        self.assertEquals(TEST_QUEUE, archived.queue_name)
+        self.assertEquals(work_queue.WorkQueue.ERROR, archived.status)
+        self.assertTrue(archived.archived)
+
+
+class AddManyTest(unittest.TestCase):
+    """Tests for adding many tasks at once."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        self.db_path = tempfile.mktemp(suffix='.db')
+        server.app.config['SQLALCHEMY_DATABASE_URI'] = (
+            'sqlite:///' + self.db_path)
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        db.session.remove()
+        os.remove(self.db_path)
+
+    def testAddMany(self):
+        """Tests adding tasks with and without IDs, skipping duplicates."""
+        existing_id = work_queue.add(TEST_QUEUE, payload='existing',
+                                     task_id='existing')
+        db.session.commit()
+
+        task_ids = work_queue.add_many(TEST_QUEUE, [
+            dict(payload={'index': 0}, source='test'),
+            dict(payload='new', task_id='new'),
+            dict(payload='existing again', task_id=existing_id),
+            dict(payload='new again', task_id='new'),
+        ])
+        db.session.commit()
+
+        self.assertEquals(4, len(task_ids))
+        self.assertEquals(['new', existing_id, 'new'], task_ids[1:])
+
+        tasks = work_queue.lease(TEST_QUEUE, 'owner', count=10)
+        db.session.commit()
+        payload_dict = dict(
+            (task['task_id'], task['payload']) for task in tasks)
+        self.assertEquals(
+            {task_ids[0]: {'index': 0},
+             'new': 'new',
+             existing_id: 'existing'},
+            payload_dict)
+
+    def testAddManyEmpty(self):
+        """Tests adding no tasks."""
+        self.assertEquals([], work_queue.add_many(TEST_QUEUE, []))
+
+
+class StatsTest(unittest.TestCase):
+    """Tests for the queue statistics."""
+
+    def setUp(self):
+        """Sets up the test harness."""
+        self.db_path = tempfile.mktemp(suffix='.db')
+        server.app.config['SQLALCHEMY_DATABASE_URI'] = (
+            'sqlite:///' + self.db_path)
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        """Cleans up the test harness."""
+        db.session.remove()
+        os.remove(self.db_path)
+
+    def get_counts(self):
+        return [(s['name'], s['status'], s['count'])
+                for s in work_queue.get_stats()]
+
+    def testStats(self):
+        """Tests statistics are grouped by queue and status."""
+        work_queue.add(TEST_QUEUE)
+        work_queue.add(TEST_QUEUE)
+        work_queue.add('other-queue')
+        db.session.commit()
+        work_queue.lease(TEST_QUEUE, 'owner')
+        db.session.commit()
+
+        stats_list = work_queue.get_stats()
+        self.assertEquals(
+            [('other-queue', work_queue.WorkQueue.LIVE, 1),
+             (TEST_QUEUE, work_queue.WorkQueue.LIVE, 2)],
+            [(s['name'], s['status'], s['count']) for s in stats_list])
+        self.assertTrue(stats_list[0]['newest_created'])
+        self.assertTrue(stats_list[0]['oldest_eta'])
+
+        stats = work_queue.stats_to_dict(stats_list[0])
+        self.assertTrue(isinstance(stats['newest_created'], int))
+
+    def testCounters(self):
+        """Tests the counts follow tasks as they are added and finished."""
+        work_queue.add(TEST_QUEUE)
+        work_queue.add_many(TEST_QUEUE, [{}, {}])
+        db.session.commit()
+        self.assertEquals(
+            [(TEST_QUEUE, work_queue.WorkQueue.LIVE, 3)], self.get_counts())
+
+        tasks = work_queue.lease(TEST_QUEUE, 'owner', count=2)
+        db.session.commit()
+        work_queue.finish(TEST_QUEUE, tasks[0]['task_id'], 'owner')
+        work_queue.finish(TEST_QUEUE, tasks[1]['task_id'], 'owner',
+                          error=True)
+        db.session.commit()
+        self.assertEquals(
+            [(TEST_QUEUE, work_queue.WorkQueue.DONE, 1),
+             (TEST_QUEUE, work_queue.WorkQueue.ERROR, 1),
+             (TEST_QUEUE, work_queue.WorkQueue.LIVE, 1)],
+            self.get_counts())
+
+        self.assertEquals(2, work_queue.reap(0, 100))
+        db.session.commit()
+        self.assertEquals(
+            [(TEST_QUEUE, work_queue.WorkQueue.LIVE, 1)], self.get_counts())
+
+    def testMissingStats(self):
+        """Tests that counts missing for existing tasks are recounted."""
+        work_queue.add(TEST_QUEUE)
+        work_queue.add(TEST_QUEUE)
+        db.session.commit()
+        db.session.execute(work_queue.WorkQueueStats.__table__.delete())
+        db.session.commit()
+
+        work_queue.add(TEST_QUEUE)
+        db.session.commit()
+        self.assertEquals(
+            [(TEST_QUEUE, work_queue.WorkQueue.LIVE, 3)], self.get_counts())
+
+
+def main(argv):
+    logging.getLogger().setLevel(logging.DEBUG)
+    argv = FLAGS(argv)
+    unittest.main(argv=argv)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# Copyright 2013 Brett Slatkin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Microbenchmark for the scheduling overhead of the WorkflowThread.
+
+Measures how long it takes each kind of work to round-trip through the
+coordinator and its worker threads:
+
+- nested: A chain of WorkflowItems that each yield the next one.
+- timer: A workflow that yields many zero-delay TimerItems in sequence.
+- process: A workflow that runs many trivial subprocesses in sequence.
+
+Example usage:
+
+PYTHONPATH=. ./tests/workers_benchmark.py --steps=500
+"""
+
+import logging
+import sys
+import tempfile
+import time
+
+# Local Libraries
+import gflags
+FLAGS = gflags.FLAGS
+
+# Local modules
+from dpxdt.client import process_worker
+from dpxdt.client import timer_worker
+from dpxdt.client import workers
+
+
+gflags.DEFINE_integer(
+    'steps', 200, 'Number of sequential steps to run for each benchmark.')
+
+
+class NestedWorkflow(workers.WorkflowItem):
+    """Yields a chain of child workflows that is depth items deep."""
+
+    def run(self, depth):
+        if depth > 0:
+            yield NestedWorkflow(depth - 1)
+
+
+class TimerWorkflow(workers.WorkflowItem):
+    """Waits on zero-delay timers one after another."""
+
+    def run(self, count):
+        for _ in xrange(count):
+            yield timer_worker.TimerItem(0)
+
+
+class TrueWorkflow(process_worker.ProcessWorkflow):
+    """Runs a subprocess that exits immediately."""
+
+    def get_args(self):
+        return [sys.executable, '-S', '-c', 'pass']
+
+
+class ProcessesWorkflow(workers.WorkflowItem):
+    """Runs trivial subprocesses one after another."""
+
+    def run(self, count, log_path):
+        for _ in xrange(count):
+            yield TrueWorkflow(log_path)
+
+
+def run_benchmark(coordinator, name, item, steps):
+    """Runs a root workflow to completion and prints the time per step."""
+    item.root = True
+    start = time.time()
+    coordinator.input_queue.put(item)
+    coordinator.wait_one()
+    elapsed = time.time() - start
+    print '%-10s %6d steps %8.3fs %10.1f usec/step' % (
+        name, steps, elapsed, 1e6 * elapsed / steps)
+
+
+def main(argv):
+    try:
+        argv = FLAGS(argv)
+    except gflags.FlagsError, e:
+        print '%s\nUsage: %s ARGS\n%s' % (e, sys.argv[0], FLAGS)
+        sys.exit(1)
+
+    workers.LOGGER.setLevel(logging.WARNING)
+    log_path = tempfile.mktemp()
+
+    coordinator = workers.get_coordinator()
+    timer_worker.register(coordinator)
+    coordinator.start()
+    try:
+        run_benchmark(
+            coordinator, 'nested', NestedWorkflow(FLAGS.steps), FLAGS.steps)
+        run_benchmark(
+            coordinator, 'timer', TimerWorkflow(FLAGS.steps), FLAGS.steps)
+        process_steps = max(1, FLAGS.steps / 10)
+        run_benchmark(
+            coordinator, 'process', ProcessesWorkflow(process_steps, log_path),
+            process_steps)
+    finally:
+        coordinator.stop()
+        coordinator.join()
+
+
+if __name__ == '__main__':
+    main(sys.argv)